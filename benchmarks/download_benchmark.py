@@ -0,0 +1,100 @@
+"""
+Compares the parallel ranged GET download used for query results against boto3's managed download.
+
+An object of the requested size is written to a moto mocked bucket and downloaded once per part size and concurrency
+combination. Moto serves requests in process so the numbers show the overhead and scaling of each approach rather
+than real S3 bandwidth; run against a real bucket with --bucket for production numbers.
+
+Usage: python benchmarks/download_benchmark.py [-s SIZE_MIB] [-p PART_SIZES] [-c CONCURRENCIES] [--bucket BUCKET]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager, nullcontext, redirect_stdout
+
+import boto3
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from pylot.plugins.helpers.s3_helpers import download_s3_object  # noqa: E402
+
+MIB = 1024 * 1024
+BENCHMARK_KEY = 'pylot-benchmark/query_results.json'
+
+
+@contextmanager
+def mocked_s3():
+    try:
+        from moto import mock_aws
+    except ImportError:
+        from moto import mock_s3 as mock_aws  # moto < 5
+    with mock_aws():
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+        yield
+
+
+def time_download(function):
+    start = time.perf_counter()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull, redirect_stdout(devnull):
+        function()
+    return time.perf_counter() - start
+
+
+def run_benchmark(s3_client, bucket, size, part_sizes, concurrencies):
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        filename = os.path.join(temp_dir, 'query_results.json')
+        elapsed = time_download(lambda: s3_client.download_file(bucket, BENCHMARK_KEY, filename))
+        results.append({'method': 'boto3 download_file', 'part_size_mib': 8, 'concurrency': 10, 'elapsed_s': elapsed})
+        for part_size in part_sizes:
+            for concurrency in concurrencies:
+                elapsed = time_download(lambda: download_s3_object(
+                    bucket, BENCHMARK_KEY, filename, s3_client, part_size=int(part_size * MIB), concurrency=concurrency
+                ))
+                results.append({
+                    'method': 'download_s3_object', 'part_size_mib': part_size, 'concurrency': concurrency,
+                    'elapsed_s': elapsed
+                })
+
+    for result in results:
+        result['throughput_mib_s'] = size / MIB / result['elapsed_s'] if result['elapsed_s'] else 0.0
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark query result downloads.')
+    parser.add_argument('-s', '--size', type=int, default=256, help='Object size in MiB.')
+    parser.add_argument('-p', '--part-sizes', type=float, nargs='+', default=[4, 8, 16, 32], help='Part sizes in MiB.')
+    parser.add_argument('-c', '--concurrencies', type=int, nargs='+', default=[1, 4, 8, 16],
+                        help='Number of concurrent ranged GETs.')
+    parser.add_argument('--bucket', help='Benchmark against this real bucket instead of a moto mocked bucket.')
+    args = parser.parse_args()
+
+    size = args.size * MIB
+    context = mocked_s3() if not args.bucket else nullcontext()
+    with context:
+        s3_client = boto3.client('s3')
+        bucket = args.bucket or 'pylot-benchmark'
+        if not args.bucket:
+            s3_client.create_bucket(Bucket=bucket, CreateBucketConfiguration={
+                'LocationConstraint': s3_client.meta.region_name
+            })
+        s3_client.put_object(Bucket=bucket, Key=BENCHMARK_KEY, Body=os.urandom(size))
+        try:
+            results = run_benchmark(s3_client, bucket, size, args.part_sizes, args.concurrencies)
+        finally:
+            s3_client.delete_object(Bucket=bucket, Key=BENCHMARK_KEY)
+
+    print(f'{"method":<20} {"part MiB":>8} {"workers":>8} {"seconds":>8} {"MiB/s":>8}')
+    for result in results:
+        print(f'{result["method"]:<20} {result["part_size_mib"]:>8} {result["concurrency"]:>8} '
+              f'{result["elapsed_s"]:>8.2f} {result["throughput_mib_s"]:>8.1f}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures PyLOT startup cost for each subcommand.
+
+Every subcommand is run with -h in a fresh interpreter using -X importtime so the wall time and the import time
+breakdown reflect what a cron job or Step Function task pays for a single PyLOT call.
+
+Usage: python benchmarks/startup_benchmark.py [-n RUNS] [-t TOP] [-o results.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from pylot.pylot_cli import discover_plugins  # noqa: E402
+
+
+def parse_import_times(stderr):
+    """
+    Parses the output of python -X importtime and sums the self time per top level package.
+    :param stderr: stderr of the benchmarked process
+    :return: dictionary of the form {package: microseconds}
+    """
+    breakdown = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|', maxsplit=2)
+        package = name.strip().split('.', maxsplit=1)[0]
+        breakdown[package] = breakdown.get(package, 0) + int(self_us)
+
+    return breakdown
+
+
+def benchmark_command(arguments, runs):
+    wall_times = []
+    breakdown = {}
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-m', 'pylot.pylot_cli', *arguments],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=False
+        )
+        wall_times.append(time.perf_counter() - start)
+        breakdown = parse_import_times(process.stderr)
+
+    return {
+        'command': ' '.join(['pylot', *arguments]),
+        'wall_time_median_s': round(statistics.median(wall_times), 4),
+        'wall_time_min_s': round(min(wall_times), 4),
+        'import_time_total_ms': round(sum(breakdown.values()) / 1000, 2),
+        'import_time_ms': {k: round(v / 1000, 2) for k, v in sorted(breakdown.items(), key=lambda x: -x[1])}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark PyLOT startup time for each subcommand.')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='Number of runs per subcommand.')
+    parser.add_argument('-t', '--top', type=int, default=8, help='Number of packages shown in the import breakdown.')
+    parser.add_argument('-o', '--output', help='Write the full results to this json file.')
+    args = parser.parse_args()
+
+    commands = [['-h']] + [[plugin, '-h'] for plugin in discover_plugins()]
+    results = []
+    for command in commands:
+        result = benchmark_command(command, args.runs)
+        results.append(result)
+        print(f'{result["command"]}: {result["wall_time_median_s"]}s median wall time, '
+              f'{result["import_time_total_ms"]}ms importing')
+        for package, import_ms in list(result['import_time_ms'].items())[:args.top]:
+            print(f'    {package:<24} {import_ms:>10}ms')
+
+    if args.output:
+        with open(args.output, 'w+', encoding='utf-8') as outfile:
+            outfile.write(json.dumps(results, indent=2))
+        print(f'Results written to: {args.output}')
+
+    return 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+# Lightweight plugin manifest used by pylot_cli to build the top level parser without importing every plugin. Only
+# the plugin selected on the commandline has its main module imported. Plugins without an entry are still discovered
+# from the plugins directory, they just have no top level help text.
+PLUGIN_MANIFEST = {
+    'cumulus_api': 'This plugin provides a commandline interface to the cumulus api endpoints.',
+    'opensearch': 'This plugin is used to submit queries directly to OpenSearch bypassing the cumulus API.',
+    'rds_lambda': 'This plugin is used to submit queries directly to the cumulus RDS bypassing the cumulus API.',
+    'status': 'This plugin reconciles the files of a collection in S3 with its granule records in Cumulus.'
+}
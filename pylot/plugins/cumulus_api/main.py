@@ -1,12 +1,25 @@
+import concurrent.futures
 import inspect
 import json
 import os
+import sys
+import threading
 from argparse import RawTextHelpFormatter
+from importlib import metadata
 from inspect import getmembers, isfunction, ismethod
+from json import JSONDecodeError
+from tempfile import gettempdir
 
-import boto3
 from cumulus_api import CumulusApi
+from .. import PLUGIN_MANIFEST
+from ..helpers.aws_helpers import get_client
+from ..helpers.cache_helpers import READ_ACTIONS, add_cache_arguments, get_response_cache
+from ..helpers.checkpoint_helpers import Checkpoint
 from ..helpers.pylot_helpers import PyLOTHelpers
+from ..helpers.stream_helpers import JsonStreamWriter, RecentKeys, open_output, results_to_stdout
+
+# Fields that identify a record across the cumulus record types. Used to deduplicate sharded listings.
+RECORD_ID_FIELDS = ('collectionId', 'granuleId', 'name', 'version', 'id', 'arn', 'pdrName')
 
 
 def is_action_function(value):
@@ -47,10 +60,70 @@ def extract_action_target_args(target_class=CumulusApi):
     return action_target_dict
 
 
-def generate_parser(subparsers, action_target_dict):
+def get_cumulus_api_version():
+    """
+    Looks up the installed cumulus_api version without importing the package.
+    :return: version string or None if it cannot be determined
+    """
+    for distribution in ('cumulus-api', 'cumulus_api'):
+        try:
+            return metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            pass
+
+    return None
+
+
+def load_action_target_args(cache_dir=None):
+    """
+    Returns the action/target/argument table from extract_action_target_args. The table is cached on disk keyed by the
+    installed cumulus_api version so the CumulusApi class only has to be inspected once per version.
+    :param cache_dir: directory to store the cache in. Defaults to <tmp>/pylot_cache/
+    :return: dictionary of the form {"action": {"target": [arguments]}}
+    """
+    version = get_cumulus_api_version()
+    if not version:
+        return extract_action_target_args()
+
+    cache_dir = cache_dir or f'{gettempdir()}/pylot_cache/'
+    cache_file = os.path.join(cache_dir, f'cumulus_api_{version}.json')
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as _file:
+                return json.load(_file)
+        except (OSError, JSONDecodeError):
+            print(f'Ignoring unreadable parser cache: {cache_file}')
+
+    action_target_dict = extract_action_target_args()
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file = f'{cache_file}.{os.getpid()}'
+    with open(temp_file, 'w+', encoding='utf-8') as _file:
+        json.dump(action_target_dict, _file)
+    os.replace(temp_file, cache_file)
+
+    return action_target_dict
+
+
+def select_actions(argv, action_target_dict):
+    """
+    Determines which action was requested on the commandline so only that action's targets need parsers.
+    :param argv: commandline arguments excluding the program name
+    :param action_target_dict: dictionary returned by extract_action_target_args
+    :return: list containing the requested action or an empty list if none was requested
+    """
+    if 'cumulus_api' in argv:
+        argv = argv[argv.index('cumulus_api') + 1:]
+    for argument in argv:
+        if argument in action_target_dict:
+            return [argument]
+
+    return []
+
+
+def generate_parser(subparsers, action_target_dict, selected_actions=None):
     cumulus_api_parser = subparsers.add_parser(
         'cumulus_api',
-        help='This plugin provides a commandline interface to the cumulus api endpoints.',
+        help=PLUGIN_MANIFEST.get('cumulus_api'),
         description='Provides commandline access to the cumulus api. To see available arguments '
                     'check the cumulus documentation here: https://nasa.github.io/cumulus-api/#cumulus-api\n'
                     'If more than 10 records are needed to be returned use the limit keyword argument: limit=XX\n'
@@ -66,6 +139,29 @@ def generate_parser(subparsers, action_target_dict):
     cumulus_api_parser.add_argument(
         '-o', '--output', metavar='file.json', help='specify a json file to write api response to.', nargs='?'
     )
+    cumulus_api_parser.add_argument(
+        '-f', '--format', metavar='', dest='output_format', default='json', choices=['json', 'jsonl'],
+        help='Format of paginated results: json for a JSON array or jsonl for JSON Lines. Default is json. '
+             'Records are written as each page arrives.'
+    )
+    cumulus_api_parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume an interrupted paginated request from <output>.checkpoint and append to the same output file.'
+    )
+    cumulus_api_parser.add_argument(
+        '-w', '--workers', metavar='', type=int, default=1,
+        help='Number of shards of a list query to fetch concurrently. Default is 1 which disables sharding.'
+    )
+    cumulus_api_parser.add_argument(
+        '--shard-by', metavar='', default='updatedAt', choices=['updatedAt', 'createdAt', 'timestamp'],
+        help='Timestamp field used to split a list query into shards: updatedAt, createdAt, timestamp. '
+             'Default is updatedAt. Existing <field>__from and <field>__to arguments bound the shards.'
+    )
+    cumulus_api_parser.add_argument(
+        '--shards', metavar='', type=int, default=None,
+        help='Number of time windows to split a list query into. Defaults to the number of workers.'
+    )
+    add_cache_arguments(cumulus_api_parser)
 
     action_subparsers = cumulus_api_parser.add_subparsers(title='actions', dest='action', required=True)
     for action_k, target_v in action_target_dict.items():
@@ -74,6 +170,8 @@ def generate_parser(subparsers, action_target_dict):
             usage=f'{action_k} <target> ',
             description=f'{action_k} action for the cumulus API'
         )
+        if selected_actions is not None and action_k not in selected_actions:
+            continue
         target_subparsers = action_parser.add_subparsers(title='target', dest='target', required=True)
         for target_k, argument_v in target_v.items():
             # TODO: Remove this reversal once we have migrated to Cumulus v18.1.0+
@@ -98,51 +196,252 @@ def generate_parser(subparsers, action_target_dict):
     pass
 
 
-def return_parser(subparsers):
-    new_command_dict = extract_action_target_args()
-    return generate_parser(subparsers, new_command_dict)
+def return_parser(subparsers, argv=None):
+    new_command_dict = load_action_target_args()
+    selected_actions = select_actions(sys.argv[1:] if argv is None else argv, new_command_dict)
+    return generate_parser(subparsers, new_command_dict, selected_actions)
+
+
+def load_data(data_val):
+    """
+    Parses the --data argument.
+    :param data_val: path of a JSON file or a JSON string
+    :return: the parsed data
+    """
+    if os.path.isfile(data_val):
+        print(f'Reading datafile: {data_val}')
+        with open(data_val, 'r', encoding='utf-8') as file:
+            return json.load(file)
+
+    return json.loads(data_val)
+
+
+def load_checkpoint_state(checkpoint, function_name):
+    """
+    Loads the state of a previous run to resume it.
+    :param checkpoint: Checkpoint of the output file or None if there is no output file
+    :param function_name: CumulusApi function being called
+    :return: the saved state or an empty dictionary if there is no checkpoint
+    """
+    if not checkpoint:
+        raise ValueError('An output file is required to resume a previous run.')
+    state = checkpoint.load()
+    if state and state.get('function') != function_name:
+        raise ValueError(f'Checkpoint {checkpoint.path} is for {state.get("function")} not {function_name}')
+    if state:
+        print(f'Resuming from checkpoint after {state.get("count")} records: {checkpoint.path}')
+    else:
+        print(f'No checkpoint found for {checkpoint.path}, starting from the first page.')
+
+    return state or {}
+
+
+def main(action, target, output=None, output_format='json', resume=False, workers=1, shard_by='updatedAt', shards=None,
+         cache=False, no_cache=False, refresh=False, cache_ttl=None, **kwargs):
+    # Without an output file the records are streamed to stdout and must not be mixed with progress messages
+    with results_to_stdout(output is None):
+        capi = PyLOTHelpers().get_cumulus_api_instance()
+        data_val = kwargs.get('data', None)
+        if data_val:
+            kwargs.update({'data': load_data(data_val)})
 
+        cumulus_api_lambda_return_limit = 100
+        limit = kwargs.get('limit', cumulus_api_lambda_return_limit)
+        function_name = f'{action}_{target}'
+        checkpoint = Checkpoint(f'{output}.checkpoint', function=function_name, format=output_format) \
+            if output else None
+        state = load_checkpoint_state(checkpoint, function_name) if resume else {}
+        if state:
+            output_format = state.get('format')
 
-def main(action, target, output=None, **kwargs):
-    capi = PyLOTHelpers().get_cumulus_api_instance()
-    data_val = kwargs.get('data', None)
-    if data_val:
-        if os.path.isfile(data_val):
-            print(f'Reading datafile: {data_val}')
-            with open(data_val, 'r', encoding='utf-8') as file:
-                kwargs.update({'data': json.load(file)})
+        print(f'Calling Cumulus API: {function_name}')
+        api_function = getattr(capi, function_name)
+        response_cache = get_response_cache(cache, no_cache, refresh, cache_ttl) if action in READ_ACTIONS else None
+        if response_cache:
+            api_function = response_cache.cached('cumulus_api', function_name, api_function)
+        api_response = None
+        if state:
+            windows = state.get('windows')
+        elif action == 'list' and workers > 1:
+            windows = get_shard_windows(api_function, shard_by, shards or workers, **kwargs)
+            print(f'Fetching {len(windows)} {shard_by} shards using {workers} workers...')
         else:
-            kwargs.update({'data': json.loads(data_val)})
-
-    cumulus_api_lambda_return_limit = 100
-    limit = kwargs.get('limit', cumulus_api_lambda_return_limit)
-    function_name = f'{action}_{target}'
-    print(f'Calling Cumulus API: {function_name}')
-    api_function = getattr(capi, function_name)
-    results = []
-    while True:
-        api_response = api_function(**kwargs)
-        if isinstance(api_response, dict) and 'results' in api_response:
-            api_response = error_handling(api_response, api_function, **kwargs)
-            kwargs.update({'searchContext': api_response.get('meta', {}).get('searchContext', None)})
-            record_count = api_response.get('meta', {}).get('count', 0)
-            api_results = api_response.get('results', [])            
-            results.extend(api_results[:limit - (len(results))])
-            if len(results) >= limit or len(results) >= record_count:
-                break
+            windows = [{}]
+            api_response = api_function(**kwargs)
+
+        if api_response is None or (isinstance(api_response, dict) and 'results' in api_response):
+            with open_output(output, 'r+' if state else 'w+') as outfile:
+                if state:
+                    outfile.seek(state.get('offset'))
+                    outfile.truncate()
+                writer = JsonStreamWriter(outfile, json_lines=output_format == 'jsonl', count=state.get('count', 0))
+                fetch_shards(
+                    api_function, limit, workers, windows, writer, checkpoint, state.get('shards'), api_response,
+                    **kwargs
+                )
+                writer.close()
+            if checkpoint:
+                checkpoint.remove()
         else:
-            results = api_response
+            json_results = json.dumps(api_response, indent=2, sort_keys=True)
+            with open_output(output) as outfile:
+                outfile.write(f'{json_results}\n')
+
+        if output:
+            print(f'Results written to: {output}')
+
+        return 0
+
+
+def paginate(api_function, max_records, api_response=None, fetched=0, **kwargs):
+    """
+    Generator that follows the searchContext of a paginated Cumulus API response and yields one page of records at a
+    time until max_records records or all matching records have been returned.
+    :param api_function: CumulusApi list function
+    :param max_records: maximum number of records to yield
+    :param api_response: an already retrieved first page, if any
+    :param fetched: number of records already fetched when resuming from a searchContext
+    :param kwargs: query parameters for api_function
+    :return: generator of (page, searchContext of the next page) tuples
+    """
+    while True:
+        if api_response is None:
+            api_response = api_function(**kwargs)
+        api_response = error_handling(api_response, api_function, **kwargs)
+        kwargs.update({'searchContext': api_response.get('meta', {}).get('searchContext', None)})
+        record_count = api_response.get('meta', {}).get('count', 0)
+        page = api_response.get('results', [])[:max_records - fetched]
+        fetched += len(page)
+        yield page, kwargs.get('searchContext')
+        if not page or fetched >= max_records or fetched >= record_count:
             break
+        api_response = None
 
-    json_results = json.dumps(results, indent=2, sort_keys=True)
-    if output:
-        with open(output, 'w+', encoding='utf-8') as outfile:
-            outfile.write(json_results)
-        print(f'Results written to: {output}')
-    else:
-        print(json_results)
 
-    return 0
+def get_shard_windows(api_function, shard_by, shards, **kwargs):
+    """
+    Splits a list query into disjoint time windows on the shard_by field. Bounds provided as <shard_by>__from and
+    <shard_by>__to are used if present, otherwise the oldest and newest matching records are looked up.
+    :return: list of dictionaries containing the <shard_by>__from and <shard_by>__to query parameters for each shard
+    """
+    bounds = []
+    for key, order in ((f'{shard_by}__from', 'asc'), (f'{shard_by}__to', 'desc')):
+        bound = kwargs.get(key)
+        if bound is None:
+            query = {**kwargs, 'limit': 1, 'sort_by': shard_by, 'order': order, 'fields': shard_by}
+            query.pop('searchContext', None)
+            records = api_function(**query).get('results', [])
+            if not records:
+                return []
+            bound = records[0].get(shard_by)
+        try:
+            bounds.append(int(bound))
+        except (TypeError, ValueError):
+            raise ValueError(f'Records can not be sharded on {shard_by}: the {key} bound {bound!r} is not an integer. '
+                             f'Use a --shard-by field every matching record has, or --workers 1.') from None
+
+    start, end = bounds
+    width = max(1, -(-(end - start + 1) // shards))
+    windows = []
+    for shard_start in range(start, end + 1, width):
+        windows.append({f'{shard_by}__from': shard_start, f'{shard_by}__to': min(shard_start + width - 1, end)})
+
+    return windows
+
+
+def record_key(record):
+    """
+    Identifies a record for deduplication using the identifying fields present in it.
+    :return: tuple of the identifying values or None if the record has no identifying fields
+    """
+    key = tuple(record.get(field) for field in RECORD_ID_FIELDS if field in record)
+    return key or None
+
+
+def unseen_records(page, seen):
+    """
+    Drops the records of a page that have already been seen and remembers the rest.
+    :param page: list of records
+    :param seen: RecentKeys of the records already written
+    :return: list of the records not seen before
+    """
+    records = []
+    for record in page:
+        key = record_key(record)
+        if key is None or seen.add(key):
+            records.append(record)
+
+    return records
+
+
+def initial_shard_states(windows, shard_states=None):
+    """
+    :param windows: list of query parameters for each shard
+    :param shard_states: shard progress loaded from a checkpoint
+    :return: dictionary of the progress of each shard keyed by the shard index, starting shards missing from
+    shard_states from the first page
+    """
+    shard_states = shard_states or {}
+    for index in range(len(windows)):
+        shard_states.setdefault(str(index), {'searchContext': None, 'fetched': 0, 'done': False})
+
+    return shard_states
+
+
+def fetch_shards(api_function, max_records, workers, windows, writer, checkpoint=None, shard_states=None,
+                 api_response=None, **kwargs):
+    """
+    Fetches the pages of a list query concurrently, one shard per query window. Each page is deduplicated against the
+    most recent records, see RecentKeys, and written as soon as it arrives so records are written in arrival order
+    rather than shard order. After every page the
+    searchContext of each shard and the output offset are saved to the checkpoint so the run can be resumed.
+    :param api_function: CumulusApi list function
+    :param max_records: maximum number of records to write
+    :param workers: number of shards fetched concurrently
+    :param windows: list of query parameters for each shard as returned by get_shard_windows. [{}] fetches serially.
+    :param writer: JsonStreamWriter the records are written to
+    :param checkpoint: Checkpoint to save progress to
+    :param shard_states: shard progress loaded from a checkpoint
+    :param api_response: an already retrieved first page of the first shard, if any
+    :param kwargs: query parameters for api_function
+    :return: number of records written
+    """
+    lock = threading.Lock()
+    seen = RecentKeys()
+    shard_states = initial_shard_states(windows, shard_states)
+
+    def save_checkpoint():
+        if checkpoint:
+            checkpoint.save({'windows': windows, 'shards': shard_states, 'count': writer.count, 'offset': writer.tell()})
+
+    def fetch_shard(index, window):
+        shard_state = shard_states.get(str(index))
+        if shard_state.get('done') or writer.count >= max_records:
+            return
+        query = {**kwargs, **window}
+        if shard_state.get('searchContext'):
+            query.update({'searchContext': shard_state.get('searchContext')})
+        first_page = api_response if index == 0 else None
+        for page, search_context in paginate(api_function, max_records, first_page, shard_state.get('fetched'), **query):
+            with lock:
+                records = unseen_records(page, seen)
+                writer.write(records[:max_records - writer.count])
+                shard_state.update({'searchContext': search_context, 'fetched': shard_state.get('fetched') + len(page)})
+                save_checkpoint()
+                if len(windows) > 1:
+                    print(f'Shard {index} {window}: {shard_state.get("fetched")} records fetched')
+                if writer.count >= max_records:
+                    break
+        with lock:
+            shard_state.update({'done': True})
+            save_checkpoint()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch_shard, index, window) for index, window in enumerate(windows)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    return writer.count
 
 
 def error_handling(results, api_function, **kwargs):
@@ -151,7 +450,7 @@ def error_handling(results, api_function, **kwargs):
         error_message = results.get('message', '')
         if 'Member must have length less than or equal to 8192' in error_message:
             print(f'Handling error: {error_message}')
-            cli = boto3.client('s3')
+            cli = get_client('s3')
             stack_prefix = os.getenv('STACK_PREFIX')
             if not stack_prefix:
                 raise ValueError('The STACK_PREFIX environment variable has not been set')
@@ -190,7 +489,7 @@ def error_handling(results, api_function, **kwargs):
                     Key=dgw
                 )
 
-                ec = boto3.client('events')
+                ec = get_client('events')
                 rule_name = f'{stack_prefix}-custom-{kwargs.get("data").get("name")}'
                 res = ec.list_targets_by_rule(Rule=rule_name)
                 print('Updating rule targets HelloWorldWorkflow -> DiscoverGranules')
@@ -1,8 +1,16 @@
 import argparse
 import inspect
+import io
+import json
+import os
+import tempfile
 import unittest
+from unittest.mock import MagicMock, patch
 
-from pylot.plugins.cumulus_api.main import is_action_function, extract_action_target_args, generate_parser
+from pylot.plugins.cumulus_api.main import is_action_function, extract_action_target_args, generate_parser, \
+    load_action_target_args, select_actions, paginate, get_shard_windows, fetch_shards, main
+from pylot.plugins.helpers.cache_helpers import ResponseCache
+from pylot.plugins.helpers.stream_helpers import JsonStreamWriter
 
 
 class FakeClass:
@@ -22,6 +30,24 @@ class FakeClass:
         pass
 
 
+class FakeListFunction:
+    """
+    Serves granules with updatedAt values 0-9 two records per page, honoring the updatedAt range parameters.
+    """
+    def __init__(self):
+        self.granules = [{'granuleId': f'granule_{x}', 'updatedAt': x} for x in range(10)]
+
+    def __call__(self, searchContext=None, updatedAt__from=0, updatedAt__to=9, order='asc', **kwargs):
+        matches = [x for x in self.granules if updatedAt__from <= x.get('updatedAt') <= updatedAt__to]
+        if order == 'desc':
+            matches.reverse()
+        offset = searchContext or 0
+        return {
+            'meta': {'count': len(matches), 'searchContext': offset + 2},
+            'results': matches[offset:offset + min(2, kwargs.get('limit', 2))]
+        }
+
+
 class TestCumulusApi(unittest.TestCase):
     def test_fake_class(self):
         fc = FakeClass()
@@ -53,6 +79,145 @@ class TestCumulusApi(unittest.TestCase):
         res = generate_parser(subparsers, extract_action_target_args(FakeClass))
         print(res)
 
+    def test_generate_parser_selected_action(self):
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(title='plugins', dest='command', required=True)
+        generate_parser(subparsers, extract_action_target_args(FakeClass), ['public'])
+        args = parser.parse_args(['cumulus_api', 'public', 'function', 'a', 'b'])
+        self.assertEqual((args.action, args.target, args.data), ('public', 'function', 'a'))
+        args = parser.parse_args(['cumulus_api', 'static'])
+        self.assertEqual(args.action, 'static')
+
+    def test_select_actions(self):
+        action_target_dict = extract_action_target_args(FakeClass)
+        self.assertEqual(select_actions(['cumulus_api', '-o', 'out.json', 'public', 'function'], action_target_dict),
+                         ['public'])
+        self.assertEqual(select_actions(['cumulus_api', '-h'], action_target_dict), [])
+
+    def test_paginate(self):
+        pages = list(paginate(FakeListFunction(), 5))
+        self.assertEqual([len(page) for page, _ in pages], [2, 2, 1])
+        self.assertEqual([search_context for _, search_context in pages], [2, 4, 6])
+
+    def test_paginate_all_records(self):
+        pages = list(paginate(FakeListFunction(), 100))
+        self.assertEqual(sum(len(page) for page, _ in pages), 10)
+
+    def test_get_shard_windows(self):
+        windows = get_shard_windows(FakeListFunction(), 'updatedAt', 3)
+        self.assertEqual(windows, [
+            {'updatedAt__from': 0, 'updatedAt__to': 3},
+            {'updatedAt__from': 4, 'updatedAt__to': 7},
+            {'updatedAt__from': 8, 'updatedAt__to': 9}
+        ])
+
+    def test_get_shard_windows_missing_field(self):
+        with self.assertRaises(ValueError):
+            get_shard_windows(FakeListFunction(), 'createdAt', 3)
+        with self.assertRaises(ValueError):
+            get_shard_windows(FakeListFunction(), 'updatedAt', 3, updatedAt__from='yesterday')
+
+    def test_fetch_shards(self):
+        outfile = io.StringIO()
+        writer = JsonStreamWriter(outfile)
+        windows = get_shard_windows(FakeListFunction(), 'updatedAt', 4)
+        count = fetch_shards(FakeListFunction(), 100, 2, windows, writer)
+        writer.close()
+        results = sorted(json.loads(outfile.getvalue()), key=lambda x: x.get('updatedAt'))
+        self.assertEqual(count, 10)
+        self.assertEqual(results, FakeListFunction().granules)
+
+    def test_fetch_shards_limit(self):
+        writer = JsonStreamWriter(io.StringIO(), json_lines=True)
+        count = fetch_shards(FakeListFunction(), 3, 2, get_shard_windows(FakeListFunction(), 'updatedAt', 4), writer)
+        self.assertEqual(count, 3)
+        self.assertEqual(len(writer.file.getvalue().splitlines()), 3)
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_streams_pages(self, gcapi):
+        gcapi.return_value.list_granules = FakeListFunction()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'granules.json')
+            main('list', 'granules', output=output, limit=5)
+            with open(output, 'r', encoding='utf-8') as outfile:
+                self.assertEqual(json.load(outfile), FakeListFunction().granules[:5])
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_sharded(self, gcapi):
+        gcapi.return_value.list_granules = FakeListFunction()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'granules.jsonl')
+            main('list', 'granules', output=output, output_format='jsonl', workers=3, limit=100)
+            with open(output, 'r', encoding='utf-8') as outfile:
+                self.assertEqual(len(outfile.readlines()), 10)
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_sharded_stdout_is_json(self, gcapi):
+        gcapi.return_value.list_granules = FakeListFunction()
+        with patch('sys.stdout', io.StringIO()) as stdout, patch('sys.stderr', io.StringIO()) as stderr:
+            main('list', 'granules', workers=2, limit=100)
+        results = sorted(json.loads(stdout.getvalue()), key=lambda x: x.get('updatedAt'))
+        self.assertEqual(results, FakeListFunction().granules)
+        self.assertIn('records fetched', stderr.getvalue())
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_resume(self, gcapi):
+        failing_function = FakeListFunction()
+        failing_function.calls = 0
+
+        def fail_on_third_page(**kwargs):
+            failing_function.calls += 1
+            if failing_function.calls == 3:
+                raise ConnectionError('Simulated failure')
+            return failing_function(**kwargs)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'granules.json')
+            gcapi.return_value.list_granules = fail_on_third_page
+            with self.assertRaises(ConnectionError):
+                main('list', 'granules', output=output, limit=100)
+            self.assertTrue(os.path.isfile(f'{output}.checkpoint'))
+
+            gcapi.return_value.list_granules = FakeListFunction()
+            main('list', 'granules', output=output, resume=True, limit=100)
+            with open(output, 'r', encoding='utf-8') as outfile:
+                self.assertEqual(json.load(outfile), FakeListFunction().granules)
+            self.assertFalse(os.path.isfile(f'{output}.checkpoint'))
+
+    @patch('pylot.plugins.cumulus_api.main.get_response_cache')
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_caches_read_actions(self, gcapi, mock_get_response_cache):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            mock_get_response_cache.return_value = ResponseCache(os.path.join(temp_dir, 'responses.sqlite'))
+            list_function = MagicMock(side_effect=FakeListFunction())
+            gcapi.return_value.list_granules = list_function
+            for _ in range(2):
+                output = os.path.join(temp_dir, 'granules.json')
+                main('list', 'granules', output=output, limit=4, cache=True)
+                with open(output, 'r', encoding='utf-8') as outfile:
+                    self.assertEqual(json.load(outfile), FakeListFunction().granules[:4])
+            self.assertEqual(list_function.call_count, 2)
+
+            gcapi.return_value.update_granule.return_value = {}
+            main('update', 'granule', data='{"granuleId": "a"}', cache=True)
+            self.assertEqual(mock_get_response_cache.call_count, 2)
+
+    def test_main_resume_requires_output(self):
+        with patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance'):
+            with self.assertRaises(ValueError):
+                main('list', 'granules', resume=True)
+
+    @patch('pylot.plugins.cumulus_api.main.get_cumulus_api_version', return_value='0.0.0')
+    @patch('pylot.plugins.cumulus_api.main.extract_action_target_args')
+    def test_load_action_target_args(self, mock_extract, mock_version):
+        mock_extract.return_value = {'public': {'function': ['data', 'not_data']}}
+        with tempfile.TemporaryDirectory() as cache_dir:
+            self.assertEqual(load_action_target_args(cache_dir), mock_extract.return_value)
+            self.assertEqual(load_action_target_args(cache_dir), mock_extract.return_value)
+            with open(os.path.join(cache_dir, 'cumulus_api_0.0.0.json'), 'r', encoding='utf-8') as cache_file:
+                self.assertEqual(json.load(cache_file), mock_extract.return_value)
+        mock_extract.assert_called_once()
+
 
 if __name__ == '__main__':
     pass
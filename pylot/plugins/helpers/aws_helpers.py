@@ -0,0 +1,69 @@
+import threading
+
+import boto3
+from botocore.config import Config
+
+from .telemetry_helpers import instrument_boto3_client
+
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+
+SESSIONS: dict = {}
+CLIENTS: dict = {}
+LOCK = threading.Lock()
+
+
+def get_session(region_name=None, profile_name=None):
+    """
+    Returns the boto3 session for a region and profile, creating it on first use. Sessions are shared by the whole
+    process so credentials and endpoint data are only resolved once.
+    :param region_name: AWS region. Uses the default region resolution if not provided.
+    :param profile_name: AWS profile. Uses the default credential chain if not provided.
+    """
+    key = (region_name, profile_name)
+    with LOCK:
+        if key not in SESSIONS:
+            SESSIONS[key] = boto3.session.Session(region_name=region_name, profile_name=profile_name)
+        return SESSIONS[key]
+
+
+def get_client(service_name, region_name=None, profile_name=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Returns a shared boto3 client. Clients are thread safe so one client per service, region and profile is reused by
+    every caller, keeping its HTTP connection pool warm. A cached client is replaced if a caller needs a larger
+    connection pool than it was created with, so the pool can match the thread pool that uses it.
+    :param service_name: AWS service such as s3 or lambda
+    :param region_name: AWS region
+    :param profile_name: AWS profile
+    :param max_pool_connections: minimum number of pooled HTTP connections the client should have
+    """
+    session = get_session(region_name, profile_name)
+    key = (service_name, region_name, profile_name)
+    with LOCK:
+        client, pool_size = CLIENTS.get(key, (None, 0))
+        if client is None or pool_size < max_pool_connections:
+            pool_size = max(pool_size, max_pool_connections)
+            client = instrument_boto3_client(
+                session.client(service_name, config=Config(max_pool_connections=pool_size))
+            )
+            CLIENTS[key] = (client, pool_size)
+        return client
+
+
+def get_resource(service_name, region_name=None, profile_name=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS):
+    """
+    Returns a new boto3 resource built on the shared session. Resources are not thread safe so they are not cached.
+    """
+    session = get_session(region_name, profile_name)
+    with LOCK:
+        resource = session.resource(service_name, config=Config(max_pool_connections=max_pool_connections))
+    instrument_boto3_client(resource.meta.client)
+    return resource
+
+
+def clear_clients():
+    """
+    Drops all cached sessions and clients, for example after credentials have been rotated.
+    """
+    with LOCK:
+        SESSIONS.clear()
+        CLIENTS.clear()
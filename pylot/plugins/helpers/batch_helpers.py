@@ -0,0 +1,86 @@
+import concurrent.futures
+import json
+import os
+import re
+import time
+
+from .aws_helpers import get_client
+
+
+def load_batch_queries(filename):
+    """
+    Reads a batch file of queries. The file is either a json object of the form {name: query} or a json list of
+    queries, in which case each query is named by its position in the list.
+    :param filename: the batch file
+    :return: list of (name, query) tuples
+    """
+    with open(filename, 'r', encoding='utf-8') as batch_file:
+        queries = json.load(batch_file)
+
+    if isinstance(queries, dict):
+        queries = list(queries.items())
+    elif isinstance(queries, list):
+        queries = [(f'query_{index}', query) for index, query in enumerate(queries)]
+    else:
+        raise ValueError(f'The batch file must contain a json object or list of queries: {filename}')
+
+    names = set()
+    for name, _ in queries:
+        if not re.fullmatch(r'[\w.-]+', name) or name in names:
+            raise ValueError(f'Query names must be unique and only contain letters, numbers, _, . and -: {name}')
+        names.add(name)
+
+    return queries
+
+
+def run_batch(queries, run_query, workers=8, transfer_concurrency=8, output_dir='batch_results',
+              manifest='manifest.json'):
+    """
+    Runs many lambda queries in one process. Queries are invoked concurrently on a bounded pool and share one lambda
+    client and one S3 client, each with enough pooled connections for every worker and its parallel download.
+    :param queries: list of (name, query) tuples
+    :param run_query: called as run_query(query, results) for each query where results is the output file for the
+    query. Returns the lambda response.
+    :param workers: number of queries run at once
+    :param transfer_concurrency: number of parts each worker downloads at once
+    :param output_dir: directory the output of each query and the manifest are written to
+    :param manifest: name of the summary manifest written to output_dir
+    :return: the manifest entries, one per query
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    get_client('lambda', max_pool_connections=workers)
+    get_client('s3', max_pool_connections=workers * transfer_concurrency)
+    start = time.monotonic()
+
+    def run_entry(name, query):
+        results = os.path.join(output_dir, f'{name}.json')
+        entry = {'name': name, 'query': query, 'file': results}
+        query_start = time.monotonic()
+        try:
+            rsp = run_query(json.dumps(query) if not isinstance(query, str) else query, results)
+            entry.update({'status': 'succeeded', 'response': rsp})
+        except Exception as exception:
+            entry.update({'status': 'failed', 'error': f'{type(exception).__name__}: {exception}', 'file': None})
+        entry.update({'elapsed': round(time.monotonic() - query_start, 3)})
+        return entry
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        entries = list(executor.map(lambda item: run_entry(*item), queries))
+
+    failed = sum(1 for entry in entries if entry.get('status') == 'failed')
+    summary = {
+        'queries': len(entries),
+        'succeeded': len(entries) - failed,
+        'failed': failed,
+        'elapsed': round(time.monotonic() - start, 3),
+        'results': entries
+    }
+    manifest_file = os.path.join(output_dir, manifest)
+    temp_file = f'{manifest_file}.tmp'
+    with open(temp_file, 'w+', encoding='utf-8') as outfile:
+        json.dump(summary, outfile, indent=2, default=str)
+    os.replace(temp_file, manifest_file)
+    print(f'{summary.get("succeeded")} of {len(entries)} queries succeeded in {summary.get("elapsed")}s. '
+          f'Manifest written to: {manifest_file}')
+
+    return entries
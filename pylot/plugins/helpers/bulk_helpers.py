@@ -0,0 +1,416 @@
+import concurrent.futures
+import json
+import math
+import queue
+import random
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+
+THROTTLED = 'throttled'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLE_MESSAGES = ('Too Many Requests', 'Throttl', 'Rate exceeded', 'SlowDown')
+# Bodies API Gateway returns without a statusCode, as {'message': ...}, and the status code they are sent with
+GATEWAY_ERROR_MESSAGES = {
+    'Forbidden': 403,
+    'Missing Authentication Token': 403,
+    'Endpoint request timed out': 504,
+    'Internal server error': 500,
+    'Bad Gateway': 502,
+    'Service Unavailable': 503,
+    'Gateway Timeout': 504
+}
+# Put on the queue of a pipeline stage once the previous stage has handed over all of its records
+PIPELINE_FINISHED = object()
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket used to cap the rate requests are sent at.
+    """
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens added per second
+        :param capacity: maximum burst size. Defaults to one second worth of tokens.
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter.
+    """
+    def __init__(self, max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class AdaptiveConcurrency:
+    """
+    Concurrency limit adjusted AIMD style: the limit is halved when requests are throttled and increased by one after
+    limit consecutive successes until it is back at its maximum.
+    """
+    def __init__(self, maximum, minimum=1, cooldown=1.0):
+        """
+        :param maximum: the starting and largest limit
+        :param minimum: the smallest limit
+        :param cooldown: minimum seconds between decreases so a burst of throttled requests only halves the limit once
+        """
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.limit = maximum
+        self.active = 0
+        self.successes = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+        with self.condition:
+            self.successes += 1
+            if self.limit < self.maximum and self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def on_throttle(self):
+        with self.condition:
+            self.successes = 0
+            now = time.monotonic()
+            if now - self.last_decrease >= self.cooldown and self.limit > self.minimum:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.last_decrease = now
+                print(f'Requests are being throttled, reducing concurrency to {self.limit}')
+
+
+def percentile(values, percent):
+    """
+    Nearest rank percentile.
+    :param values: sorted sequence of numbers
+    :param percent: percentile between 0 and 100
+    :return: the percentile or 0.0 if values is empty
+    """
+    if not values:
+        return 0.0
+    rank = max(1, math.ceil(percent / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+@dataclass
+class BulkResult:
+    succeeded: int = 0
+    failed: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    failures: list = field(default_factory=list)
+    latencies: array = field(default_factory=lambda: array('d'))
+
+    @property
+    def processed(self):
+        return self.succeeded + self.failed
+
+    @property
+    def throughput(self):
+        return self.processed / self.elapsed if self.elapsed else 0.0
+
+    def latency_percentiles(self, percents=(50, 95, 99)):
+        """
+        :return: dictionary of the form {percent: latency in seconds} over the latency of each record
+        """
+        latencies = sorted(self.latencies)
+        return {percent: percentile(latencies, percent) for percent in percents}
+
+    def add(self, record, error=None):
+        """
+        Counts the outcome of a record.
+        :param error: description of the error the record failed with, None if it succeeded
+        """
+        if error:
+            self.failed += 1
+            self.failures.append({'record': record, 'error': error})
+        else:
+            self.succeeded += 1
+
+    def summary(self):
+        latency = ', '.join(f'p{k} {v * 1000:.0f}ms' for k, v in self.latency_percentiles().items())
+        return f'{self.succeeded} succeeded, {self.failed} failed, {self.retries} retries in {self.elapsed:.1f}s ' \
+               f'({self.throughput:.1f} records/s, latency {latency})'
+
+
+def response_status_code(response):
+    """
+    :return: the statusCode of a Cumulus API response or, for API Gateway error bodies that only have a message, the
+    status code implied by the message. None if neither is present.
+    """
+    status_code = response.get('statusCode')
+    if status_code is not None:
+        return status_code
+    message = response.get('message')
+    if not isinstance(message, str):
+        return None
+    if any(throttle_message in message for throttle_message in THROTTLE_MESSAGES):
+        return 429
+
+    return GATEWAY_ERROR_MESSAGES.get(message.strip())
+
+
+def response_error(response):
+    """
+    Determines if a Cumulus API response describes an error.
+    :return: the error description or None if the response was successful
+    """
+    if isinstance(response, dict):
+        status_code = response_status_code(response)
+        if isinstance(status_code, int) and status_code >= 400:
+            return f'{status_code} {response.get("error", "")}: {response.get("message", "")}'.strip()
+        if isinstance(response.get('error'), str):
+            return f'{response.get("error")}: {response.get("message", "")}'
+
+    return None
+
+
+def classify_error(response=None, exception=None):
+    """
+    Classifies the outcome of a Cumulus API call.
+    :param response: the response returned by the call
+    :param exception: the exception raised by the call, if any
+    :return: None for a successful call, otherwise THROTTLED, RETRYABLE or FATAL
+    """
+    if exception is not None:
+        if any(message in str(exception) for message in THROTTLE_MESSAGES):
+            return THROTTLED
+        # Connection errors and timeouts, including those raised by requests, are OSErrors
+        return RETRYABLE if isinstance(exception, OSError) else FATAL
+
+    error = response_error(response)
+    if not error:
+        return None
+    status_code = response_status_code(response)
+    if status_code == 429 or any(message in error for message in THROTTLE_MESSAGES):
+        return THROTTLED
+    if status_code in RETRYABLE_STATUS_CODES or (isinstance(status_code, int) and status_code >= 500):
+        return RETRYABLE
+
+    return FATAL
+
+
+def write_replay_file(filename, failures):
+    """
+    Writes the records of failed operations to a json file that can be passed back to PyLOT with --replay.
+    :param filename: the replay file
+    :param failures: BulkResult failures
+    :return: number of records written
+    """
+    records = []
+    seen = set()
+    for failure in failures:
+        record = failure.get('record')
+        key = json.dumps(record, sort_keys=True)
+        if key not in seen:
+            seen.add(key)
+            records.append(record)
+
+    with open(filename, 'w+', encoding='utf-8') as replay_file:
+        json.dump(records, replay_file, indent=2, sort_keys=True)
+
+    return len(records)
+
+
+class BulkExecutor:
+    """
+    Runs a function over a large number of records on a bounded thread pool. Records are consumed lazily so only
+    max_in_flight records are ever submitted at once, an optional token bucket caps the request rate, and responses are
+    aggregated into success and failure counters rather than printed. Retryable failures are retried with backoff and
+    throttling reduces the number of concurrent requests until the API recovers.
+    """
+    def __init__(self, concurrency=10, rate_limit=None, max_in_flight=None, progress_interval=1000, retry_policy=None):
+        """
+        :param concurrency: maximum number of concurrent requests
+        :param rate_limit: maximum requests per second, or a TokenBucket shared with other executors. No limit if not
+        provided.
+        :param max_in_flight: maximum number of submitted but unfinished records. Defaults to twice the concurrency.
+        :param progress_interval: print progress every progress_interval processed records
+        :param retry_policy: RetryPolicy for throttled and retryable failures. Failures are not retried if not provided.
+        """
+        self.concurrency = concurrency
+        if isinstance(rate_limit, TokenBucket):
+            self.rate_limiter = rate_limit
+        else:
+            self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.max_in_flight = max_in_flight or concurrency * 2
+        self.progress_interval = progress_interval
+        self.retry_policy = retry_policy
+        self.adaptive_concurrency = AdaptiveConcurrency(concurrency)
+        self.lock = threading.Lock()
+
+    def call(self, function, record, result=None):
+        """
+        Calls function with record, retrying throttled and retryable failures according to the retry policy.
+        :param result: BulkResult to count retries in
+        :return: the response of the last attempt
+        """
+        attempt = 0
+        while True:
+            self.adaptive_concurrency.acquire()
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            response = None
+            exception = None
+            try:
+                response = function(record)
+            except Exception as error:
+                exception = error
+            finally:
+                self.adaptive_concurrency.release()
+
+            outcome = classify_error(response, exception)
+            if outcome is None:
+                self.adaptive_concurrency.on_success()
+                return response
+            if outcome == THROTTLED:
+                self.adaptive_concurrency.on_throttle()
+            if outcome == FATAL or not self.retry_policy or attempt >= self.retry_policy.max_retries:
+                if exception is not None:
+                    raise exception
+                return response
+
+            time.sleep(self.retry_policy.delay(attempt))
+            attempt += 1
+            if result is not None:
+                with self.lock:
+                    result.retries += 1
+
+    def run(self, function, records, on_success=None):
+        """
+        :param function: called once per record with the record as the only argument
+        :param records: iterable of records
+        :param on_success: optional callback called with each record that was processed successfully. A record is
+        counted as failed if on_success raises for it.
+        :return: BulkResult
+        """
+        result = BulkResult()
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+        start = time.monotonic()
+
+        def timed_call(record):
+            call_start = time.monotonic()
+            try:
+                return self.call(function, record, result)
+            finally:
+                with lock:
+                    result.latencies.append(time.monotonic() - call_start)
+
+        def record_done(record, future):
+            try:
+                error = response_error(future.result())
+                if not error and on_success:
+                    on_success(record)
+            except Exception as exception:
+                error = f'{type(exception).__name__}: {exception}'
+            try:
+                with lock:
+                    result.add(record, error)
+                    if self.progress_interval and result.processed % self.progress_interval == 0:
+                        print(f'{result.processed} records processed: {result.succeeded} succeeded, '
+                              f'{result.failed} failed')
+            finally:
+                # Always free the slot, the loop submitting records waits on it
+                slots.release()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for record in records:
+                slots.acquire()
+                future = executor.submit(timed_call, record)
+                future.add_done_callback(lambda done, submitted=record: record_done(submitted, done))
+
+        result.elapsed = time.monotonic() - start
+        return result
+
+
+def queued_records(stage_queue):
+    """
+    Yields the records put on the queue of a pipeline stage until the previous stage puts PIPELINE_FINISHED.
+    """
+    while True:
+        record = stage_queue.get()
+        if record is PIPELINE_FINISHED:
+            return
+        yield record
+
+
+def run_pipeline(stages, records):
+    """
+    Streams records through a sequence of stages. Each stage runs on its own BulkExecutor and a record is handed to the
+    next stage as soon as the previous stage succeeds for it, so the stages overlap instead of waiting on each other.
+    Records that fail a stage do not continue to the following stages.
+    :param stages: list of (name, function, BulkExecutor) tuples
+    :param records: iterable of records
+    :return: list of (name, BulkResult) tuples, one per stage
+    """
+    results = [BulkResult() for _ in stages]
+    errors = []
+    queues = [queue.Queue(maxsize=executor.max_in_flight) for _, _, executor in stages]
+
+    def run_stage(index):
+        _, function, executor = stages[index]
+        source = records if index == 0 else queued_records(queues[index])
+        next_queue = queues[index + 1] if index + 1 < len(stages) else None
+        try:
+            results[index] = executor.run(function, source, next_queue.put if next_queue else None)
+        except Exception as exception:
+            errors.append(exception)
+            if index:
+                # Keep consuming so the previous stage is not blocked on a full queue
+                for _ in queued_records(queues[index]):
+                    pass
+        finally:
+            if next_queue:
+                next_queue.put(PIPELINE_FINISHED)
+
+    threads = [threading.Thread(target=run_stage, args=(index,), daemon=True) for index in range(len(stages))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    return [(name, result) for (name, _, _), result in zip(stages, results)]
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from tempfile import gettempdir
+
+from .bulk_helpers import response_error
+from .s3_helpers import get_s3_etag
+
+DEFAULT_TTL = 300
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+READ_ACTIONS = ('list', 'get')
+# Environment variables that select the deployment a request is sent to: the Cumulus API endpoint, the lambdas and the
+# AWS account and region
+DEPLOYMENT_VARIABLES = (
+    'INVOKE_BASE_URL', 'OPENSEARCH_LAMBDA_ARN', 'RDS_LAMBDA_ARN', 'AWS_PROFILE', 'AWS_REGION', 'AWS_DEFAULT_REGION'
+)
+
+
+def cache_key(plugin, function_name, args=(), kwargs=None):
+    """
+    :return: hash of the plugin, function and its arguments with the kwargs normalized by key order, and of the
+    deployment the request is sent to so responses are never shared between deployments
+    """
+    deployment = {name: os.getenv(name) for name in DEPLOYMENT_VARIABLES}
+    normalized = json.dumps(
+        [plugin, function_name, list(args), kwargs or {}, deployment], sort_keys=True, default=str
+    )
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+
+def results_object(response):
+    """
+    :return: tuple of the bucket and key of the S3 object a lambda response points to, or None for other responses
+    """
+    if isinstance(response, dict) and response.get('bucket') and response.get('key'):
+        return response.get('bucket'), response.get('key')
+    return None
+
+
+class ResponseCache:
+    """
+    SQLite backed cache of read only API and lambda responses. Entries older than ttl seconds are never returned and
+    the least recently used entries are evicted once the cache grows past max_bytes. The database is shared by every
+    PyLOT process on a host.
+    """
+    def __init__(self, path=None, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, refresh=False):
+        """
+        :param path: location of the database. Defaults to <tmp>/pylot_cache/responses.sqlite
+        :param ttl: seconds a response stays valid
+        :param max_bytes: size the cached responses are kept under
+        :param refresh: ignore cached responses but still store new ones
+        """
+        self.path = path or os.path.join(gettempdir(), 'pylot_cache', 'responses.sqlite')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        # Cached responses hold Cumulus records, so the directory and database are only accessible to their owner.
+        # SQLite creates its WAL and shared memory files with the permissions of the database.
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+        os.chmod(self.path, 0o600)
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, plugin TEXT, function TEXT, value TEXT, '
+            'size INTEGER, created REAL, accessed REAL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(responses)')]
+        if 'etag' not in columns:
+            self.connection.execute('ALTER TABLE responses ADD COLUMN etag TEXT')
+
+    def get_entry(self, key):
+        """
+        :return: tuple of the cached response and the ETag stored with it, or None if there is no valid entry
+        """
+        if self.refresh:
+            return None
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT value, etag FROM responses WHERE key = ? AND created > ?', (key, now - self.ttl)
+            ).fetchone()
+            if row:
+                self.connection.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def get(self, key):
+        """
+        :return: the cached response or None if there is no valid entry
+        """
+        entry = self.get_entry(key)
+        return entry[0] if entry else None
+
+    def set(self, key, value, plugin='', function_name='', etag=None):
+        """
+        :param etag: ETag of the S3 object the response points to, if any
+        """
+        serialized = json.dumps(value, default=str)
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, plugin, function, value, size, created, accessed, etag) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, plugin, function_name, serialized, len(serialized), now, now, etag)
+            )
+            self.evict(now)
+
+    def evict(self, now=None):
+        """
+        Deletes expired entries, then the least recently used entries until the cache is under max_bytes.
+        """
+        now = now or time.time()
+        self.connection.execute('DELETE FROM responses WHERE created <= ?', (now - self.ttl,))
+        total = 0
+        evicted = []
+        for key, size in self.connection.execute('SELECT key, size FROM responses ORDER BY accessed DESC'):
+            total += size
+            if total > self.max_bytes:
+                evicted.append((key,))
+        self.connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+
+    def call(self, plugin, function_name, function, *args, **kwargs):
+        """
+        Returns the cached response of function(*args, **kwargs), calling it if there is no valid entry. Error
+        responses are never cached. Lambda responses that point to a results object in S3 are stored with the
+        object's ETag and only reused while the object still has that ETag.
+        """
+        key = cache_key(plugin, function_name, args, kwargs)
+        entry = self.get_entry(key)
+        if entry is not None:
+            response, etag = entry
+            location = results_object(response)
+            if not location or get_s3_etag(*location) == etag:
+                print(f'Using cached {function_name} response', file=sys.stderr)
+                return response
+            print(f'Ignoring cached {function_name} response, its S3 results object has changed', file=sys.stderr)
+        response = function(*args, **kwargs)
+        if response is None or response_error(response):
+            return response
+        location = results_object(response)
+        etag = get_s3_etag(*location) if location else None
+        if not location or etag:
+            self.set(key, response, plugin, function_name, etag)
+
+        return response
+
+    def cached(self, plugin, function_name, function):
+        """
+        :return: function wrapped so its responses are read from and stored in the cache
+        """
+        def cached_function(*args, **kwargs):
+            return self.call(plugin, function_name, function, *args, **kwargs)
+
+        return cached_function
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def get_response_cache(cache=False, no_cache=False, refresh=False, cache_ttl=None, **kwargs):
+    """
+    Creates the response cache from the commandline options added by add_cache_arguments. The cache is opt in: it is
+    used when --cache is passed or the PYLOT_CACHE_TTL environment variable is set, and never with --no-cache.
+    --refresh only has an effect when the cache is used.
+    :return: ResponseCache or None if caching is disabled
+    """
+    env_ttl = os.getenv('PYLOT_CACHE_TTL')
+    if no_cache or not (cache or env_ttl):
+        return None
+
+    return ResponseCache(ttl=float(cache_ttl or env_ttl or DEFAULT_TTL), refresh=refresh)
+
+
+def add_cache_arguments(parser):
+    """
+    Adds the response cache options to a plugin's parser.
+    """
+    parser.add_argument(
+        '--cache', action='store_true',
+        help='Cache read only responses on disk and reuse them for repeated identical requests. Also enabled by '
+             'setting the PYLOT_CACHE_TTL environment variable.'
+    )
+    parser.add_argument(
+        '--cache-ttl', metavar='', type=float, default=None,
+        help=f'Seconds a cached response is reused for. Default is PYLOT_CACHE_TTL or {DEFAULT_TTL}.'
+    )
+    parser.add_argument(
+        '--refresh', action='store_true',
+        help='Ignore cached responses for this request and replace them with fresh ones. Requires --cache or '
+             'PYLOT_CACHE_TTL.'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Do not read or write the response cache, even if PYLOT_CACHE_TTL is set.'
+    )
@@ -0,0 +1,40 @@
+import json
+import os
+from json import JSONDecodeError
+
+
+class Checkpoint:
+    """
+    Small json state file used to resume long running operations. The file is replaced atomically on every save so an
+    interrupted run always leaves the last complete state behind.
+    """
+    def __init__(self, path, **fields):
+        """
+        :param path: location of the checkpoint file
+        :param fields: values stored with every save, such as the function being checkpointed
+        """
+        self.path = path
+        self.fields = fields
+
+    def load(self):
+        """
+        :return: the saved state or an empty dictionary if there is no checkpoint
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as checkpoint_file:
+                return json.load(checkpoint_file)
+        except JSONDecodeError:
+            print(f'Ignoring unreadable checkpoint: {self.path}')
+            return {}
+
+    def save(self, state):
+        temp_file = f'{self.path}.tmp'
+        with open(temp_file, 'w+', encoding='utf-8') as checkpoint_file:
+            json.dump({**self.fields, **state}, checkpoint_file)
+        os.replace(temp_file, self.path)
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
@@ -1,6 +1,15 @@
+import concurrent.futures
+import csv
+import gzip
+import io
+import json
+import threading
 from dataclasses import dataclass
+from urllib.parse import unquote_plus
 
-import boto3
+from .aws_helpers import get_client
+
+DEFAULT_WORKERS = 16
 
 
 @dataclass
@@ -20,8 +29,155 @@ class GetStatusHelpers:
         :return:
         :rtype:
         """
-        boto3.setup_default_session(profile_name=aws_profile,  region_name=region_name)
-        s3_resource = boto3.resource('s3')
-        bucket = s3_resource.Bucket(name=bucket_name)
-        prefix = f"{prefix.rstrip('/')}/"
-        return sum(1 for _ in bucket.objects.filter(Prefix=prefix).all())
+        stats = GetStatusHelpers.get_s3_prefix_stats(
+            bucket_name, prefix, region_name=region_name, aws_profile=aws_profile
+        )
+        return sum(value.get('count') for value in stats.values())
+
+    @staticmethod
+    def iter_list_pages(s3_client, bucket_name, prefix, delimiter=None):
+        """
+        Generator of raw list_objects_v2 responses, without building resource objects.
+        """
+        kwargs = {'Bucket': bucket_name, 'Prefix': prefix}
+        if delimiter:
+            kwargs.update({'Delimiter': delimiter})
+        while True:
+            rsp = s3_client.list_objects_v2(**kwargs)
+            yield rsp
+            if not rsp.get('IsTruncated'):
+                break
+            kwargs.update({'ContinuationToken': rsp.get('NextContinuationToken')})
+
+    @staticmethod
+    def list_objects(s3_client, bucket_name, prefix, delimiter=None):
+        """
+        Counts the objects under a prefix.
+        :return: tuple of (object count, total bytes, list of common prefixes)
+        """
+        count = 0
+        size = 0
+        common_prefixes = []
+        for rsp in GetStatusHelpers.iter_list_pages(s3_client, bucket_name, prefix, delimiter):
+            for s3_object in rsp.get('Contents', []):
+                count += 1
+                size += s3_object.get('Size', 0)
+            common_prefixes.extend(common_prefix.get('Prefix') for common_prefix in rsp.get('CommonPrefixes', []))
+
+        return count, size, common_prefixes
+
+    @staticmethod
+    def get_s3_prefix_stats(bucket_name, prefix, region_name="us-west-2", aws_profile=None, workers=DEFAULT_WORKERS,
+                            max_depth=3, inventory_manifest=None, s3_client=None):
+        """
+        Counts the objects and bytes under each sub-prefix of a prefix. Sub-prefixes are discovered with delimiter
+        listings, descending up to max_depth levels until there is enough work to keep every worker busy, and the
+        resulting prefixes are listed in parallel. Objects directly under the prefix are reported under the prefix.
+        :param bucket_name: S3 bucket
+        :param prefix: prefix to count
+        :param region_name: AWS region
+        :param aws_profile: AWS profile
+        :param workers: number of concurrent listings
+        :param max_depth: maximum number of prefix levels discovered before counting
+        :param inventory_manifest: s3://bucket/key of an S3 Inventory manifest.json. When provided the counts are read
+        from the inventory instead of listing the bucket.
+        :param s3_client: boto3 S3 client
+        :return: dictionary of the form {sub_prefix: {'count': objects, 'bytes': total size}}
+        """
+        if not s3_client:
+            s3_client = get_client('s3', region_name=region_name, profile_name=aws_profile,
+                                   max_pool_connections=workers)
+        prefix = f"{prefix.rstrip('/')}/" if prefix else ''
+        if inventory_manifest:
+            manifest_bucket, manifest_key = inventory_manifest.replace('s3://', '', 1).split('/', maxsplit=1)
+            return GetStatusHelpers.get_s3_inventory_stats(
+                manifest_bucket, manifest_key, prefix, workers=workers, s3_client=s3_client, bucket_name=bucket_name
+            )
+
+        stats: dict = {}
+        lock = threading.Lock()
+
+        def add_stats(group, count, size):
+            with lock:
+                group_stats = stats.setdefault(group, {'count': 0, 'bytes': 0})
+                group_stats['count'] += count
+                group_stats['bytes'] += size
+
+        def discover(group, sub_prefix):
+            count, size, common_prefixes = GetStatusHelpers.list_objects(s3_client, bucket_name, sub_prefix, '/')
+            add_stats(group, count, size)
+            # Counts are grouped by the first level of sub-prefixes below the prefix
+            return [(common_prefix if group == prefix else group, common_prefix) for common_prefix in common_prefixes]
+
+        def count_prefix(group, sub_prefix):
+            count, size, _ = GetStatusHelpers.list_objects(s3_client, bucket_name, sub_prefix)
+            add_stats(group, count, size)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = discover(prefix, prefix)
+            depth = 1
+            while pending and len(pending) < workers and depth < max_depth:
+                levels = executor.map(lambda item: discover(*item), pending)
+                pending = [item for level in levels for item in level]
+                depth += 1
+            for future in [executor.submit(count_prefix, *item) for item in pending]:
+                future.result()
+
+        if stats.get(prefix) == {'count': 0, 'bytes': 0} and len(stats) > 1:
+            stats.pop(prefix)
+        return stats
+
+    @staticmethod
+    def get_s3_inventory_stats(manifest_bucket, manifest_key, prefix, workers=DEFAULT_WORKERS, s3_client=None,
+                               bucket_name=None):
+        """
+        Counts objects and bytes per sub-prefix from an S3 Inventory report instead of listing the bucket. Only CSV
+        inventories are supported.
+        :param manifest_bucket: bucket the inventory is delivered to
+        :param manifest_key: key of the inventory manifest.json
+        :param prefix: prefix to count
+        :param workers: number of inventory files read at once
+        :param s3_client: boto3 S3 client
+        :param bucket_name: bucket being counted. The inventory must be a report of this bucket.
+        :return: dictionary of the form {sub_prefix: {'count': objects, 'bytes': total size}}
+        """
+        if not s3_client:
+            s3_client = get_client('s3', max_pool_connections=workers)
+        rsp = s3_client.get_object(Bucket=manifest_bucket, Key=manifest_key)
+        manifest = json.loads(rsp.get('Body').read())
+        if manifest.get('fileFormat', '').upper() != 'CSV':
+            raise ValueError(f'Unsupported inventory format {manifest.get("fileFormat")}. Only CSV is supported.')
+        if bucket_name and manifest.get('sourceBucket') != bucket_name:
+            raise ValueError(f'Inventory s3://{manifest_bucket}/{manifest_key} is a report of '
+                             f'{manifest.get("sourceBucket")} not {bucket_name}')
+
+        columns = [column.strip() for column in manifest.get('fileSchema').split(',')]
+        destination_bucket = manifest.get('destinationBucket', '').replace('arn:aws:s3:::', '') or manifest_bucket
+
+        def read_inventory_file(inventory_file):
+            file_stats: dict = {}
+            body = s3_client.get_object(Bucket=destination_bucket, Key=inventory_file.get('key')).get('Body')
+            with gzip.GzipFile(fileobj=body) as gzip_file:
+                for row in csv.reader(io.TextIOWrapper(gzip_file, encoding='utf-8')):
+                    record = dict(zip(columns, row))
+                    if record.get('IsLatest', 'true') != 'true' or record.get('IsDeleteMarker', 'false') == 'true':
+                        continue
+                    key = unquote_plus(record.get('Key'))
+                    if not key.startswith(prefix):
+                        continue
+                    sub_prefix, separator, _ = key[len(prefix):].partition('/')
+                    group = f'{prefix}{sub_prefix}/' if separator else prefix
+                    group_stats = file_stats.setdefault(group, {'count': 0, 'bytes': 0})
+                    group_stats['count'] += 1
+                    group_stats['bytes'] += int(record.get('Size') or 0)
+            return file_stats
+
+        stats: dict = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for file_stats in executor.map(read_inventory_file, manifest.get('files', [])):
+                for group, group_stats in file_stats.items():
+                    total = stats.setdefault(group, {'count': 0, 'bytes': 0})
+                    total['count'] += group_stats.get('count')
+                    total['bytes'] += group_stats.get('bytes')
+
+        return stats
@@ -0,0 +1,115 @@
+import copy
+
+# Marks an empty dictionary in the update, which only makes sure the key holds a dictionary
+EMPTY_DICT = object()
+MISSING = object()
+
+
+def same_value(current, value):
+    # True == 1 in python, but changing a boolean field to an integer is still a change
+    return type(current) is type(value) and current == value
+
+
+class PatchPlan:
+    """
+    An update document compiled once into the list of leaf assignments it makes, so applying it to a record is a flat
+    loop instead of a recursive walk of the update on every record. Applying the plan deep merges the update into the
+    record: nested dictionaries are merged key by key, existing nested fields that the update does not mention are
+    kept, and any other value in the update replaces the record's value.
+    """
+    def __init__(self, update_dict, string_fields=()):
+        """
+        :param update_dict: the update to apply
+        :param string_fields: fields converted to strings when present in a record and not already a string
+        """
+        self.top_level = {}
+        self.nested = []
+        self.mutable = []
+        self.string_fields = tuple(string_fields)
+        self.compile(update_dict, ())
+
+    def compile(self, update_dict, parents):
+        for key, value in update_dict.items():
+            if isinstance(value, dict):
+                if not value:
+                    self.nested.append((parents, key, EMPTY_DICT))
+                self.compile(value, parents + (key,))
+            elif isinstance(value, list):
+                # Lists are copied per record so records never share a mutable value
+                self.mutable.append((parents, key, value))
+            elif parents:
+                self.nested.append((parents, key, value))
+            else:
+                self.top_level[key] = value
+
+    @staticmethod
+    def resolve(record, parents):
+        target = record
+        for parent in parents:
+            child = target.get(parent)
+            if not isinstance(child, dict):
+                child = target[parent] = {}
+            target = child
+        return target
+
+    def apply(self, record):
+        """
+        Applies the plan to a record in place.
+        :return: the record
+        """
+        record.update(self.top_level)
+        for parents, key, value in self.nested:
+            target = self.resolve(record, parents)
+            if value is not EMPTY_DICT:
+                target[key] = value
+            elif not isinstance(target.get(key), dict):
+                target[key] = {}
+        for parents, key, value in self.mutable:
+            self.resolve(record, parents)[key] = copy.deepcopy(value)
+        for field in self.string_fields:
+            value = record.get(field)
+            if field in record and not isinstance(value, str):
+                record[field] = str(value)
+
+        return record
+
+    def changed_fields(self, record):
+        """
+        Determines which top level fields of a record applying the plan would change, without modifying the record.
+        :return: list of top level field names, empty if the plan is a no-op for the record
+        """
+        changed = {key: None for key, value in self.top_level.items() if not same_value(record.get(key, MISSING), value)}
+        for parents, key, value in self.nested + self.mutable:
+            field = parents[0] if parents else key
+            if field in changed:
+                continue
+            target = record
+            for parent in parents:
+                target = target.get(parent) if isinstance(target, dict) else None
+            current = target.get(key, MISSING) if isinstance(target, dict) else MISSING
+            if value is EMPTY_DICT:
+                differs = not isinstance(current, dict)
+            else:
+                differs = not same_value(current, value)
+            if differs:
+                changed[field] = None
+
+        return list(changed)
+
+    def diff(self, record):
+        """
+        Builds the fields of a record that applying the plan would change, merged with their existing nested values.
+        The record is not modified.
+        :return: dictionary of the changed top level fields and their updated values, empty if nothing would change
+        """
+        changed = self.changed_fields(record)
+        patched = self.apply({key: copy.deepcopy(record[key]) for key in changed if key in record})
+        return {key: patched[key] for key in changed}
+
+    def stream(self, records):
+        """
+        Generator that applies the plan to each record as it is consumed.
+        """
+        apply = self.apply
+        for record in records:
+            yield apply(record)
@@ -0,0 +1,102 @@
+import json
+import os
+import statistics
+import threading
+import time
+from json import JSONDecodeError
+from tempfile import gettempdir
+
+DEFAULT_SAMPLES = 20
+
+
+def format_duration(seconds):
+    """
+    :return: seconds formatted as 1h 2m 3s
+    """
+    seconds = int(round(seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    parts = [f'{hours}h' if hours else '', f'{minutes}m' if minutes or hours else '', f'{seconds}s']
+    return ' '.join(part for part in parts if part)
+
+
+class ThroughputHistory:
+    """
+    Json file of the throughput bulk operations achieved on previous runs, used to estimate how long an operation will
+    take before it is run. Only the last samples runs of each operation are kept and the file is replaced atomically so
+    concurrent PyLOT processes never leave a partial file behind.
+    """
+    def __init__(self, path=None, samples=DEFAULT_SAMPLES):
+        """
+        :param path: location of the history file. Defaults to <tmp>/pylot_cache/throughput.json
+        :param samples: number of runs kept per operation
+        """
+        self.path = path or os.path.join(gettempdir(), 'pylot_cache', 'throughput.json')
+        self.samples = samples
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        :return: dictionary of the form {operation: [{'records', 'elapsed', 'throughput', 'bytes', 'recorded'}]}
+        """
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as history_file:
+                return json.load(history_file)
+        except (JSONDecodeError, OSError):
+            print(f'Ignoring unreadable throughput history: {self.path}')
+            return {}
+
+    def record(self, operation, records, elapsed, transferred_bytes=0):
+        """
+        Adds a run of an operation to the history. Runs that processed nothing are ignored.
+        :param operation: name of the operation, such as update_granule
+        :param records: number of records processed
+        :param elapsed: seconds the run took
+        :param transferred_bytes: number of bytes transferred by the run
+        """
+        if not records or elapsed <= 0:
+            return
+        with self.lock:
+            history = self.load()
+            runs = history.setdefault(operation, [])
+            runs.append({
+                'records': records, 'elapsed': round(elapsed, 3), 'throughput': records / elapsed,
+                'bytes': transferred_bytes, 'recorded': int(time.time())
+            })
+            history[operation] = runs[-self.samples:]
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            temp_file = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_file, 'w+', encoding='utf-8') as history_file:
+                json.dump(history, history_file)
+            os.replace(temp_file, self.path)
+
+    def throughput(self, operation):
+        """
+        :return: tuple of the median records per second over the recorded runs of operation and the number of runs,
+        or (None, 0) if the operation has never been recorded
+        """
+        runs = self.load().get(operation, [])
+        if not runs:
+            return None, 0
+        return statistics.median(run.get('throughput') for run in runs), len(runs)
+
+    def bytes_per_record(self, operation):
+        """
+        :return: the median bytes transferred per record over the recorded runs of operation, or None if no run
+        transferred any bytes
+        """
+        runs = [run for run in self.load().get(operation, []) if run.get('bytes')]
+        if not runs:
+            return None
+        return statistics.median(run.get('bytes') / run.get('records') for run in runs)
+
+    def estimate(self, operation, records):
+        """
+        :return: a description of the time operation is expected to take for records
+        """
+        throughput, runs = self.throughput(operation)
+        if not throughput:
+            return f'unknown, no recorded {operation} runs yet'
+        return f'{format_duration(records / throughput)} at {throughput:.1f} records/s (median of {runs} runs)'
@@ -1,11 +1,14 @@
 import json
 import os
 import pathlib
-from time import time
 from dataclasses import dataclass
-from tempfile import gettempdir
 
 from cumulus_api import CumulusApi
+from .telemetry_helpers import InstrumentedProxy
+from .token_helpers import TokenCache, TokenRefresher
+
+TOKEN_CACHE = TokenCache()
+TOKEN_REFRESHER = TokenRefresher(TOKEN_CACHE, lambda: CumulusApi().TOKEN)
 
 
 @dataclass
@@ -20,20 +23,24 @@ class PyLOTHelpers:
 
     @classmethod
     def get_cumulus_api_instance(cls):
-        token_dir = f'{gettempdir()}/pylot_token/'
-        os.makedirs(token_dir, exist_ok=True)
-        token_file = f'{token_dir}token'
-        token = None
-        if os.path.isfile(token_file):
-            print(f'Using local token: {token_file}')
-            file_stat = os.stat(token_file)
-            if int(time()) - int(file_stat.st_mtime) < 3600:
-                with open(token_file, 'r', encoding='utf-8') as _file:
-                    token = _file.readline()
-
-        cml = CumulusApi(token=token)
-        if not token and cml.TOKEN:
-            with open(token_file, 'w+', encoding='utf-8') as _file:
-                _file.write(cml.TOKEN)
-
-        return cml
+        """
+        Creates a CumulusApi instance using the token cached by any PyLOT process on this host, generating a new token
+        if the cached one is missing or about to expire. The token is renewed in the background before it expires.
+        Calls made through the instance are recorded by the telemetry layer.
+        """
+        generated = []
+
+        def generate_token():
+            generated.append(CumulusApi())
+            return generated[-1].TOKEN
+
+        entry = TOKEN_CACHE.get_token(generate_token)
+        if generated:
+            cml = generated[-1]
+        else:
+            print(f'Using local token: {TOKEN_CACHE.path}')
+            cml = CumulusApi(token=entry.get('token'))
+        if entry.get('token'):
+            TOKEN_REFRESHER.register(cml, entry.get('expires'))
+
+        return InstrumentedProxy(cml, 'cumulus_api')
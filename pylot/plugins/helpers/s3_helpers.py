@@ -0,0 +1,159 @@
+import concurrent.futures
+import shutil
+import time
+from collections import deque
+
+from botocore.exceptions import ClientError
+
+from .aws_helpers import get_client
+from .bulk_helpers import RetryPolicy
+
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+
+
+class S3RangeReader:
+    """
+    Read only file like object over an S3 object. The object is fetched with ranged GETs, concurrency parts at a time
+    ahead of the reader, so large objects can be consumed as a stream without being written to disk and with at most
+    concurrency * part_size bytes held in memory.
+    """
+    def __init__(self, bucket, key, s3_client, size, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+        self.bucket = bucket
+        self.key = key
+        self.s3_client = s3_client
+        self.size = size
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+        self.parts: deque = deque()
+        self.next_offset = 0
+        # Bytes fetched but not read yet start at position, so reads never copy the rest of the buffer
+        self.buffer = bytearray()
+        self.position = 0
+
+    def fetch_part(self, start, end):
+        rsp = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f'bytes={start}-{end}')
+        return rsp.get('Body').read()
+
+    def schedule_parts(self):
+        while len(self.parts) < self.concurrency and self.next_offset < self.size:
+            end = min(self.next_offset + self.part_size, self.size) - 1
+            self.parts.append(self.executor.submit(self.fetch_part, self.next_offset, end))
+            self.next_offset = end + 1
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and (self.parts or self.next_offset < self.size):
+            self.schedule_parts()
+            # Bytes already read are dropped once per part rather than on every read
+            del self.buffer[:self.position]
+            self.position = 0
+            self.buffer += self.parts.popleft().result()
+            self.schedule_parts()
+
+        end = len(self.buffer) if size < 0 else min(self.position + size, len(self.buffer))
+        data = bytes(self.buffer[self.position:end])
+        self.position = end
+        return data
+
+    def close(self):
+        for part in self.parts:
+            part.cancel()
+        self.executor.shutdown(wait=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_s3_object(bucket, key, s3_client=None, part_size=DEFAULT_PART_SIZE, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Opens an S3 object for streaming reads. Objects larger than part_size are read with parallel ranged GETs.
+    :return: file like object with read and close methods
+    """
+    if not s3_client:
+        s3_client = get_client('s3', max_pool_connections=concurrency)
+    size = s3_client.head_object(Bucket=bucket, Key=key).get('ContentLength', 0)
+    if size <= part_size:
+        return s3_client.get_object(Bucket=bucket, Key=key).get('Body')
+
+    return S3RangeReader(bucket, key, s3_client, size, part_size, concurrency)
+
+
+def get_s3_etag(bucket, key, s3_client=None):
+    """
+    :return: the ETag of an S3 object or None if the object does not exist
+    """
+    if not s3_client:
+        s3_client = get_client('s3')
+    try:
+        return s3_client.head_object(Bucket=bucket, Key=key).get('ETag')
+    except ClientError as error:
+        if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+            return None
+        raise
+
+
+def copy_s3_object(bucket, key, destination, s3_client=None):
+    """
+    Streams an S3 object into a binary file object such as sys.stdout.buffer.
+    """
+    source = open_s3_object(bucket, key, s3_client)
+    try:
+        shutil.copyfileobj(source, destination, DEFAULT_PART_SIZE)
+    finally:
+        source.close()
+    destination.flush()
+
+
+def download_s3_object(bucket, key, filename, s3_client=None, part_size=DEFAULT_PART_SIZE,
+                       concurrency=DEFAULT_CONCURRENCY, max_retries=5):
+    """
+    Downloads an S3 object with concurrent ranged GETs written directly into their place in the local file. Each part
+    is retried on its own with jittered exponential backoff so one failed range does not restart the whole download.
+    :param bucket: S3 bucket
+    :param key: S3 key
+    :param filename: local file to write
+    :param s3_client: boto3 S3 client
+    :param part_size: bytes per ranged GET
+    :param concurrency: number of parts downloaded at once
+    :param max_retries: number of times each part is retried
+    :return: dictionary with the bytes transferred, elapsed seconds, throughput in MiB/s and number of part retries
+    """
+    if not s3_client:
+        s3_client = get_client('s3', max_pool_connections=concurrency)
+    retry_policy = RetryPolicy(max_retries=max_retries)
+    size = int(s3_client.head_object(Bucket=bucket, Key=key).get('ContentLength', 0))
+    start = time.monotonic()
+    with open(filename, 'wb') as local_file:
+        local_file.truncate(size)
+
+    def download_part(offset):
+        end = min(offset + part_size, size) - 1
+        attempt = 0
+        while True:
+            try:
+                rsp = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={offset}-{end}')
+                data = rsp.get('Body').read()
+                if len(data) != end - offset + 1:
+                    raise IOError(f'Expected {end - offset + 1} bytes for range {offset}-{end} but got {len(data)}')
+                break
+            except Exception:
+                if attempt >= retry_policy.max_retries:
+                    raise
+                time.sleep(retry_policy.delay(attempt))
+                attempt += 1
+        with open(filename, 'r+b') as part_file:
+            part_file.seek(offset)
+            part_file.write(data)
+        return attempt
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        retries = sum(executor.map(download_part, range(0, size, part_size)))
+
+    elapsed = time.monotonic() - start
+    throughput = size / (1024 * 1024) / elapsed if elapsed else 0.0
+    print(f'Downloaded {size / (1024 * 1024):.1f} MiB in {elapsed:.1f}s ({throughput:.1f} MiB/s, {retries} part retries)')
+    return {'bytes': size, 'elapsed': elapsed, 'throughput': throughput, 'retries': retries}
@@ -0,0 +1,216 @@
+import codecs
+import json
+import sys
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
+from json import JSONDecodeError
+
+WHITESPACE = ' \t\n\r'
+DEFAULT_RECENT_KEYS = 100_000
+DELIMITERS = f'{WHITESPACE},]'
+# Streams results are written to while print output is sent to stderr, see results_to_stdout
+RESULT_STREAMS: list = []
+
+
+def results_stdout():
+    """
+    :return: the stdout results are written to, which is not sys.stdout while results_to_stdout is active
+    """
+    return RESULT_STREAMS[-1] if RESULT_STREAMS else sys.stdout
+
+
+@contextmanager
+def results_to_stdout(enabled=True):
+    """
+    Sends everything printed to stderr while results are streamed to stdout so piped results are never mixed with
+    progress messages. Results must be written to results_stdout().
+    :param enabled: False to leave stdout untouched, for results written to a file
+    """
+    if not enabled:
+        yield
+        return
+    stdout = results_stdout()
+    stdout.flush()
+    RESULT_STREAMS.append(stdout)
+    try:
+        with redirect_stdout(sys.stderr):
+            yield
+    finally:
+        RESULT_STREAMS.pop()
+
+
+@contextmanager
+def open_output(output=None, mode='w+'):
+    """
+    Opens the output file for a streaming writer, or the results stdout if no output file was provided.
+    :param output: path of the output file
+    :param mode: mode to open the output file with
+    """
+    if not output:
+        yield results_stdout()
+    else:
+        with open(output, mode, encoding='utf-8') as outfile:
+            yield outfile
+
+
+class RecentKeys:
+    """
+    Remembers the most recently added keys so duplicate records can be dropped from a stream in constant memory. Only
+    the last maxlen keys are kept: a duplicate is caught when it arrives within maxlen records of the first copy, which
+    covers records that shift between pages or slices while a query is running, without holding every key of the result
+    set.
+    """
+    def __init__(self, maxlen=DEFAULT_RECENT_KEYS):
+        """
+        :param maxlen: number of keys remembered
+        """
+        self.maxlen = maxlen
+        self.keys: set = set()
+        self.order: deque = deque()
+
+    def add(self, key):
+        """
+        :return: True if key was added, False if it is one of the remembered keys
+        """
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.order.append(key)
+        if len(self.order) > self.maxlen:
+            self.keys.discard(self.order.popleft())
+        return True
+
+
+class JsonStreamWriter:
+    """
+    Writes records to a file as they arrive so that a result set never has to be held in memory. Records are either
+    framed as a JSON array, formatted identically to json.dumps(records, indent=2, sort_keys=True), or written as
+    JSON Lines with one record per line.
+    """
+    def __init__(self, file, json_lines=False, count=0):
+        """
+        :param file: file object to write to
+        :param json_lines: write JSON Lines instead of a JSON array
+        :param count: number of records already written to file, used when appending to an existing output
+        """
+        self.file = file
+        self.json_lines = json_lines
+        self.count = count
+
+    def write(self, records):
+        for record in records:
+            if self.json_lines:
+                self.file.write(f'{json.dumps(record, sort_keys=True)}\n')
+            else:
+                separator = ',\n' if self.count else '[\n'
+                record_json = json.dumps(record, indent=2, sort_keys=True).replace('\n', '\n  ')
+                self.file.write(f'{separator}  {record_json}')
+            self.count += 1
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        """
+        Closes the JSON array framing. The underlying file is left open.
+        """
+        if not self.json_lines:
+            self.file.write('\n]\n' if self.count else '[]\n')
+        self.file.flush()
+
+
+class JsonArrayScanner:
+    """
+    Scans the text of a JSON array that is read from a file a chunk at a time. Only the unread part of the current
+    chunk and the element being decoded are held in memory.
+    """
+    def __init__(self, file, chunk_size):
+        """
+        :param file: file like object opened in text or binary mode. Binary content is decoded as utf-8.
+        :param chunk_size: number of characters or bytes read at a time
+        """
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def read_chunk(self):
+        """
+        Appends the next chunk of the file to the unread part of the buffer.
+        """
+        chunk = self.file.read(self.chunk_size)
+        self.eof = not chunk
+        if isinstance(chunk, bytes):
+            chunk = self.text_decoder.decode(chunk, final=self.eof)
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def next_token(self):
+        """
+        Skips whitespace, reading more of the file as needed.
+        :return: the next character or an empty string at the end of the file
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if self.eof:
+                return ''
+            self.read_chunk()
+
+    def next_element(self, expect_separator):
+        """
+        Moves to the start of the next element of the array.
+        :param expect_separator: True if an element has already been read, so a comma must come first
+        :return: False at the end of the array
+        """
+        token = self.next_token()
+        if token == ']':
+            return False
+        if not token:
+            raise ValueError('Unterminated JSON array')
+        if expect_separator:
+            if token != ',':
+                raise ValueError(f'Expected "," or "]" but found "{token}"')
+            self.position += 1
+            self.next_token()
+        return True
+
+    def decode_element(self):
+        """
+        Decodes the element starting at the current position, reading more of the file until it is complete.
+        """
+        while True:
+            try:
+                element, end = self.decoder.raw_decode(self.buffer, self.position)
+                # The element is only complete once it is followed by a delimiter, a number at the end of the buffer
+                # may continue in the next chunk
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in DELIMITERS):
+                    self.position = end
+                    return element
+            except JSONDecodeError:
+                if self.eof:
+                    raise
+            self.read_chunk()
+
+
+def iter_json_array(file, chunk_size=1 << 20):
+    """
+    Generator that incrementally parses a file containing a JSON array and yields its elements one at a time, so only
+    the current chunk and element are ever held in memory.
+    :param file: file like object opened in text or binary mode. Binary content is decoded as utf-8.
+    :param chunk_size: number of characters or bytes read at a time
+    """
+    scanner = JsonArrayScanner(file, chunk_size)
+    if scanner.next_token() != '[':
+        raise ValueError('Expected a JSON array')
+    scanner.position += 1
+    expect_separator = False
+    while scanner.next_element(expect_separator):
+        yield scanner.decode_element()
+        expect_separator = True
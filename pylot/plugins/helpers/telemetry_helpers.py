@@ -0,0 +1,349 @@
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+from array import array
+from dataclasses import dataclass, field
+from tempfile import gettempdir
+
+from .bulk_helpers import percentile, response_error
+
+PERCENTS = (50, 95, 99)
+# Top level options whose value follows them on the commandline, see pylot_cli.select_plugin
+TELEMETRY_OPTIONS = ('--metrics-file', '--prometheus-file', '--statsd')
+
+
+@dataclass
+class CallStats:
+    count: int = 0
+    errors: int = 0
+    retries: int = 0
+    bytes: int = 0
+    latencies: array = field(default_factory=lambda: array('d'))
+
+    def latency_percentiles(self, percents=PERCENTS):
+        """
+        :return: dictionary of the form {percent: latency in seconds}
+        """
+        latencies = sorted(self.latencies)
+        return {percent: percentile(latencies, percent) for percent in percents}
+
+
+class Telemetry:
+    """
+    Thread safe collector of per call latency, errors, retries and bytes transferred for the Cumulus API, lambda and S3
+    calls a PyLOT command makes, and of counters such as the number of records processed. When the command finishes the
+    metrics are written to a json file and optionally a Prometheus textfile, and a latency summary is printed. Calls are
+    also sent to StatsD as they happen if a StatsD address is configured.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls: dict = {}
+        self.counters: dict = {}
+        self.start = time.monotonic()
+        self.command = None
+        self.metrics_file = None
+        self.prometheus_file = None
+        self.statsd_address = None
+        self.statsd_socket = None
+
+    def configure(self, command=None, metrics_file=None, prometheus_file=None, statsd=None):
+        """
+        :param command: name of the command the metrics are recorded for
+        :param metrics_file: json file the metrics are written to when the command finishes. Defaults to
+        <tmp>/pylot_cache/metrics/<command>.json
+        :param prometheus_file: Prometheus textfile collector file the metrics are written to when the command finishes
+        :param statsd: StatsD host:port calls and counters are sent to over UDP
+        """
+        self.command = command
+        self.metrics_file = metrics_file or os.path.join(gettempdir(), 'pylot_cache', 'metrics', f'{command}.json')
+        self.prometheus_file = prometheus_file
+        if statsd:
+            host, _, port = statsd.rpartition(':')
+            self.statsd_address = (host or 'localhost', int(port))
+            self.statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.counters.clear()
+            self.start = time.monotonic()
+
+    def send_statsd(self, lines):
+        if not self.statsd_socket:
+            return
+        try:
+            self.statsd_socket.sendto('\n'.join(lines).encode('utf-8'), self.statsd_address)
+        except OSError:
+            # Metrics are best effort and must never fail the command
+            pass
+
+    def record(self, name, latency, error=False, retries=0, transferred_bytes=0):
+        """
+        Records a single call.
+        :param name: name of the call such as cumulus_api.update_granule or s3.GetObject
+        :param latency: seconds the call took
+        :param error: the call failed
+        :param retries: number of times the call was retried
+        :param transferred_bytes: number of bytes sent and received by the call
+        """
+        with self.lock:
+            stats = self.calls.setdefault(name, CallStats())
+            stats.count += 1
+            stats.errors += int(error)
+            stats.retries += retries
+            stats.bytes += transferred_bytes
+            stats.latencies.append(latency)
+
+        lines = [f'pylot.{name}:{latency * 1000:.3f}|ms']
+        if error:
+            lines.append(f'pylot.{name}.errors:1|c')
+        if retries:
+            lines.append(f'pylot.{name}.retries:{retries}|c')
+        if transferred_bytes:
+            lines.append(f'pylot.{name}.bytes:{transferred_bytes}|c')
+        self.send_statsd(lines)
+
+    def increment(self, name, value=1):
+        """
+        Adds value to a counter such as records_processed.
+        """
+        if not value:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        self.send_statsd([f'pylot.{name}:{value}|c'])
+
+    def instrument(self, name, function, is_error=None):
+        """
+        :param is_error: called with the return value of a call that did not raise to determine if it failed
+        :return: function wrapped so every call to it is recorded
+        """
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            error = True
+            try:
+                response = function(*args, **kwargs)
+                error = bool(is_error and is_error(response))
+                return response
+            finally:
+                self.record(name, time.monotonic() - start, error)
+
+        return wrapper
+
+    def record_result(self, name, result):
+        """
+        Adds the succeeded, failed and retried record counts of a BulkResult to the counters of an operation.
+        """
+        prefix = re.sub(r'\W+', '_', name).strip('_').lower()
+        self.increment(f'{prefix}_succeeded', result.succeeded)
+        self.increment(f'{prefix}_failed', result.failed)
+        self.increment(f'{prefix}_retries', result.retries)
+
+    def snapshot(self):
+        """
+        :return: dictionary of the recorded calls and counters with latencies in milliseconds
+        """
+        with self.lock:
+            calls = {
+                name: {
+                    'count': stats.count, 'errors': stats.errors, 'retries': stats.retries, 'bytes': stats.bytes,
+                    'latency_ms': {
+                        **{f'p{k}': round(v * 1000, 3) for k, v in stats.latency_percentiles().items()},
+                        'max': round(max(stats.latencies, default=0) * 1000, 3),
+                        'total': round(sum(stats.latencies) * 1000, 3)
+                    }
+                } for name, stats in sorted(self.calls.items())
+            }
+            return {
+                'command': self.command, 'elapsed': round(time.monotonic() - self.start, 3),
+                'calls': calls, 'counters': dict(sorted(self.counters.items()))
+            }
+
+    def summary(self):
+        """
+        :return: list of lines describing the latency percentiles of each call and the counters
+        """
+        snapshot = self.snapshot()
+        lines = [f'Telemetry for {snapshot.get("command") or "pylot"} ({snapshot.get("elapsed"):.1f}s):']
+        for name, stats in snapshot.get('calls').items():
+            latency = ', '.join(f'{k} {v:.0f}ms' for k, v in stats.get('latency_ms').items() if k.startswith('p'))
+            transferred = f', {stats.get("bytes") / (1024 * 1024):.1f} MiB' if stats.get('bytes') else ''
+            lines.append(f'  {name}: {stats.get("count")} calls, {stats.get("errors")} errors, '
+                         f'{stats.get("retries")} retries{transferred} (latency {latency})')
+        for name, value in snapshot.get('counters').items():
+            lines.append(f'  {name}: {value}')
+
+        return lines
+
+    def write_json(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp_file = f'{path}.tmp'
+        with open(temp_file, 'w+', encoding='utf-8') as metrics_file:
+            json.dump(self.snapshot(), metrics_file, indent=2)
+        os.replace(temp_file, path)
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics in the Prometheus text format for the node exporter textfile collector. The file is replaced
+        atomically so the collector never reads a partial file.
+        """
+        snapshot = self.snapshot()
+        command = snapshot.get('command') or 'pylot'
+        lines = [
+            '# HELP pylot_call_latency_seconds Latency of the calls made by PyLOT.',
+            '# TYPE pylot_call_latency_seconds summary'
+        ]
+        with self.lock:
+            latencies = {name: (stats.latency_percentiles(), sum(stats.latencies)) for name, stats in self.calls.items()}
+        for name, stats in snapshot.get('calls').items():
+            labels = f'command="{command}",call="{name}"'
+            quantiles, total = latencies.get(name)
+            for percent, value in quantiles.items():
+                lines.append(f'pylot_call_latency_seconds{{{labels},quantile="{percent / 100}"}} {value}')
+            lines.append(f'pylot_call_latency_seconds_sum{{{labels}}} {total}')
+            lines.append(f'pylot_call_latency_seconds_count{{{labels}}} {stats.get("count")}')
+        for metric, key, description in (
+                ('pylot_call_errors_total', 'errors', 'Calls made by PyLOT that failed.'),
+                ('pylot_call_retries_total', 'retries', 'Retries of the calls made by PyLOT.'),
+                ('pylot_call_bytes_total', 'bytes', 'Bytes transferred by the calls made by PyLOT.')
+        ):
+            lines.extend([f'# HELP {metric} {description}', f'# TYPE {metric} counter'])
+            for name, stats in snapshot.get('calls').items():
+                lines.append(f'{metric}{{command="{command}",call="{name}"}} {stats.get(key)}')
+        for name, value in snapshot.get('counters').items():
+            lines.extend([f'# TYPE pylot_{name}_total counter', f'pylot_{name}_total{{command="{command}"}} {value}'])
+
+        temp_file = f'{path}.tmp'
+        with open(temp_file, 'w+', encoding='utf-8') as prometheus_file:
+            prometheus_file.write('\n'.join(lines) + '\n')
+        os.replace(temp_file, path)
+
+    def finish(self, stream=None):
+        """
+        Prints the summary and writes the configured sinks if any calls were recorded. Output goes to stderr so it never
+        mixes with results written to stdout, and a sink that can not be written never fails the command.
+        """
+        stream = stream or sys.stderr
+        if not (self.calls or self.counters):
+            return
+        print('\n'.join(self.summary()), file=stream)
+        for path, write in ((self.metrics_file, self.write_json), (self.prometheus_file, self.write_prometheus)):
+            if not path:
+                continue
+            try:
+                write(path)
+                print(f'Metrics written to: {path}', file=stream)
+            except OSError as error:
+                print(f'Unable to write metrics to {path}: {error}', file=stream)
+        if self.statsd_socket:
+            self.statsd_socket.close()
+            self.statsd_socket = None
+
+
+TELEMETRY = Telemetry()
+
+
+def body_length(body):
+    """
+    :return: number of bytes left in a request body, 0 if it can not be determined without reading it
+    """
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    try:
+        position = body.tell()
+        end = body.seek(0, os.SEEK_END)
+        body.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def instrument_boto3_client(client, telemetry=TELEMETRY):
+    """
+    Records every call a boto3 client makes, including its retries and the bytes in its request and response bodies,
+    through the client's event hooks.
+    """
+    def before_call(model, params, context, **kwargs):
+        context['pylot_call'] = (
+            f'{client.meta.service_model.service_name}.{model.name}', time.monotonic(),
+            body_length(params.get('body')) if isinstance(params, dict) else 0
+        )
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        if 'pylot_call' not in context:
+            return
+        name, start, sent = context.pop('pylot_call')
+        headers = getattr(http_response, 'headers', None) or {}
+        # A HEAD response describes the length of a body it does not send
+        received = 0
+        if model.http.get('method') != 'HEAD':
+            received = parsed.get('ContentLength') or headers.get('content-length') or 0
+        telemetry.record(
+            name, time.monotonic() - start, error=(getattr(http_response, 'status_code', 200) or 200) >= 300,
+            retries=parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0), transferred_bytes=sent + int(received)
+        )
+
+    def after_call_error(context, **kwargs):
+        # Raised when the request could not be sent or no response was received
+        if 'pylot_call' in context:
+            name, start, _ = context.pop('pylot_call')
+            telemetry.record(name, time.monotonic() - start, error=True)
+
+    # Registered first so handlers that short circuit the request, such as botocore's Stubber, are still timed
+    events = client.meta.events
+    events.register_first('before-call.*.*', before_call, unique_id='pylot-telemetry-before-call')
+    events.register_first('after-call.*.*', after_call, unique_id='pylot-telemetry-after-call')
+    events.register_first('after-call-error.*.*', after_call_error, unique_id='pylot-telemetry-after-call-error')
+
+    return client
+
+
+class InstrumentedProxy:
+    """
+    Wraps an API object such as a CumulusApi instance so each of its method calls is recorded as <prefix>.<method>.
+    Attribute reads and writes, such as a token refresh, go straight to the wrapped object.
+    """
+    def __init__(self, target, prefix, telemetry=TELEMETRY):
+        object.__setattr__(self, 'target', target)
+        object.__setattr__(self, 'prefix', prefix)
+        object.__setattr__(self, 'telemetry', telemetry)
+
+    def __getattr__(self, name):
+        value = getattr(self.target, name)
+        if callable(value) and not name.startswith('_'):
+            return self.telemetry.instrument(f'{self.prefix}.{name}', value, response_error)
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self.target, name, value)
+
+
+def add_telemetry_arguments(parser):
+    """
+    Adds the telemetry sink arguments to the top level parser. Each defaults to a PYLOT_ environment variable.
+    """
+    parser.add_argument(
+        '--metrics-file',
+        help='Write call latency, retry, byte and record metrics to this json file when the command finishes. '
+             'Defaults to the PYLOT_METRICS_FILE environment variable or <tmp>/pylot_cache/metrics/<plugin>.json.',
+        metavar='',
+        default=os.getenv('PYLOT_METRICS_FILE')
+    )
+    parser.add_argument(
+        '--prometheus-file',
+        help='Also write the metrics to this Prometheus textfile collector file. Defaults to the '
+             'PYLOT_PROMETHEUS_FILE environment variable.',
+        metavar='',
+        default=os.getenv('PYLOT_PROMETHEUS_FILE')
+    )
+    parser.add_argument(
+        '--statsd',
+        help='Send the metrics to StatsD at host:port as they are recorded. Defaults to the PYLOT_STATSD environment '
+             'variable.',
+        metavar='',
+        default=os.getenv('PYLOT_STATSD')
+    )
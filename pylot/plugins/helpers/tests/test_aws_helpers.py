@@ -0,0 +1,45 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pylot.plugins.helpers import aws_helpers
+from pylot.plugins.helpers.aws_helpers import clear_clients, get_client, get_session
+
+
+class TestAwsHelpers(unittest.TestCase):
+    def setUp(self):
+        clear_clients()
+
+    def tearDown(self):
+        clear_clients()
+
+    @patch('pylot.plugins.helpers.aws_helpers.boto3.session.Session')
+    def test_get_session_is_cached_per_region_and_profile(self, mock_session):
+        mock_session.side_effect = lambda **kwargs: MagicMock()
+        self.assertIs(get_session('us-west-2'), get_session('us-west-2'))
+        self.assertIsNot(get_session('us-west-2'), get_session('us-east-1'))
+        self.assertIsNot(get_session('us-west-2'), get_session('us-west-2', 'other'))
+        self.assertEqual(mock_session.call_count, 3)
+
+    @patch('pylot.plugins.helpers.aws_helpers.boto3.session.Session')
+    def test_get_client_is_cached(self, mock_session):
+        mock_session.return_value.client.side_effect = lambda *args, **kwargs: MagicMock()
+        client = get_client('s3')
+        self.assertIs(get_client('s3'), client)
+        self.assertIsNot(get_client('lambda'), client)
+        self.assertEqual(mock_session.call_count, 1)
+
+    @patch('pylot.plugins.helpers.aws_helpers.boto3.session.Session')
+    def test_get_client_grows_connection_pool(self, mock_session):
+        mock_session.return_value.client.side_effect = lambda *args, **kwargs: MagicMock()
+        client = get_client('s3', max_pool_connections=10)
+        self.assertIs(get_client('s3', max_pool_connections=5), client)
+        larger_client = get_client('s3', max_pool_connections=64)
+        self.assertIsNot(larger_client, client)
+        config = mock_session.return_value.client.call_args.kwargs.get('config')
+        self.assertEqual(config.max_pool_connections, 64)
+        self.assertIs(get_client('s3'), larger_client)
+        self.assertEqual(aws_helpers.CLIENTS.get(('s3', None, None))[1], 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
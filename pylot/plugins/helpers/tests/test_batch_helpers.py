@@ -0,0 +1,63 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+from pylot.plugins.helpers.batch_helpers import load_batch_queries, run_batch
+
+
+class TestBatchHelpers(unittest.TestCase):
+    def write_batch_file(self, temp_dir, queries):
+        filename = os.path.join(temp_dir, 'batch.json')
+        with open(filename, 'w', encoding='utf-8') as batch_file:
+            json.dump(queries, batch_file)
+        return filename
+
+    def test_load_batch_queries(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            named = load_batch_queries(self.write_batch_file(temp_dir, {'nalma': {'a': 1}, 'goes': {'b': 2}}))
+            listed = load_batch_queries(self.write_batch_file(temp_dir, [{'a': 1}, {'b': 2}]))
+        self.assertEqual(named, [('nalma', {'a': 1}), ('goes', {'b': 2})])
+        self.assertEqual(listed, [('query_0', {'a': 1}), ('query_1', {'b': 2})])
+
+    def test_load_batch_queries_rejects_unsafe_names(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            with self.assertRaises(ValueError):
+                load_batch_queries(self.write_batch_file(temp_dir, {'../escape': {}}))
+
+    @patch('pylot.plugins.helpers.batch_helpers.get_client')
+    def test_run_batch(self, mock_get_client):
+        active = []
+        peak = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(3, timeout=5)
+
+        def run_query(query_data, results):
+            with lock:
+                active.append(results)
+                peak.append(len(active))
+            if json.loads(query_data).get('fail'):
+                raise ValueError('bad query')
+            barrier.wait()
+            with lock:
+                active.remove(results)
+            return {'record_count': 1}
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            queries = [('a', {}), ('b', {}), ('c', {}), ('bad', {'fail': True})]
+            entries = run_batch(queries, run_query, workers=4, transfer_concurrency=2, output_dir=temp_dir)
+            with open(os.path.join(temp_dir, 'manifest.json'), 'r', encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+
+        self.assertEqual([entry.get('status') for entry in entries], ['succeeded'] * 3 + ['failed'])
+        self.assertEqual(entries[0].get('file'), os.path.join(temp_dir, 'a.json'))
+        self.assertEqual(entries[3].get('error'), 'ValueError: bad query')
+        self.assertEqual((manifest.get('succeeded'), manifest.get('failed')), (3, 1))
+        self.assertGreaterEqual(max(peak), 3)
+        mock_get_client.assert_any_call('s3', max_pool_connections=8)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from pylot.plugins.helpers.bulk_helpers import BulkExecutor, TokenBucket, response_error, classify_error, \
+    RetryPolicy, AdaptiveConcurrency, write_replay_file, THROTTLED, RETRYABLE, FATAL, percentile, run_pipeline
+
+
+class TestBulkHelpers(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_response_error(self):
+        self.assertIsNone(response_error({'message': 'Successfully updated granule'}))
+        self.assertEqual(response_error({'message': 'Internal server error'}), '500 : Internal server error')
+        self.assertEqual(response_error({'message': 'Too Many Requests'}), '429 : Too Many Requests')
+        self.assertIsNone(response_error({'granuleId': 'a', 'error': {'Cause': 'None'}}))
+        self.assertEqual(response_error({'statusCode': 404, 'error': 'Not Found', 'message': 'No record'}),
+                         '404 Not Found: No record')
+        self.assertEqual(response_error({'error': 'Bad Request', 'message': 'Invalid'}), 'Bad Request: Invalid')
+
+    def test_run_counts_results(self):
+        def function(record):
+            if record % 3 == 0:
+                raise ValueError('bad record')
+            if record % 3 == 1:
+                return {'statusCode': 500, 'error': 'Internal Server Error'}
+            return {'message': 'ok'}
+
+        result = BulkExecutor(concurrency=4, progress_interval=0).run(function, range(9))
+        self.assertEqual((result.succeeded, result.failed), (3, 6))
+        self.assertEqual(sorted(x.get('record') for x in result.failures), [0, 1, 3, 4, 6, 7])
+
+    def test_run_on_success_failure(self):
+        def on_success(record):
+            if record % 2:
+                raise RuntimeError('next stage unavailable')
+
+        result = BulkExecutor(concurrency=2, max_in_flight=2, progress_interval=0).run(
+            lambda record: None, range(10), on_success=on_success
+        )
+        self.assertEqual((result.succeeded, result.failed), (5, 5))
+        self.assertEqual(result.failures[0].get('error'), 'RuntimeError: next stage unavailable')
+
+    def test_run_bounds_in_flight(self):
+        lock = threading.Lock()
+        completed = [0]
+        gaps = []
+
+        def records():
+            for record in range(200):
+                # Every record consumed so far has been submitted, so this is the number of records in flight
+                with lock:
+                    gaps.append(record - completed[0])
+                yield record
+
+        def on_success(record):
+            with lock:
+                completed[0] += 1
+
+        result = BulkExecutor(concurrency=4, max_in_flight=8, progress_interval=0).run(
+            lambda record: time.sleep(0.001), records(), on_success=on_success
+        )
+        self.assertEqual(result.succeeded, 200)
+        self.assertLessEqual(max(gaps), 8)
+
+    def test_classify_error(self):
+        self.assertIsNone(classify_error({'message': 'ok'}))
+        self.assertEqual(classify_error({'message': 'Too Many Requests'}), THROTTLED)
+        self.assertEqual(classify_error({'message': 'Internal server error'}), RETRYABLE)
+        self.assertEqual(classify_error({'message': 'Endpoint request timed out'}), RETRYABLE)
+        self.assertEqual(classify_error({'message': 'Missing Authentication Token'}), FATAL)
+        self.assertEqual(classify_error({'statusCode': 429, 'error': 'Too Many Requests'}), THROTTLED)
+        self.assertEqual(classify_error({'statusCode': 502, 'error': 'Bad Gateway'}), RETRYABLE)
+        self.assertEqual(classify_error({'statusCode': 404, 'error': 'Not Found'}), FATAL)
+        self.assertEqual(classify_error(exception=ConnectionError('reset')), RETRYABLE)
+        self.assertEqual(classify_error(exception=Exception('ThrottlingException: Rate exceeded')), THROTTLED)
+        self.assertEqual(classify_error(exception=KeyError('granuleId')), FATAL)
+
+    def test_retry_policy_delay(self):
+        policy = RetryPolicy(base_delay=1, max_delay=4)
+        for attempt in range(10):
+            self.assertLessEqual(policy.delay(attempt), min(4, 2 ** attempt))
+
+    def test_adaptive_concurrency(self):
+        concurrency = AdaptiveConcurrency(8, cooldown=0)
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 4)
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 2)
+        for _ in range(2):
+            concurrency.on_success()
+        self.assertEqual(concurrency.limit, 3)
+
+    def test_adaptive_concurrency_cooldown(self):
+        concurrency = AdaptiveConcurrency(8, cooldown=60)
+        concurrency.on_throttle()
+        concurrency.on_throttle()
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_run_retries(self):
+        attempts = {}
+
+        def function(record):
+            attempts[record] = attempts.get(record, 0) + 1
+            if record == 'throttled' and attempts[record] < 3:
+                return {'statusCode': 429, 'error': 'Too Many Requests'}
+            if record == 'missing':
+                return {'statusCode': 404, 'error': 'Not Found'}
+            return {'message': 'ok'}
+
+        executor = BulkExecutor(concurrency=4, progress_interval=0, retry_policy=RetryPolicy(base_delay=0))
+        result = executor.run(function, ['throttled', 'missing', 'ok'])
+        self.assertEqual((result.succeeded, result.failed, result.retries), (2, 1, 2))
+        self.assertEqual(attempts, {'throttled': 3, 'missing': 1, 'ok': 1})
+
+    def test_run_retries_exhausted(self):
+        def function(record):
+            raise ConnectionError('reset')
+
+        executor = BulkExecutor(progress_interval=0, retry_policy=RetryPolicy(max_retries=2, base_delay=0))
+        result = executor.run(function, ['a'])
+        self.assertEqual((result.failed, result.retries), (1, 2))
+
+    def test_write_replay_file(self):
+        failures = [{'record': {'granuleId': 'a'}, 'error': 'x'}, {'record': {'granuleId': 'a'}, 'error': 'y'},
+                    {'record': {'granuleId': 'b'}, 'error': 'x'}]
+        with tempfile.TemporaryDirectory() as temp_dir:
+            replay_file = os.path.join(temp_dir, 'failed.json')
+            self.assertEqual(write_replay_file(replay_file, failures), 2)
+            with open(replay_file, 'r', encoding='utf-8') as infile:
+                self.assertEqual(json.load(infile), [{'granuleId': 'a'}, {'granuleId': 'b'}])
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0.0)
+
+    def test_run_records_latency(self):
+        result = BulkExecutor(progress_interval=0).run(lambda x: time.sleep(0.01), range(4))
+        self.assertEqual(len(result.latencies), 4)
+        self.assertGreaterEqual(result.latency_percentiles().get(50), 0.01)
+        self.assertIn('p99', result.summary())
+
+    def test_run_pipeline(self):
+        started_second_stage = threading.Event()
+        order = []
+
+        def first(record):
+            if record == 9:
+                # The last record of the first stage waits until the second stage has started on earlier records
+                started_second_stage.wait(5)
+            if record == 3:
+                return {'statusCode': 400, 'error': 'Bad Request'}
+            return {}
+
+        def second(record):
+            order.append(record)
+            started_second_stage.set()
+            return {}
+
+        start = time.monotonic()
+        results = run_pipeline([
+            ('first', first, BulkExecutor(concurrency=2, progress_interval=0)),
+            ('second', second, BulkExecutor(concurrency=2, progress_interval=0))
+        ], range(10))
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertEqual([name for name, _ in results], ['first', 'second'])
+        self.assertEqual((results[0][1].succeeded, results[0][1].failed), (9, 1))
+        self.assertEqual(results[1][1].succeeded, 9)
+        self.assertNotIn(3, order)
@@ -0,0 +1,133 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pylot.plugins.helpers.cache_helpers import ResponseCache, cache_key, get_response_cache
+
+
+class TestCacheHelpers(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'responses.sqlite')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_cache_key_normalizes_kwargs(self):
+        self.assertEqual(
+            cache_key('cumulus_api', 'list_granules', kwargs={'a': 1, 'b': 2}),
+            cache_key('cumulus_api', 'list_granules', kwargs={'b': 2, 'a': 1})
+        )
+        self.assertNotEqual(
+            cache_key('cumulus_api', 'list_granules', kwargs={'a': 1}),
+            cache_key('cumulus_api', 'list_collections', kwargs={'a': 1})
+        )
+
+    def test_cache_key_includes_deployment(self):
+        with patch.dict(os.environ, {'OPENSEARCH_LAMBDA_ARN': 'arn:sit'}):
+            sit_key = cache_key('opensearch', 'query', ({}, 'granule', 0))
+        with patch.dict(os.environ, {'OPENSEARCH_LAMBDA_ARN': 'arn:uat'}):
+            self.assertNotEqual(cache_key('opensearch', 'query', ({}, 'granule', 0)), sit_key)
+        with patch.dict(os.environ, {'OPENSEARCH_LAMBDA_ARN': 'arn:sit', 'AWS_PROFILE': 'uat'}):
+            self.assertNotEqual(cache_key('opensearch', 'query', ({}, 'granule', 0)), sit_key)
+
+    def test_permissions(self):
+        path = os.path.join(self.temp_dir.name, 'pylot_cache', 'responses.sqlite')
+        ResponseCache(path).set('key', {'a': 1})
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o777, 0o700)
+        for file in os.listdir(os.path.dirname(path)):
+            self.assertEqual(os.stat(os.path.join(os.path.dirname(path), file)).st_mode & 0o777, 0o600)
+
+    def test_call_caches_responses(self):
+        cache = ResponseCache(self.path)
+        function = MagicMock(return_value={'results': [1, 2]})
+        self.assertEqual(cache.call('cumulus_api', 'list_granules', function, limit=2), {'results': [1, 2]})
+        self.assertEqual(cache.call('cumulus_api', 'list_granules', function, limit=2), {'results': [1, 2]})
+        function.assert_called_once_with(limit=2)
+        cache.call('cumulus_api', 'list_granules', function, limit=3)
+        self.assertEqual(function.call_count, 2)
+
+    def test_call_does_not_cache_errors(self):
+        cache = ResponseCache(self.path)
+        function = MagicMock(return_value={'statusCode': 500, 'error': 'Internal Server Error'})
+        cache.call('cumulus_api', 'list_granules', function)
+        cache.call('cumulus_api', 'list_granules', function)
+        self.assertEqual(function.call_count, 2)
+
+    def test_cache_hit_printed_to_stderr(self):
+        cache = ResponseCache(self.path)
+        function = MagicMock(return_value={'results': [1]})
+        cache.call('cumulus_api', 'list_granules', function)
+        with patch('sys.stdout', io.StringIO()) as stdout, patch('sys.stderr', io.StringIO()) as stderr:
+            cache.call('cumulus_api', 'list_granules', function)
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('Using cached list_granules response', stderr.getvalue())
+
+    @patch('pylot.plugins.helpers.cache_helpers.get_s3_etag')
+    def test_call_checks_results_object(self, mock_get_s3_etag):
+        cache = ResponseCache(self.path)
+        function = MagicMock(return_value={'bucket': 'bucket', 'key': 'results.json', 'record_count': 1})
+        mock_get_s3_etag.return_value = '"1"'
+        cache.call('opensearch', 'query', function)
+        cache.call('opensearch', 'query', function)
+        self.assertEqual(function.call_count, 1)
+        mock_get_s3_etag.assert_called_with('bucket', 'results.json')
+        # The results object was overwritten
+        mock_get_s3_etag.return_value = '"2"'
+        cache.call('opensearch', 'query', function)
+        self.assertEqual(function.call_count, 2)
+        # The results object expired, so the response is not cached
+        mock_get_s3_etag.return_value = None
+        cache.call('opensearch', 'query', function)
+        cache.call('opensearch', 'query', function)
+        self.assertEqual(function.call_count, 4)
+
+    def test_ttl(self):
+        cache = ResponseCache(self.path, ttl=60)
+        with patch('pylot.plugins.helpers.cache_helpers.time.time', return_value=1000):
+            cache.set('key', {'a': 1})
+        with patch('pylot.plugins.helpers.cache_helpers.time.time', return_value=1059):
+            self.assertEqual(cache.get('key'), {'a': 1})
+        with patch('pylot.plugins.helpers.cache_helpers.time.time', return_value=1061):
+            self.assertIsNone(cache.get('key'))
+
+    def test_refresh_ignores_cached_responses(self):
+        ResponseCache(self.path).set('key', {'a': 1})
+        cache = ResponseCache(self.path, refresh=True)
+        self.assertIsNone(cache.get('key'))
+        cache.set('key', {'a': 2})
+        self.assertEqual(ResponseCache(self.path).get('key'), {'a': 2})
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(self.path, max_bytes=30)
+        now = time.time()
+        with patch('pylot.plugins.helpers.cache_helpers.time.time', side_effect=[now + 1, now + 2, now + 3, now + 4]):
+            cache.set('first', 'x' * 10)
+            cache.set('second', 'y' * 10)
+            # Reading first makes second the least recently used entry
+            cache.get('first')
+            cache.set('third', 'z' * 10)
+        self.assertIsNone(cache.get('second'))
+        self.assertEqual(cache.get('first'), 'x' * 10)
+        self.assertEqual(cache.get('third'), 'z' * 10)
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_get_response_cache(self):
+        self.assertIsNone(get_response_cache())
+        self.assertIsNone(get_response_cache(refresh=True))
+        with patch('pylot.plugins.helpers.cache_helpers.ResponseCache') as mock_cache:
+            get_response_cache(cache=True, cache_ttl=10)
+            mock_cache.assert_called_once_with(ttl=10, refresh=False)
+            self.assertIsNone(get_response_cache(cache=True, no_cache=True))
+            os.environ['PYLOT_CACHE_TTL'] = '30'
+            get_response_cache()
+            mock_cache.assert_called_with(ttl=30, refresh=False)
+            get_response_cache(refresh=True)
+            mock_cache.assert_called_with(ttl=30, refresh=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import os
+import tempfile
+import unittest
+
+from pylot.plugins.helpers.checkpoint_helpers import Checkpoint
+
+
+class TestCheckpointHelpers(unittest.TestCase):
+    def test_save_load_remove(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint = Checkpoint(os.path.join(temp_dir, 'run.checkpoint'), function='list_granules')
+            self.assertEqual(checkpoint.load(), {})
+            checkpoint.save({'count': 2, 'offset': 10})
+            self.assertEqual(checkpoint.load(), {'function': 'list_granules', 'count': 2, 'offset': 10})
+            checkpoint.remove()
+            self.assertFalse(os.path.isfile(checkpoint.path))
+
+    def test_unreadable_checkpoint(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            checkpoint = Checkpoint(os.path.join(temp_dir, 'run.checkpoint'))
+            with open(checkpoint.path, 'w+', encoding='utf-8') as checkpoint_file:
+                checkpoint_file.write('{"count": ')
+            self.assertEqual(checkpoint.load(), {})
@@ -0,0 +1,116 @@
+import csv
+import gzip
+import io
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pylot.plugins.helpers.get_status_helpers import GetStatusHelpers
+
+KEYS = {
+    'data/readme.txt': 5,
+    'data/a/1.nc': 10,
+    'data/a/2.nc': 20,
+    'data/a/2020/3.nc': 30,
+    'data/b/1.nc': 1,
+    'other/1.nc': 100,
+}
+
+
+def fake_list_objects_v2(keys, page_size=2):
+    def list_objects_v2(Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        entries = []
+        for key in sorted(keys):
+            if not key.startswith(Prefix):
+                continue
+            index = key.find(Delimiter, len(Prefix)) if Delimiter else -1
+            entry = ('prefix', key[:index + 1]) if index >= 0 else ('key', key)
+            if entry not in entries:
+                entries.append(entry)
+        start = int(ContinuationToken or 0)
+        page = entries[start:start + page_size]
+        rsp = {
+            'Contents': [{'Key': value, 'Size': keys.get(value)} for kind, value in page if kind == 'key'],
+            'CommonPrefixes': [{'Prefix': value} for kind, value in page if kind == 'prefix'],
+            'IsTruncated': start + page_size < len(entries)
+        }
+        if rsp.get('IsTruncated'):
+            rsp.update({'NextContinuationToken': str(start + page_size)})
+        return rsp
+
+    return list_objects_v2
+
+
+def fake_inventory_client(rows):
+    data = io.StringIO()
+    csv.writer(data).writerows(rows)
+    inventory = gzip.compress(data.getvalue().encode('utf-8'))
+    manifest = {
+        'sourceBucket': 'bucket',
+        'fileFormat': 'CSV',
+        'fileSchema': 'Bucket, Key, Size, IsLatest, IsDeleteMarker',
+        'destinationBucket': 'arn:aws:s3:::inventory-bucket',
+        'files': [{'key': 'inventory/data/1.csv.gz'}, {'key': 'inventory/data/2.csv.gz'}]
+    }
+
+    def get_object(Bucket, Key):
+        body = json.dumps(manifest).encode('utf-8') if Key.endswith('manifest.json') else inventory
+        return {'Body': io.BytesIO(body)}
+
+    client = MagicMock()
+    client.get_object.side_effect = get_object
+    return client
+
+
+class TestGetStatusHelpers(unittest.TestCase):
+    def test_list_objects(self):
+        client = MagicMock()
+        client.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        self.assertEqual(GetStatusHelpers.list_objects(client, 'bucket', 'data/'), (5, 66, []))
+        self.assertEqual(
+            GetStatusHelpers.list_objects(client, 'bucket', 'data/', '/'), (1, 5, ['data/a/', 'data/b/'])
+        )
+
+    def test_get_s3_prefix_stats(self):
+        client = MagicMock()
+        client.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        for workers in (1, 8):
+            stats = GetStatusHelpers.get_s3_prefix_stats('bucket', 'data', workers=workers, s3_client=client)
+            self.assertEqual(stats, {
+                'data/': {'count': 1, 'bytes': 5},
+                'data/a/': {'count': 3, 'bytes': 60},
+                'data/b/': {'count': 1, 'bytes': 1}
+            })
+
+    def test_get_s3_prefix_stats_empty_prefix(self):
+        client = MagicMock()
+        client.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        stats = GetStatusHelpers.get_s3_prefix_stats('bucket', 'missing', s3_client=client)
+        self.assertEqual(stats, {'missing/': {'count': 0, 'bytes': 0}})
+
+    @patch('pylot.plugins.helpers.get_status_helpers.get_client')
+    def test_get_s3_count(self, mock_get_client):
+        mock_get_client.return_value.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        self.assertEqual(GetStatusHelpers.get_s3_count('bucket', 'data/'), 5)
+
+    def test_get_s3_inventory_stats(self):
+        client = fake_inventory_client([
+            ['bucket', 'data/readme.txt', '5', 'true', 'false'],
+            ['bucket', 'data/a/file+1.nc', '10', 'true', 'false'],
+            ['bucket', 'data/a/old.nc', '10', 'false', 'false'],
+            ['bucket', 'data/a/deleted.nc', '', 'true', 'true'],
+            ['bucket', 'other/1.nc', '100', 'true', 'false'],
+        ])
+        stats = GetStatusHelpers.get_s3_prefix_stats(
+            'bucket', 'data/', inventory_manifest='s3://inventory-bucket/inventory/manifest.json', s3_client=client
+        )
+        self.assertEqual(stats, {'data/': {'count': 2, 'bytes': 10}, 'data/a/': {'count': 2, 'bytes': 20}})
+        with self.assertRaises(ValueError):
+            GetStatusHelpers.get_s3_prefix_stats(
+                'other-bucket', 'data/', inventory_manifest='s3://inventory-bucket/inventory/manifest.json',
+                s3_client=client
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
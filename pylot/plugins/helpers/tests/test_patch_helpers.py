@@ -0,0 +1,50 @@
+import unittest
+
+from pylot.plugins.helpers.patch_helpers import PatchPlan
+
+
+class TestPatchHelpers(unittest.TestCase):
+    def test_compile(self):
+        plan = PatchPlan({'a': 1, 'b': {'c': 2, 'd': {}}, 'e': [1]})
+        self.assertEqual(plan.top_level, {'a': 1})
+        self.assertEqual([(parents, key) for parents, key, _ in plan.nested], [(('b',), 'c'), (('b',), 'd')])
+        self.assertEqual(plan.mutable, [((), 'e', [1])])
+
+    def test_apply_deep_merge(self):
+        record = {'a': 0, 'b': {'c': 0, 'keep': 1}, 'd': 'not a dict', 'f': {'g': 1}}
+        update = {'a': 1, 'b': {'c': 2}, 'd': {'e': 3}, 'f': {}, 'h': {'i': None}}
+        PatchPlan(update).apply(record)
+        self.assertEqual(record, {
+            'a': 1, 'b': {'c': 2, 'keep': 1}, 'd': {'e': 3}, 'f': {'g': 1}, 'h': {'i': None}
+        })
+
+    def test_lists_not_shared(self):
+        plan = PatchPlan({'files': [{'name': 'a'}]})
+        first, second = plan.stream([{}, {}])
+        first['files'].append({'name': 'b'})
+        self.assertEqual(second, {'files': [{'name': 'a'}]})
+
+    def test_string_fields(self):
+        plan = PatchPlan({}, string_fields=('productVolume',))
+        records = list(plan.stream([{'productVolume': 1}, {'productVolume': '2'}, {'collectionId': 'c'}]))
+        self.assertEqual(records, [{'productVolume': '1'}, {'productVolume': '2'}, {'collectionId': 'c'}])
+
+    def test_stream_is_lazy(self):
+        def records():
+            yield {'a': 0}
+            raise AssertionError('Consumed too far')
+
+        self.assertEqual(next(PatchPlan({'a': 1}).stream(records())), {'a': 1})
+
+    def test_changed_fields(self):
+        plan = PatchPlan({'status': 'completed', 'published': True, 'execution': {'name': 'b'}, 'meta': {}})
+        record = {'status': 'completed', 'published': 1, 'execution': {'name': 'a'}, 'meta': {'x': 1}}
+        self.assertEqual(plan.changed_fields(record), ['published', 'execution'])
+        self.assertEqual(plan.changed_fields({'status': 'completed', 'published': True, 'execution': {'name': 'b'},
+                                              'meta': {}}), [])
+
+    def test_diff(self):
+        plan = PatchPlan({'status': 'completed', 'execution': {'name': 'b'}}, string_fields=('productVolume',))
+        record = {'status': 'completed', 'execution': {'name': 'a', 'arn': 'arn'}, 'productVolume': 1}
+        self.assertEqual(plan.diff(record), {'execution': {'name': 'b', 'arn': 'arn'}})
+        self.assertEqual(record, {'status': 'completed', 'execution': {'name': 'a', 'arn': 'arn'}, 'productVolume': 1})
@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from pylot.plugins.helpers.plan_helpers import ThroughputHistory, format_duration
+
+
+class TestPlanHelpers(unittest.TestCase):
+    def test_format_duration(self):
+        self.assertEqual(format_duration(5.4), '5s')
+        self.assertEqual(format_duration(125), '2m 5s')
+        self.assertEqual(format_duration(3605), '1h 0m 5s')
+
+    def test_record_and_estimate(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = ThroughputHistory(os.path.join(temp_dir, 'history', 'throughput.json'), samples=2)
+            self.assertEqual(history.throughput('update_granule'), (None, 0))
+            self.assertEqual(history.estimate('update_granule', 10), 'unknown, no recorded update_granule runs yet')
+            history.record('update_granule', 100, 100)
+            history.record('update_granule', 0, 10)
+            history.record('update_granule', 100, 10)
+            history.record('update_granule', 100, 5)
+            self.assertEqual(history.throughput('update_granule'), (15.0, 2))
+            self.assertEqual(history.estimate('update_granule', 150), '10s at 15.0 records/s (median of 2 runs)')
+
+    def test_bytes_per_record(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = ThroughputHistory(os.path.join(temp_dir, 'throughput.json'))
+            history.record('query_granule', 10, 1)
+            self.assertIsNone(history.bytes_per_record('query_granule'))
+            history.record('query_granule', 10, 1, 2048)
+            self.assertEqual(history.bytes_per_record('query_granule'), 204.8)
+
+    def test_unreadable_history(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = ThroughputHistory(os.path.join(temp_dir, 'throughput.json'))
+            with open(history.path, 'w+', encoding='utf-8') as history_file:
+                history_file.write('{')
+            self.assertEqual(history.load(), {})
@@ -0,0 +1,111 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+from pylot.plugins.helpers.s3_helpers import S3RangeReader, open_s3_object, copy_s3_object, download_s3_object, \
+    get_s3_etag
+
+
+def fake_s3_client(data):
+    """
+    MagicMock S3 client serving data for head_object and ranged or whole get_object requests.
+    """
+    def get_object(Bucket, Key, Range=None):
+        if Range:
+            start, end = (int(x) for x in Range.split('=')[-1].split('-'))
+            return {'Body': io.BytesIO(data[start:end + 1])}
+        return {'Body': io.BytesIO(data)}
+
+    client = MagicMock()
+    client.head_object.return_value = {'ContentLength': len(data)}
+    client.get_object.side_effect = get_object
+    return client
+
+
+class TestS3Helpers(unittest.TestCase):
+    def test_range_reader(self):
+        data = bytes(range(256)) * 40
+        client = fake_s3_client(data)
+        with S3RangeReader('bucket', 'key', client, len(data), part_size=1000, concurrency=3) as reader:
+            chunks = []
+            while True:
+                chunk = reader.read(777)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        self.assertEqual(b''.join(chunks), data)
+        self.assertEqual(client.get_object.call_count, 11)
+
+    def test_get_s3_etag(self):
+        client = MagicMock()
+        client.head_object.return_value = {'ETag': '"abc"'}
+        self.assertEqual(get_s3_etag('bucket', 'key', client), '"abc"')
+        client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        self.assertIsNone(get_s3_etag('bucket', 'key', client))
+        client.head_object.side_effect = ClientError({'Error': {'Code': '403'}}, 'HeadObject')
+        with self.assertRaises(ClientError):
+            get_s3_etag('bucket', 'key', client)
+
+    def test_range_reader_read_all(self):
+        data = b'x' * 2500
+        reader = S3RangeReader('bucket', 'key', fake_s3_client(data), len(data), part_size=1000, concurrency=2)
+        self.assertEqual(reader.read(), data)
+        reader.close()
+
+    def test_open_s3_object_small(self):
+        client = fake_s3_client(b'[1, 2]')
+        body = open_s3_object('bucket', 'key', client)
+        self.assertEqual(body.read(), b'[1, 2]')
+        self.assertNotIn('Range', client.get_object.call_args.kwargs)
+
+    def test_open_s3_object_large(self):
+        body = open_s3_object('bucket', 'key', fake_s3_client(b'x' * 10), part_size=4)
+        self.assertIsInstance(body, S3RangeReader)
+        self.assertEqual(body.read(), b'x' * 10)
+
+    def test_copy_s3_object(self):
+        destination = io.BytesIO()
+        copy_s3_object('bucket', 'key', destination, fake_s3_client(b'[{"a": 1}]'))
+        self.assertEqual(destination.getvalue(), b'[{"a": 1}]')
+
+    def test_download_s3_object(self):
+        data = os.urandom(10000)
+        client = fake_s3_client(data)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'results.json')
+            stats = download_s3_object('bucket', 'key', filename, client, part_size=1024, concurrency=4)
+            with open(filename, 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), data)
+        self.assertEqual(stats.get('bytes'), 10000)
+        self.assertEqual(client.get_object.call_count, 10)
+
+    @patch('pylot.plugins.helpers.s3_helpers.time.sleep')
+    def test_download_s3_object_retries_part(self, mock_sleep):
+        data = b'x' * 3000
+        client = fake_s3_client(data)
+        get_object = client.get_object.side_effect
+        failed = []
+
+        def flaky_get_object(**kwargs):
+            if kwargs.get('Range') == 'bytes=1000-1999' and not failed:
+                failed.append(kwargs.get('Range'))
+                raise ConnectionError('reset')
+            return get_object(**kwargs)
+
+        client.get_object.side_effect = flaky_get_object
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'results.json')
+            stats = download_s3_object('bucket', 'key', filename, client, part_size=1000, concurrency=2)
+            with open(filename, 'rb') as downloaded:
+                self.assertEqual(downloaded.read(), data)
+        self.assertEqual(stats.get('retries'), 1)
+
+    def test_download_empty_s3_object(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, 'results.json')
+            download_s3_object('bucket', 'key', filename, fake_s3_client(b''))
+            self.assertEqual(os.path.getsize(filename), 0)
@@ -0,0 +1,61 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+
+from pylot.plugins.helpers.stream_helpers import JsonStreamWriter, RecentKeys, open_output, iter_json_array
+
+
+class TestStreamHelpers(unittest.TestCase):
+    def test_json_array_matches_json_dumps(self):
+        records = [{'granuleId': 'a', 'files': [{'key': 'x'}]}, {'granuleId': 'b', 'status': 'completed'}]
+        writer = JsonStreamWriter(io.StringIO())
+        writer.write(records[:1])
+        writer.write(records[1:])
+        writer.close()
+        self.assertEqual(writer.file.getvalue(), f'{json.dumps(records, indent=2, sort_keys=True)}\n')
+        self.assertEqual(writer.count, 2)
+
+    def test_empty_json_array(self):
+        writer = JsonStreamWriter(io.StringIO())
+        writer.close()
+        self.assertEqual(json.loads(writer.file.getvalue()), [])
+
+    def test_json_lines(self):
+        writer = JsonStreamWriter(io.StringIO(), json_lines=True)
+        writer.write([{'a': 1}, {'b': 2}])
+        writer.close()
+        self.assertEqual(writer.file.getvalue(), '{"a": 1}\n{"b": 2}\n')
+
+    def test_open_output(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output = os.path.join(temp_dir, 'results.json')
+            with open_output(output) as outfile:
+                JsonStreamWriter(outfile).close()
+            with open(output, 'r', encoding='utf-8') as infile:
+                self.assertEqual(json.load(infile), [])
+
+    def test_iter_json_array(self):
+        records = [{'granuleId': 'é', 'files': [{'size': 10}]}, -1.5e10, 'a],"b', [], None, 12345]
+        text = json.dumps(records, indent=2, ensure_ascii=False)
+        for chunk_size in (1, 2, 7, 1 << 20):
+            self.assertEqual(list(iter_json_array(io.StringIO(text), chunk_size)), records)
+            self.assertEqual(list(iter_json_array(io.BytesIO(text.encode('utf-8')), chunk_size)), records)
+
+    def test_iter_json_array_is_lazy(self):
+        records = iter_json_array(io.StringIO('[{"a": 1}, {"b": 2}, not json'), chunk_size=4)
+        self.assertEqual(next(records), {'a': 1})
+        self.assertEqual(next(records), {'b': 2})
+        with self.assertRaises(ValueError):
+            next(records)
+
+    def test_iter_json_array_invalid(self):
+        for text in ('', '{}', '[1,', '[1 2]', '[1,]'):
+            with self.assertRaises(ValueError):
+                list(iter_json_array(io.StringIO(text)))
+
+    def test_recent_keys(self):
+        seen = RecentKeys(maxlen=2)
+        self.assertEqual([seen.add(key) for key in ('a', 'b', 'a', 'c', 'a')], [True, True, False, True, True])
+        self.assertEqual(len(seen.keys), 2)
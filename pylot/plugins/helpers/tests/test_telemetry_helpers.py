@@ -0,0 +1,119 @@
+import io
+import json
+import os
+import socket
+import tempfile
+import unittest
+
+import boto3
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from pylot.plugins.helpers.bulk_helpers import BulkResult
+from pylot.plugins.helpers.telemetry_helpers import InstrumentedProxy, Telemetry, body_length, instrument_boto3_client
+
+
+class TestTelemetryHelpers(unittest.TestCase):
+    def setUp(self):
+        self.telemetry = Telemetry()
+
+    def test_record_and_snapshot(self):
+        for latency in range(1, 101):
+            self.telemetry.record('s3.GetObject', latency / 1000, transferred_bytes=10)
+        self.telemetry.record('s3.GetObject', 0.5, error=True, retries=2)
+        self.telemetry.increment('records_processed', 5)
+        self.telemetry.increment('records_processed', 0)
+        snapshot = self.telemetry.snapshot()
+        stats = snapshot.get('calls').get('s3.GetObject')
+        self.assertEqual((stats.get('count'), stats.get('errors'), stats.get('retries'), stats.get('bytes')),
+                         (101, 1, 2, 1000))
+        self.assertEqual(stats.get('latency_ms').get('p50'), 51)
+        self.assertEqual(stats.get('latency_ms').get('max'), 500)
+        self.assertEqual(snapshot.get('counters'), {'records_processed': 5})
+
+    def test_instrument(self):
+        function = self.telemetry.instrument('cumulus_api.get_granule', lambda x: x, is_error=lambda x: x == 'bad')
+        function('good')
+        function('bad')
+        failing = self.telemetry.instrument('cumulus_api.get_granule', lambda: 1 / 0)
+        with self.assertRaises(ZeroDivisionError):
+            failing()
+        stats = self.telemetry.snapshot().get('calls').get('cumulus_api.get_granule')
+        self.assertEqual((stats.get('count'), stats.get('errors')), (3, 2))
+
+    def test_record_result(self):
+        self.telemetry.record_result('CMR removal', BulkResult(succeeded=3, failed=1))
+        self.assertEqual(self.telemetry.counters, {'cmr_removal_succeeded': 3, 'cmr_removal_failed': 1})
+
+    def test_instrumented_proxy(self):
+        class Api:
+            TOKEN = 'old'
+
+            def update_granule(self, data):
+                return {'statusCode': 500, 'error': 'Server Error'} if data.get('fail') else {}
+
+        api = Api()
+        proxy = InstrumentedProxy(api, 'cumulus_api', self.telemetry)
+        proxy.update_granule({})
+        proxy.update_granule({'fail': True})
+        proxy.TOKEN = 'new'
+        self.assertEqual((api.TOKEN, proxy.TOKEN), ('new', 'new'))
+        stats = self.telemetry.snapshot().get('calls').get('cumulus_api.update_granule')
+        self.assertEqual((stats.get('count'), stats.get('errors')), (2, 1))
+
+    def test_instrument_boto3_client(self):
+        client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='a', aws_secret_access_key='b')
+        instrument_boto3_client(client, self.telemetry)
+        with Stubber(client) as stubber:
+            stubber.add_response('get_object', {'ContentLength': 1024}, {'Bucket': 'bucket', 'Key': 'key'})
+            stubber.add_client_error('get_object', http_status_code=404)
+            client.get_object(Bucket='bucket', Key='key')
+            with self.assertRaises(ClientError):
+                client.get_object(Bucket='bucket', Key='key')
+        stats = self.telemetry.snapshot().get('calls').get('s3.GetObject')
+        self.assertEqual((stats.get('count'), stats.get('errors'), stats.get('bytes')), (2, 1, 1024))
+
+    def test_body_length(self):
+        body = io.BytesIO(b'12345')
+        body.read(2)
+        self.assertEqual(body_length(body), 3)
+        self.assertEqual(body.read(), b'345')
+        self.assertEqual(body_length(b'12'), 2)
+        self.assertEqual(body_length(None), 0)
+
+    def test_write_sinks(self):
+        self.telemetry.configure('opensearch')
+        self.telemetry.record('lambda.Invoke', 0.25)
+        self.telemetry.increment('update_granule_succeeded', 2)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.telemetry.metrics_file = os.path.join(temp_dir, 'metrics', 'opensearch.json')
+            self.telemetry.prometheus_file = os.path.join(temp_dir, 'pylot.prom')
+            stream = io.StringIO()
+            self.telemetry.finish(stream)
+            with open(self.telemetry.metrics_file, 'r', encoding='utf-8') as metrics_file:
+                metrics = json.load(metrics_file)
+            with open(self.telemetry.prometheus_file, 'r', encoding='utf-8') as prometheus_file:
+                prometheus = prometheus_file.read()
+        self.assertEqual(metrics.get('command'), 'opensearch')
+        self.assertEqual(metrics.get('calls').get('lambda.Invoke').get('latency_ms').get('p99'), 250)
+        self.assertIn('pylot_call_latency_seconds{command="opensearch",call="lambda.Invoke",quantile="0.95"} 0.25',
+                      prometheus)
+        self.assertIn('pylot_call_latency_seconds_count{command="opensearch",call="lambda.Invoke"} 1', prometheus)
+        self.assertIn('pylot_update_granule_succeeded_total{command="opensearch"} 2', prometheus)
+        self.assertIn('lambda.Invoke: 1 calls, 0 errors, 0 retries (latency p50 250ms, p95 250ms, p99 250ms)',
+                      stream.getvalue())
+
+    def test_finish_without_calls(self):
+        stream = io.StringIO()
+        self.telemetry.finish(stream)
+        self.assertEqual(stream.getvalue(), '')
+
+    def test_statsd(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as server:
+            server.bind(('127.0.0.1', 0))
+            server.settimeout(5)
+            self.telemetry.configure('opensearch', statsd=f'127.0.0.1:{server.getsockname()[1]}')
+            self.telemetry.record('lambda.Invoke', 0.25, error=True)
+            self.assertEqual(server.recv(1024).decode('utf-8').splitlines(),
+                             ['pylot.lambda.Invoke:250.000|ms', 'pylot.lambda.Invoke.errors:1|c'])
+            self.telemetry.statsd_socket.close()
@@ -0,0 +1,90 @@
+import base64
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+from pylot.plugins.helpers.token_helpers import TOKEN_LIFETIME, TokenCache, TokenRefresher, get_token_expiry, \
+    set_token
+
+
+def make_jwt(expiry):
+    payload = base64.urlsafe_b64encode(json.dumps({'exp': expiry}).encode('utf-8')).decode('utf-8').rstrip('=')
+    return f'header.{payload}.signature'
+
+
+class TestTokenHelpers(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache = TokenCache(os.path.join(self.temp_dir.name, 'pylot_token', 'token.json'))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_token_expiry(self):
+        self.assertEqual(get_token_expiry(make_jwt(1234567890)), 1234567890)
+        self.assertEqual(get_token_expiry('not-a-jwt', issued=100), 100 + TOKEN_LIFETIME)
+        self.assertEqual(get_token_expiry(None, issued=100), 100 + TOKEN_LIFETIME)
+
+    def test_get_token_reuses_valid_token(self):
+        generate = MagicMock(return_value='first')
+        self.assertEqual(self.cache.get_token(generate).get('token'), 'first')
+        self.assertEqual(self.cache.get_token(generate).get('token'), 'first')
+        generate.assert_called_once()
+        self.assertEqual(stat.S_IMODE(os.stat(self.cache.path).st_mode), 0o600)
+
+    def test_get_token_renews_expiring_token(self):
+        self.cache.save(make_jwt(time.time() + 60))
+        entry = self.cache.get_token(MagicMock(return_value='renewed'), margin=300)
+        self.assertEqual(entry.get('token'), 'renewed')
+        self.assertEqual(self.cache.load().get('token'), 'renewed')
+
+    def test_get_token_generates_once_across_threads(self):
+        generate = MagicMock(side_effect=lambda: time.sleep(0.05) or 'token')
+        threads = [threading.Thread(target=self.cache.get_token, args=(generate,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        generate.assert_called_once()
+
+    def test_load_ignores_corrupt_cache(self):
+        os.makedirs(os.path.dirname(self.cache.path), exist_ok=True)
+        with open(self.cache.path, 'w', encoding='utf-8') as cache_file:
+            cache_file.write('{"tok')
+        self.assertEqual(self.cache.load(), {})
+
+    def test_set_token(self):
+        cml = MagicMock()
+        cml.HEADERS = {'Authorization': 'Bearer old', 'Content-Type': 'application/json'}
+        set_token(cml, 'new')
+        self.assertEqual(cml.TOKEN, 'new')
+        self.assertEqual(cml.HEADERS, {'Authorization': 'Bearer new', 'Content-Type': 'application/json'})
+
+    def test_token_refresher(self):
+        self.cache.save(make_jwt(time.time() + 1))
+        refreshed = threading.Event()
+
+        def generate():
+            refreshed.set()
+            return make_jwt(time.time() + 3600)
+
+        cml = MagicMock()
+        cml.HEADERS = {}
+        refresher = TokenRefresher(self.cache, generate, margin=0.5)
+        refresher.register(cml, self.cache.load().get('expires'))
+        self.assertTrue(refreshed.wait(5))
+        for _ in range(50):
+            if cml.TOKEN == self.cache.load().get('token'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(cml.TOKEN, self.cache.load().get('token'))
+        self.assertGreater(refresher.expires, time.time() + 3000)
+
+
+if __name__ == '__main__':
+    unittest.main()
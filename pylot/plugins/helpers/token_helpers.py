@@ -0,0 +1,167 @@
+import base64
+import json
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from json import JSONDecodeError
+from tempfile import gettempdir
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+
+TOKEN_LIFETIME = 3600
+REFRESH_MARGIN = 300
+RETRY_INTERVAL = 60
+
+
+def get_token_expiry(token, issued=None):
+    """
+    Determines when a token expires from the exp claim of a JWT, or one TOKEN_LIFETIME after it was issued if the
+    token is not a JWT.
+    :param token: the token
+    :param issued: epoch seconds the token was issued at. Defaults to now.
+    :return: expiry time in epoch seconds
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        expiry = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if isinstance(expiry, (int, float)):
+            return float(expiry)
+    except (AttributeError, IndexError, TypeError, ValueError):
+        pass
+
+    return (issued or time.time()) + TOKEN_LIFETIME
+
+
+class TokenCache:
+    """
+    Token file shared by every PyLOT process on a host. Reads and renewals happen under an exclusive file lock so
+    concurrent processes generate at most one new token between them, and the file is replaced atomically so a reader
+    never sees a partially written token.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: location of the cache file. Defaults to <tmp>/pylot_token/token.json
+        """
+        self.path = path or os.path.join(gettempdir(), 'pylot_token', 'token.json')
+
+    @contextmanager
+    def locked(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.lock', 'a+', encoding='utf-8') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def load(self):
+        """
+        :return: dictionary of the form {'token': token, 'expires': epoch seconds} or an empty dictionary
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as cache_file:
+                entry = json.load(cache_file)
+        except (OSError, JSONDecodeError):
+            return {}
+
+        return entry if isinstance(entry, dict) and entry.get('token') else {}
+
+    def save(self, token):
+        issued = time.time()
+        entry = {'token': token, 'issued': issued, 'expires': get_token_expiry(token, issued)}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_file = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        file_descriptor = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as cache_file:
+            json.dump(entry, cache_file)
+        os.replace(temp_file, self.path)
+
+        return entry
+
+    def get_token(self, generate, margin=REFRESH_MARGIN):
+        """
+        Returns the cached token if it is valid for more than margin seconds, otherwise generates and caches a new one.
+        :param generate: called without arguments to generate a new token
+        :param margin: seconds before expiry a token is considered stale
+        :return: dictionary of the form {'token': token, 'expires': epoch seconds}. The token is None if generate
+        did not produce one.
+        """
+        with self.locked():
+            entry = self.load()
+            if entry and entry.get('expires', 0) - time.time() > margin:
+                return entry
+            token = generate()
+            if not token:
+                return {'token': None, 'expires': None}
+            print(f'Caching new token: {self.path}')
+            return self.save(token)
+
+
+def set_token(cml, token):
+    """
+    Switches a CumulusApi instance over to a new token.
+    """
+    cml.TOKEN = token
+    headers = getattr(cml, 'HEADERS', None)
+    if isinstance(headers, dict):
+        headers.update({'Authorization': f'Bearer {token}'})
+
+
+class TokenRefresher:
+    """
+    Background thread that renews the cached token margin seconds before it expires and hands the new token to every
+    registered CumulusApi instance, so long running jobs never send requests with an expired token.
+    """
+    def __init__(self, cache, generate, margin=REFRESH_MARGIN):
+        """
+        :param cache: TokenCache
+        :param generate: called without arguments to generate a new token
+        :param margin: seconds before expiry the token is renewed
+        """
+        self.cache = cache
+        self.generate = generate
+        self.margin = margin
+        self.instances: weakref.WeakSet = weakref.WeakSet()
+        self.expires = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def register(self, cml, expires):
+        with self.condition:
+            self.instances.add(cml)
+            self.expires = expires
+            if not self.thread or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='pylot-token-refresher', daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def refresh(self):
+        entry = self.cache.get_token(self.generate, self.margin)
+        if not entry.get('token'):
+            raise ValueError('No token was generated')
+        with self.condition:
+            for cml in list(self.instances):
+                set_token(cml, entry.get('token'))
+            self.expires = entry.get('expires')
+
+    def run(self):
+        while True:
+            with self.condition:
+                wait = self.expires - self.margin - time.time()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+            try:
+                self.refresh()
+            except Exception as exception:
+                print(f'Token refresh failed, retrying in {RETRY_INTERVAL}s: {exception}')
+                with self.condition:
+                    self.condition.wait(RETRY_INTERVAL)
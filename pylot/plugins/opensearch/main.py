@@ -1,10 +1,36 @@
+import concurrent.futures
+import copy
+import itertools
 import json
+import math
 import os
-import concurrent.futures
 import pathlib
+import threading
+import time
+from contextlib import closing
+from datetime import datetime, timezone
+from functools import partial
 
-import boto3
+from cumulus_api import CumulusApi
+from .. import PLUGIN_MANIFEST
+from ..helpers.aws_helpers import get_client
+from ..helpers.batch_helpers import load_batch_queries, run_batch
+from ..helpers.cache_helpers import add_cache_arguments, get_response_cache
+from ..helpers.bulk_helpers import BulkExecutor, RetryPolicy, TokenBucket, response_error, run_pipeline, \
+    write_replay_file
+from ..helpers.patch_helpers import PatchPlan
+from ..helpers.plan_helpers import ThroughputHistory, format_duration
 from ..helpers.pylot_helpers import PyLOTHelpers
+from ..helpers.s3_helpers import copy_s3_object, download_s3_object, open_s3_object
+from ..helpers.stream_helpers import JsonStreamWriter, RecentKeys, iter_json_array, open_output, results_stdout, \
+    results_to_stdout
+from ..helpers.telemetry_helpers import TELEMETRY
+
+# Fields that identify a record for the update endpoints that accept partial records
+IDENTITY_FIELDS = {'granule': ('granuleId', 'collectionId')}
+# CumulusApi functions for the Cumulus granule bulk patch endpoint, in the order they are looked for. Releases of
+# CumulusApi that predate the endpoint have none of them.
+BULK_PATCH_FUNCTIONS = ('bulk_patch_granules', 'bulk_patch')
 
 
 class OpenSearch:
@@ -16,10 +42,13 @@ class OpenSearch:
         return data
 
     def invoke_opensearch_lambda(
-            self, query_data, record_type, terminate_after, lambda_client=None, **kwargs
+            self, query_data, record_type, terminate_after, lambda_client=None, count_only=False, **kwargs
     ):
+        """
+        :param count_only: ask the lambda for the number of matching records without writing the results to S3
+        """
         if not lambda_client:
-            lambda_client = boto3.client('lambda')
+            lambda_client = get_client('lambda')
         lambda_arn = os.getenv('OPENSEARCH_LAMBDA_ARN')
         if not lambda_arn:
             raise ValueError('The ARN for the OpenSearch lambda is not defined. Provide it as an environment variable.')
@@ -31,13 +60,15 @@ class OpenSearch:
                 'record_type': str(record_type).rstrip('s'),
                 'terminate_after': int(terminate_after)}
         }
+        if count_only:
+            payload['config']['count_only'] = True
 
         print('Invoking OpenSearch lambda...')
+        # The invocation latency and payload size are recorded by the telemetry layer instead of printing the response
         rsp = lambda_client.invoke(
             FunctionName=lambda_arn,
             Payload=json.dumps(payload).encode('utf-8')
         )
-        print(rsp)
         if rsp.get('StatusCode') != 200:
             raise Exception(
                 f'The OpenSearch lambda failed. Check the Cloudwatch logs for {os.getenv("OPENSEARCH_LAMBDA_ARN")}'
@@ -45,40 +76,251 @@ class OpenSearch:
 
         return rsp
 
-    def download_file(self, bucket, key, results, s3_client=None):
+    def download_file(self, bucket, key, results, s3_client=None, part_size=8, concurrency=8):
+        """
+        :param part_size: MiB downloaded by each ranged GET
+        :param concurrency: number of parts downloaded at once
+        """
         if not s3_client:
-            s3_client = boto3.client('s3')
+            s3_client = get_client('s3', max_pool_connections=concurrency)
         print('Downloading query results...')
-        s3_client.download_file(
-            Bucket=bucket,
-            Key=key,
-            Filename=f'{os.getcwd()}/{results}'
+        download_s3_object(
+            bucket=bucket,
+            key=key,
+            filename=os.path.join(os.getcwd(), results),
+            s3_client=s3_client,
+            part_size=int(part_size * 1024 * 1024),
+            concurrency=concurrency
         )
 
-        file = f'{os.getcwd()}/{results}'
+        file = os.path.join(os.getcwd(), results)
         return file
 
 
-def query_opensearch(query_data, record_type, results='query_results.json', terminate_after=100, **kwargs):
-    open_search = OpenSearch()
+def run_opensearch_query(query_data, record_type, terminate_after, response_cache=None):
+    """
+    Invokes the OpenSearch lambda.
+    :param response_cache: ResponseCache to reuse the response of an identical earlier query from
+    :return: the lambda response containing the bucket, key and record_count of the results
+    """
+    def invoke(query_data, record_type, terminate_after):
+        rsp = OpenSearch().invoke_opensearch_lambda(query_data, record_type, terminate_after)
+        return json.loads(rsp.get('Payload').read().decode('utf-8'))
+
+    if response_cache:
+        return response_cache.call('opensearch', 'query', invoke, query_data, record_type, int(terminate_after))
+    return invoke(query_data, record_type, terminate_after)
+
+
+def load_query(query_data):
+    """
+    :param query_data: json query or the name of a file containing one
+    :return: the query as a dictionary
+    """
     if isinstance(query_data, str) and os.path.isfile(query_data):
-        query_data = open_search.read_json_file(query_data)
-    else:
-        query_data = json.loads(query_data)
+        return OpenSearch.read_json_file(query_data)
+    return json.loads(query_data)
+
+
+def count_opensearch_records(query_data, record_type, terminate_after):
+    """
+    Counts the records matching a query with a count only OpenSearch lambda invocation.
+    :return: the lambda response containing the record_count
+    """
+    rsp = OpenSearch().invoke_opensearch_lambda(query_data, record_type, terminate_after, count_only=True)
+    return json.loads(rsp.get('Payload').read().decode('utf-8'))
+
+
+def query_opensearch(query_data, record_type, results='query_results.json', terminate_after=100, download=True,
+                     part_size=8, transfer_concurrency=8, partitions=1, response_cache=None, history=None, **kwargs):
+    """
+    Runs a query through the OpenSearch lambda and retrieves the results object it writes to S3.
+    :param results: name of the local results file, or - to stream the results to stdout
+    :param download: download the results to the results file. If False the results are left in S3.
+    :param part_size: MiB downloaded by each ranged GET
+    :param transfer_concurrency: number of parts downloaded at once
+    :param partitions: split the query into this many range slices run as separate lambda invocations. See
+    query_opensearch_partitioned.
+    :param response_cache: ResponseCache to reuse the lambda response of an identical earlier query from
+    :param history: ThroughputHistory the size and duration of downloaded results are recorded in
+    :return: the lambda response containing the bucket, key and record_count of the results, and the local file if
+    the results were downloaded
+    """
+    with results_to_stdout(results == '-'):
+        open_search = OpenSearch()
+        query_data = load_query(query_data)
+
+        if int(partitions) > 1:
+            return query_opensearch_partitioned(
+                query_data, record_type, int(partitions), results=results, terminate_after=terminate_after,
+                download=download, response_cache=response_cache, **kwargs
+            )
+
+        start = time.monotonic()
+        ret_dict = run_opensearch_query(query_data, record_type, terminate_after, response_cache)
+
+        if results == '-':
+            stdout = results_stdout()
+            stdout.flush()
+            copy_s3_object(ret_dict.get('bucket'), ret_dict.get('key'), stdout.buffer)
+        elif download:
+            # Download results from S3
+            file = open_search.download_file(
+                bucket=ret_dict.get('bucket'), key=ret_dict.get('key'), results=results, part_size=part_size,
+                concurrency=transfer_concurrency
+            )
+            ret_dict.update({'file': file})
+            print(f'{ret_dict.get("record_count")} {record_type} records obtained: {file}')
+            if history:
+                history.record(
+                    f'query_{record_type}', ret_dict.get('record_count'), time.monotonic() - start, os.path.getsize(file)
+                )
+        else:
+            print(f'{ret_dict.get("record_count")} {record_type} records obtained: '
+                  f's3://{ret_dict.get("bucket")}/{ret_dict.get("key")}')
+        return ret_dict
+
+
+def parse_partition_bound(value):
+    """
+    :param value: epoch milliseconds or an ISO 8601 date or datetime. Datetimes without a timezone are taken as UTC.
+    :return: epoch milliseconds
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if str(value).lstrip('-').isdigit():
+        return int(value)
+    date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if not date.tzinfo:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def partition_queries(query_data, partitions, partition_field, partition_from, partition_to):
+    """
+    Splits a query into disjoint range slices on partition_field. The slices are cut at evenly spaced points between
+    partition_from and partition_to, the first and last slices are open ended and one extra slice matches records
+    without the field, so together the slices match exactly the records the original query matches.
+    :return: list of queries, one per slice
+    """
+    partition_from = parse_partition_bound(partition_from)
+    partition_to = parse_partition_bound(partition_to)
+    if partition_from is None:
+        raise ValueError('A lower bound for the partition field is needed to split the query: --partition-from')
+    if partition_to is None:
+        partition_to = int(time.time() * 1000)
+    if partition_to <= partition_from:
+        raise ValueError(f'The partition range is empty: {partition_from} - {partition_to}')
+
+    width = (partition_to - partition_from) / partitions
+    cuts = [int(partition_from + width * index) for index in range(1, partitions)]
+    bounds = list(zip([None] + cuts, cuts + [None]))
+    original_query = query_data.get('query', {'match_all': {}})
+    slices = []
+    for lower, upper in bounds:
+        slice_range = {}
+        if lower is not None:
+            slice_range.update({'gte': lower})
+        if upper is not None:
+            slice_range.update({'lt': upper})
+        clauses = [original_query, {'range': {partition_field: slice_range}}] if slice_range else [original_query]
+        slices.append({**query_data, 'query': {'bool': {'filter': clauses}}})
+    slices.append({**query_data, 'query': {'bool': {
+        'filter': [original_query], 'must_not': [{'exists': {'field': partition_field}}]
+    }}})
 
-    rsp = open_search.invoke_opensearch_lambda(query_data, record_type, terminate_after)
-    ret_dict = json.loads(rsp.get('Payload').read().decode('utf-8'))
+    return slices
 
-    # Download results from S3
-    file = open_search.download_file(bucket=ret_dict.get('bucket'), key=ret_dict.get('key'), results=results)
-    print(f'{ret_dict.get("record_count")} {record_type} records obtained: {os.getcwd()}/{results}')
-    return file
+
+def iter_slice_records(slices, source_only=False, stats=None, terminate_after=0):
+    """
+    Generator that streams the records of each slice's results object in turn, skipping records whose _id was already
+    yielded. A record can appear in two slices if its partition field changes while the slices are being queried.
+    Only the most recent _ids are remembered, see RecentKeys, so memory does not grow with the number of records.
+    :param slices: lambda responses of the slices
+    :param source_only: yield the _source of each record
+    :param stats: dictionary updated with the number of records read and duplicates skipped
+    :param terminate_after: stop after this many records have been yielded. Use 0 to yield all records.
+    """
+    stats = {} if stats is None else stats
+    stats.update({'read': 0, 'duplicates': 0})
+    if terminate_after:
+        # Each slice is limited by terminate_after on its own, so the merged slices can hold up to partitions times more
+        yield from itertools.islice(
+            iter_slice_records(slices, source_only=source_only, stats=stats), int(terminate_after)
+        )
+        return
+    seen = RecentKeys()
+    for query_slice in slices:
+        for record in read_s3_records(query_slice.get('bucket'), query_slice.get('key')):
+            stats['read'] += 1
+            record_id = record.get('_id')
+            if record_id is not None and not seen.add(record_id):
+                stats['duplicates'] += 1
+                continue
+            yield record.get('_source') if source_only else record
+
+
+def query_opensearch_partitioned(query_data, record_type, partitions, results='query_results.json', terminate_after=0,
+                                 download=True, partition_field='updatedAt', partition_from=None, partition_to=None,
+                                 partition_workers=8, response_cache=None, **kwargs):
+    """
+    Runs one logical query as parallel lambda invocations over disjoint range slices so no single invocation has to
+    return the whole result set. The slice results are merged into one output with duplicate _ids removed and the
+    number of records read is checked against the record_count each slice reported.
+    :param query_data: OpenSearch query
+    :param partitions: number of range slices
+    :param results: name of the local results file, or - to stream the merged results to stdout
+    :param terminate_after: limit on the number of records returned. Each slice is invoked with the limit and the
+    merged results are cut off once it is reached.
+    :param download: merge the slices into the results file. If False the slice results are left in S3 and can be
+    streamed with iter_slice_records.
+    :param partition_field: numeric or date field the slices are cut on
+    :param partition_from: lower bound of the evenly spaced cuts, epoch milliseconds or an ISO 8601 date
+    :param partition_to: upper bound of the evenly spaced cuts. Defaults to now.
+    :param partition_workers: number of lambda invocations run at once
+    :param response_cache: ResponseCache to reuse slice responses from
+    :return: dictionary with the slice responses, the combined record_count and the local file if the results were
+    merged to one
+    """
+    slice_queries = partition_queries(query_data, partitions, partition_field, partition_from, partition_to)
+    print(f'Running {len(slice_queries)} query slices on {partition_field}...')
+    get_client('lambda', max_pool_connections=partition_workers)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=partition_workers) as executor:
+        slices = list(executor.map(
+            lambda slice_query: run_opensearch_query(slice_query, record_type, terminate_after, response_cache),
+            slice_queries
+        ))
+
+    record_count = sum(int(query_slice.get('record_count') or 0) for query_slice in slices)
+    ret_dict = {'record_count': record_count, 'slices': slices, 'terminate_after': int(terminate_after)}
+    if not download and results != '-':
+        if int(terminate_after):
+            ret_dict.update({'record_count': min(record_count, int(terminate_after))})
+        print(f'{ret_dict.get("record_count")} {record_type} records obtained in {len(slices)} slices')
+        return ret_dict
+
+    stats: dict = {}
+    file = None if results == '-' else os.path.join(os.getcwd(), results)
+    with open_output(file) as outfile:
+        writer = JsonStreamWriter(outfile)
+        writer.write(iter_slice_records(slices, stats=stats, terminate_after=terminate_after))
+        writer.close()
+    if not int(terminate_after) and stats.get('read') != record_count:
+        print(f'Warning: the slices reported {record_count} records but {stats.get("read")} were read')
+    ret_dict.update({'record_count': writer.count, 'duplicates': stats.get('duplicates')})
+    if file:
+        ret_dict.update({'file': file})
+        print(f'{writer.count} {record_type} records obtained: {file} '
+              f'({stats.get("duplicates")} duplicates removed)')
+    return ret_dict
 
 
 def return_parser(subparsers):
     subparser = subparsers.add_parser(
         'opensearch',
-        help='This plugin is used to submit queries directly to OpenSearch bypassing the cumulus API.',
+        help=PLUGIN_MANIFEST.get('opensearch'),
         description='Submit queries to opensearch'
     )
     choices = ['granule', 'collection', 'provider', 'pdr', 'rule', 'logs', 'execution', 'reconciliationReport']
@@ -97,10 +339,64 @@ def return_parser(subparsers):
     )
     subparser.add_argument(
         '-r', '--results',
-        help='The name to give to the OpenSearch results file.',
+        help='The name to give to the OpenSearch results file. Use - to stream the results to stdout.',
         metavar='',
         default='query_results.json'
     )
+    subparser.add_argument(
+        '--part-size',
+        help='The size in MiB of each part of the parallel results download. Default is 8.',
+        metavar='',
+        type=float,
+        default=8
+    )
+    subparser.add_argument(
+        '--transfer-concurrency',
+        help='The number of parts of the results file downloaded at once. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '-p', '--partitions',
+        help='Split the query into this many range slices on --partition-field, run as parallel lambda invocations '
+             'and merged into one results file. Use for queries too large for a single lambda invocation. '
+             'Default is 1.',
+        metavar='',
+        type=int,
+        default=1
+    )
+    subparser.add_argument(
+        '--partition-field',
+        help='The numeric or date field the query is split on. Default is updatedAt.',
+        metavar='',
+        default='updatedAt'
+    )
+    subparser.add_argument(
+        '--partition-from',
+        help='Where the evenly spaced slices start, as epoch milliseconds or an ISO 8601 date. Records before it '
+             'are still returned by the first slice. Required with --partitions.',
+        metavar=''
+    )
+    subparser.add_argument(
+        '--partition-to',
+        help='Where the evenly spaced slices end, as epoch milliseconds or an ISO 8601 date. Records after it are '
+             'still returned by the last slice. Default is now.',
+        metavar=''
+    )
+    subparser.add_argument(
+        '--partition-workers',
+        help='The number of query slices run at once. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '-s', '--stream',
+        help='Stream the query results from S3 straight into the update and delete operations without writing a '
+             'local results file.',
+        action='store_true'
+    )
 
     group = subparser.add_mutually_exclusive_group(required=True)
     group.add_argument(
@@ -110,10 +406,38 @@ def return_parser(subparsers):
              'See: https://opensearch.org/docs/latest/opensearch/query-dsl/index/ ',
         metavar=''
     )
+    group.add_argument(
+        '--batch',
+        help='The name of a json file containing many OpenSearch queries, either an object of the form '
+             '{"<name>": <query>} or a list of queries. The queries are run concurrently and the results of each are '
+             'written to <output-dir>/<name>.json along with a manifest.json summary: <filename>.json',
+        metavar=''
+    )
+    group.add_argument(
+        '--replay',
+        help='The name of a json file of failed records written by a previous run. The records are updated or deleted '
+             'again instead of querying OpenSearch: <filename>.json',
+        metavar=''
+    )
+
+    subparser.add_argument(
+        '--batch-workers',
+        help='The number of batch queries run at once. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '--output-dir',
+        help='The directory batch query results and the batch manifest are written to. Default is batch_results.',
+        metavar='',
+        default='batch_results'
+    )
 
     subparser.add_argument(
         '-u', '--update-data',
-        help='The name of a json file containing key values pairs to update records with: <filename>.json',
+        help='The name of a json file containing key values pairs to update records with: <filename>.json. '
+             'Records that already hold the values are skipped and granules are sent with only the changed fields.',
         metavar=''
     )
 
@@ -124,15 +448,81 @@ def return_parser(subparsers):
         metavar=''
     )
 
+    subparser.add_argument(
+        '--plan',
+        help='Count the records the query matches and print the requests an update or delete would send with an '
+             'estimated duration based on previous runs, without changing any records.',
+        action='store_true'
+    )
+
     subparser.add_argument(
         '-b', '--bulk',
-        help='If True the Cumulus bulk delete endpoint will be used for delete operations',
+        help='If True the Cumulus bulk endpoints will be used for delete operations and granule updates',
         metavar='',
         default=False
     )
 
+    subparser.add_argument(
+        '--bulk-batch-size',
+        help='The maximum number of granules in each bulk delete or update request. Default is 1000.',
+        metavar='',
+        type=int,
+        default=1000
+    )
 
-def process_update_data(update_data, query_results):
+    subparser.add_argument(
+        '--poll-interval',
+        help='Seconds between checks of each bulk delete or update async operation. Default is 10.',
+        metavar='',
+        type=float,
+        default=10
+    )
+
+    subparser.add_argument(
+        '-c', '--concurrency',
+        help='The number of concurrent Cumulus API requests used for updates and deletes. Default is 10.',
+        metavar='',
+        type=int,
+        default=10
+    )
+
+    subparser.add_argument(
+        '--delete-concurrency',
+        help='The number of concurrent Cumulus API granule deletes. CMR removal uses --concurrency and each granule '
+             'is deleted as soon as it has been removed from CMR. Defaults to --concurrency.',
+        metavar='',
+        type=int,
+        default=None
+    )
+
+    subparser.add_argument(
+        '--rate-limit',
+        help='The maximum number of Cumulus API requests per second used for updates and deletes. '
+             'Default is no limit.',
+        metavar='',
+        type=float,
+        default=None
+    )
+
+    subparser.add_argument(
+        '--max-retries',
+        help='The number of times a throttled or failed Cumulus API request is retried. Default is 5.',
+        metavar='',
+        type=int,
+        default=5
+    )
+
+    add_cache_arguments(subparser)
+
+    subparser.add_argument(
+        '--failed-records',
+        help='The name of the json file failed records are written to. Default is failed_records.json',
+        metavar='',
+        default='failed_records.json'
+    )
+
+
+def load_patch_plan(update_data):
     if not os.path.isfile(update_data):
         update_data = f'{pathlib.Path(__file__).parent.resolve()}/{update_data}'
 
@@ -140,25 +530,71 @@ def process_update_data(update_data, query_results):
     with open(update_data, 'r', encoding='utf-8') as json_file:
         update_dict = json.load(json_file)
 
-    for record in query_results:
-        update_dictionary(record, update_dict)
-        if not isinstance(record.get('productVolume'), str):
-            record.update({'productVolume': str(record.get('productVolume'))})
+    return PatchPlan(update_dict, string_fields=('productVolume',))
+
 
-    return query_results
+def process_update_data(update_data, query_results):
+    # The update is compiled once and applied lazily as the records are consumed
+    return load_patch_plan(update_data).stream(query_results)
 
 
 def update_dictionary(results_dict, update_dict):
-    for k, v in update_dict.items():
-        if isinstance(v, dict):
-            results_dict[k] = update_dictionary(update_dict.get(k, {}), v)
-        else:
-            results_dict[k] = v
+    """
+    Deep merges update_dict into results_dict in place, keeping nested fields the update does not mention.
+    :return: results_dict
+    """
+    return PatchPlan(update_dict).apply(results_dict)
+
+
+def chunk_granule_ids(query_results, batch_size):
+    """
+    Generator that groups the granule IDs of the query results into chunks of at most batch_size IDs.
+    """
+    granule_ids = (granule.get('granuleId') for granule in query_results)
+    for index in itertools.count():
+        ids = list(itertools.islice(granule_ids, batch_size))
+        if not ids:
+            return
+        yield {'chunk': index, 'ids': ids}
 
-    return results_dict
 
+def wait_for_async_operation(cml, async_operation_id, poll_interval=10, timeout=3600):
+    """
+    Polls a Cumulus async operation until it is no longer running.
+    :return: the async operation, or an error response if it failed, could not be retrieved or did not finish within
+    timeout seconds
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        rsp = cml.get_async_operation(async_operation_id)
+        if response_error(rsp):
+            return rsp
+        status = rsp.get('status')
+        if status == 'SUCCEEDED':
+            return rsp
+        if status != 'RUNNING':
+            return {'error': status, 'message': rsp.get('output', '')}
+        if time.monotonic() >= deadline:
+            return {'error': 'Timeout', 'message': f'{async_operation_id} was still RUNNING after {timeout}s'}
+        time.sleep(poll_interval)
 
-def bulk_delete_cumulus(delete_file, query_results):
+
+def bulk_delete_cumulus(delete_file, query_results, batch_size=1000, executor=None, poll_executor=None,
+                        poll_interval=10, poll_timeout=3600, history=None):
+    """
+    Deletes granules with the Cumulus bulk delete endpoint. The granule IDs are split into chunks of batch_size that
+    are submitted concurrently, and each chunk's async operation is polled as soon as it has been submitted so
+    submission and completion overlap.
+    :param delete_file: json file containing the bulk delete definition the chunk IDs are added to
+    :param query_results: iterable of granule records
+    :param batch_size: maximum number of granule IDs per bulk delete request
+    :param executor: BulkExecutor used to submit the chunks
+    :param poll_executor: BulkExecutor used to poll the async operations
+    :param poll_interval: seconds between polls of an async operation
+    :param poll_timeout: seconds an async operation may run before its chunk is reported as failed
+    :param history: ThroughputHistory the granules per second are recorded in
+    :return: BulkResult failures with one entry per granule of each failed chunk
+    """
     cml = PyLOTHelpers().get_cumulus_api_instance()
     if not os.path.isfile(delete_file):
         delete_file = f'{pathlib.Path(__file__).parent.resolve()}/{delete_file}'
@@ -166,82 +602,438 @@ def bulk_delete_cumulus(delete_file, query_results):
     with open(delete_file, 'r+', encoding='utf-8') as delete_definition:
         delete_config = json.load(delete_definition)
 
-    id_array = []
-    for granule in query_results:
-        granule_id = granule.get('granuleId')
-        id_array.append(granule_id)
-    print('Adding granule IDs to delete request...')
-    delete_config.update({'ids': id_array})
+    # Sizes of the submitted chunks, list.append is thread safe
+    submitted = []
 
-    # Execute bulk delete
-    print('Submitting bulk delete request...')
-    rsp = cml.bulk_delete(delete_config)
-    print(f'Check bulk delete status using: pylot cumulus_api get async_operation {rsp.get("id")}')
+    def submit_chunk(chunk):
+        submitted.append(len(chunk.get('ids')))
+        rsp = cml.bulk_delete({**delete_config, 'ids': chunk.get('ids')})
+        if not response_error(rsp):
+            chunk.update({'asyncOperationId': rsp.get('id')})
+        return rsp
 
+    def poll_chunk(chunk):
+        return wait_for_async_operation(cml, chunk.get('asyncOperationId'), poll_interval, poll_timeout)
 
-def thread_function(function, records):
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for record in records:
-            futures.append(executor.submit(function, record))
-        for future in concurrent.futures.as_completed(futures):
-            print(future.result())
+    print(f'Submitting bulk delete requests of up to {batch_size} granules...')
+    stage_results = run_pipeline([
+        ('Bulk delete submission', submit_chunk, executor or BulkExecutor(progress_interval=100)),
+        ('Bulk delete completion', poll_chunk, poll_executor or BulkExecutor(progress_interval=100))
+    ], chunk_granule_ids(query_results, batch_size))
 
+    failures = []
+    for failure in report_chunk_failures(
+            stage_results, lambda chunk: f'{len(chunk.get("ids"))} granules {chunk.get("ids")[0]} - {chunk.get("ids")[-1]}'
+    ):
+        failures.extend(
+            {'record': {'granuleId': granule_id}, 'error': failure.get('error')}
+            for granule_id in failure.get('record').get('ids')
+        )
+    if history:
+        history.record('bulk_delete_granule', sum(submitted), max(result.elapsed for _, result in stage_results))
+    print('Bulk delete complete\n')
 
-def delete_cumulus(query_results):
-    cml = PyLOTHelpers().get_cumulus_api_instance()
+    return failures
 
-    records_to_update = []
+
+def report_chunk_failures(stage_results, describe_chunk):
+    """
+    Prints the summary of each stage of a bulk pipeline, records it in the telemetry and prints each failed chunk.
+    :param stage_results: list of (name, BulkResult) tuples returned by run_pipeline
+    :param describe_chunk: function returning a description of the granules in a chunk
+    :return: the failures of every stage
+    """
+    failures = []
+    for name, result in stage_results:
+        print(f'{name}: {result.summary()}')
+        TELEMETRY.record_result(name, result)
+        for failure in result.failures:
+            chunk = failure.get('record')
+            print(f'Failed chunk {chunk.get("chunk")} ({describe_chunk(chunk)}, async operation '
+                  f'{chunk.get("asyncOperationId")}): {failure.get("error")}')
+            failures.append(failure)
+
+    return failures
+
+
+def chunk_granule_updates(query_results, patch_plan, batch_size, stats):
+    """
+    Generator that groups the granules the update would change by the set of fields that change, yielding chunks of at
+    most batch_size granules that share the same fields. Granules that would not change are counted in stats.
+    """
+    groups: dict = {}
+    chunks = itertools.count()
     for record in query_results:
-        product_volume = record.get('productVolume', '')
-        if not isinstance(product_volume, str):
-            record.update({'product_volume': str(product_volume)})
-            records_to_update.append(record)
+        fields = tuple(patch_plan.changed_fields(record))
+        if not fields:
+            stats['skipped'] += 1
+            continue
+        group = groups.setdefault(fields, [])
+        group.append(record)
+        if len(group) >= batch_size:
+            yield {'chunk': next(chunks), 'fields': list(fields), 'records': groups.pop(fields)}
+
+    for fields, group in groups.items():
+        yield {'chunk': next(chunks), 'fields': list(fields), 'records': group}
+
+
+def get_bulk_patch_function_name():
+    """
+    Looks the granule bulk patch function up on the CumulusApi class rather than on an instance, so only functions the
+    installed release actually defines are found.
+    :return: name of the CumulusApi granule bulk patch function
+    :raises ValueError: if the installed CumulusApi has no granule bulk patch function
+    """
+    name = next((name for name in BULK_PATCH_FUNCTIONS if callable(getattr(CumulusApi, name, None))), None)
+    if not name:
+        raise ValueError(
+            f'The installed CumulusApi has no granule bulk patch function ({", ".join(BULK_PATCH_FUNCTIONS)}) so '
+            f'granules can not be updated with --bulk. Upgrade cumulus-api or run the update without --bulk.'
+        )
+    return name
+
+
+def bulk_update_cumulus(query_results, patch_plan, batch_size=1000, executor=None, poll_executor=None,
+                        poll_interval=10, poll_timeout=3600, history=None):
+    """
+    Updates granules with the Cumulus granule bulk patch endpoint. Granules are grouped into chunks of batch_size that
+    change the same fields, the chunks are submitted concurrently and any async operation they start is polled as soon
+    as the chunk has been submitted. Granules of chunks the bulk endpoint rejects are retried one record at a time.
+    Raises a ValueError if the installed CumulusApi has no bulk patch function, see get_bulk_patch_function_name.
+    :param query_results: iterable of granule records
+    :param patch_plan: PatchPlan of the update
+    :param batch_size: maximum number of granules per bulk request
+    :param executor: BulkExecutor used to submit the chunks and for per record updates
+    :param poll_executor: BulkExecutor used to poll the async operations
+    :param poll_interval: seconds between polls of an async operation
+    :param poll_timeout: seconds an async operation may run before its chunk is reported as failed
+    :param history: ThroughputHistory the granules per second are recorded in
+    :return: BulkResult failures of the per record updates
+    """
+    bulk_patch_function_name = get_bulk_patch_function_name()
+    cml = PyLOTHelpers().get_cumulus_api_instance()
+    bulk_patch = getattr(cml, bulk_patch_function_name)
+    identity_fields = IDENTITY_FIELDS.get('granule')
+    stats = {'skipped': 0, 'completed': 0}
+    lock = threading.Lock()
+
+    def submit_chunk(chunk):
+        granules = []
+        for record in chunk.get('records'):
+            granule = {field: record.get(field) for field in identity_fields if field in record}
+            granule.update(patch_plan.diff(record))
+            granules.append(granule)
+        rsp = bulk_patch({'apiGranules': granules})
+        if not response_error(rsp) and isinstance(rsp, dict):
+            chunk.update({'asyncOperationId': rsp.get('id')})
+        return rsp
+
+    def poll_chunk(chunk):
+        # The bulk patch endpoint may finish the update before responding instead of starting an async operation
+        rsp = {}
+        if chunk.get('asyncOperationId'):
+            rsp = wait_for_async_operation(cml, chunk.get('asyncOperationId'), poll_interval, poll_timeout)
+        if not response_error(rsp):
+            with lock:
+                stats['completed'] += len(chunk.get('records'))
+                print(f'Chunk {chunk.get("chunk")} updated {", ".join(chunk.get("fields"))} for '
+                      f'{len(chunk.get("records"))} granules ({stats["completed"]} granules updated)')
+        return rsp
+
+    print(f'Submitting bulk update requests of up to {batch_size} granules...')
+    stage_results = run_pipeline([
+        ('Bulk update submission', submit_chunk, executor or BulkExecutor(progress_interval=100)),
+        ('Bulk update completion', poll_chunk, poll_executor or BulkExecutor(progress_interval=100))
+    ], chunk_granule_updates(query_results, patch_plan, batch_size, stats))
+
+    rejected = []
+    for failure in report_chunk_failures(stage_results, lambda chunk: f'{len(chunk.get("records"))} granules'):
+        rejected.extend(failure.get('record').get('records'))
+    print(f'{stats["completed"]} changed, {stats["skipped"]} skipped as already up to date, '
+          f'{len(rejected)} rejected by the bulk endpoint')
+    if history:
+        history.record('bulk_update_granule', stats['completed'], max(result.elapsed for _, result in stage_results))
+
+    failures = []
+    if rejected:
+        print(f'Retrying {len(rejected)} rejected granules one at a time')
+        failures = update_cumulus('granule', rejected, executor, patch_plan, history)
+    print('Bulk update complete\n')
+
+    return failures
 
-    if records_to_update:
-        update_cumulus('granule', records_to_update)
 
-    granule_ids = [x.get('granuleId') for x in query_results]
-    print('Removing from CMR...')
-    thread_function(cml.remove_granule_from_cmr, granule_ids)
-    print('CMR removal complete\n')
+def thread_function(function, records, executor=None):
+    executor = executor or BulkExecutor()
+    result = executor.run(function, records)
+    print(result.summary())
+    for failure in result.failures[:10]:
+        print(f'Failed: {failure.get("record")} {failure.get("error")}')
 
-    print('Deleting records...')
-    print(granule_ids)
-    thread_function(cml.delete_granule, granule_ids)
+    return result
+
+
+def delete_cumulus(query_results, executor=None, delete_executor=None, history=None):
+    """
+    Removes each granule from CMR and deletes it.
+    :param history: ThroughputHistory the granules per second are recorded in
+    :return: BulkResult failures
+    """
+    cml = PyLOTHelpers().get_cumulus_api_instance()
+
+    def remove_from_cmr(record):
+        product_volume = record.get('productVolume', '')
+        if not isinstance(product_volume, str):
+            record.update({'productVolume': str(product_volume)})
+            response = cml.update_granule(record)
+            if response_error(response):
+                return response
+        return cml.remove_granule_from_cmr(record.get('granuleId'))
+
+    # Each granule is deleted as soon as its own CMR removal succeeds
+    failures = []
+    print('Removing from CMR and deleting records...')
+    stage_results = run_pipeline([
+        ('CMR removal', remove_from_cmr, executor or BulkExecutor()),
+        ('Deletion', lambda x: cml.delete_granule(x.get('granuleId')), delete_executor or BulkExecutor())
+    ], query_results)
+    for name, result in stage_results:
+        print(f'{name}: {result.summary()}')
+        TELEMETRY.record_result(name, result)
+        for failure in result.failures[:10]:
+            print(f'Failed: {failure.get("record").get("granuleId")} {failure.get("error")}')
+        failures.extend(result.failures)
+    if history:
+        history.record('delete_granule', stage_results[-1][1].succeeded, max(x.elapsed for _, x in stage_results))
     print('Deletion complete\n')
 
+    return failures
+
 
-def update_cumulus(record_type, query_results):
+def update_cumulus(record_type, query_results, executor=None, patch_plan=None, history=None):
+    """
+    Sends update_<record_type> for each record.
+    :param patch_plan: PatchPlan of the update. When provided records the update would not change are skipped, and
+    granules are updated with only their identity and changed fields. The records themselves are never modified so
+    failed records can be replayed with the same update data.
+    :param history: ThroughputHistory the records per second are recorded in
+    :return: BulkResult failures
+    """
     print('Updating records...')
     cml = PyLOTHelpers().get_cumulus_api_instance()
     update_function = getattr(cml, f'update_{record_type}')
-    thread_function(update_function, query_results)
+    if not patch_plan:
+        result = thread_function(update_function, query_results, executor)
+        TELEMETRY.record_result(f'update_{record_type}', result)
+        if history:
+            history.record(f'update_{record_type}', result.processed, result.elapsed)
+        print('Updating complete\n')
+        return result.failures
+
+    skipped = 0
+    identity_fields = IDENTITY_FIELDS.get(record_type)
+
+    def changed_records():
+        nonlocal skipped
+        for record in query_results:
+            if patch_plan.changed_fields(record):
+                yield record
+            else:
+                skipped += 1
+
+    def send_update(record):
+        if identity_fields:
+            payload = {field: record.get(field) for field in identity_fields if field in record}
+            payload.update(patch_plan.diff(record))
+        else:
+            payload = patch_plan.apply(copy.deepcopy(record))
+        return update_function(payload)
+
+    result = thread_function(send_update, changed_records(), executor)
+    TELEMETRY.record_result(f'update_{record_type}', result)
+    TELEMETRY.increment(f'update_{record_type}_skipped', skipped)
+    print(f'{result.succeeded} changed, {skipped} skipped as already up to date, {result.failed} failed')
+    if history:
+        history.record(f'update_{record_type}', result.processed, result.elapsed)
     print('Updating complete\n')
 
+    return result.failures
+
+
+def read_records(filename, source_only=False):
+    """
+    Generator that streams the records of a json array file one at a time.
+    :param filename: OpenSearch query results or a replay file
+    :param source_only: yield the _source of each record, removing the extra OpenSearch information
+    """
+    with open(filename, 'r', encoding='utf-8') as json_file:
+        for record in iter_json_array(json_file):
+            yield record.get('_source') if source_only else record
+
 
-def main(record_type, bulk=False, results=None, query=None, update_data=None, delete=None, **kwargs):
-    results_file = query_opensearch(query_data=query, record_type=record_type, results=results, **kwargs)
+def read_s3_records(bucket, key, source_only=False):
+    """
+    Generator that streams the records of a json array object in S3 one at a time without writing it to disk.
+    :param source_only: yield the _source of each record, removing the extra OpenSearch information
+    """
+    with closing(open_s3_object(bucket, key)) as body:
+        for record in iter_json_array(body):
+            yield record.get('_source') if source_only else record
 
+
+def plan_operations(record_type, query=None, replay=None, update_data=None, delete=None, bulk=False,
+                    terminate_after=100, partitions=1, bulk_batch_size=1000, history=None):
+    """
+    Describes the requests an update or delete would send and estimates how long it would take from the throughput of
+    previous runs, without changing any records. Records are counted with a count only lambda invocation, or by reading
+    the replay file.
+    :param history: ThroughputHistory to estimate durations from
+    :return: dictionary with the record_count and the estimated seconds per operation, None where unknown
+    """
+    history = history or ThroughputHistory()
+    print('Planning, no records will be changed...')
+    if replay:
+        record_count = sum(1 for _ in read_records(replay))
+        print(f'{record_count} {record_type} records in replay file: {replay}')
+    else:
+        record_count = int(count_opensearch_records(load_query(query), record_type, terminate_after).get('record_count'))
+        print(f'{record_count} {record_type} records match the query (1 count only lambda invocation)')
+        invocations = max(1, int(partitions))
+        print(f'Query: {invocations} OpenSearch lambda invocation{"s" if invocations > 1 else ""}', end='')
+        bytes_per_record = history.bytes_per_record(f'query_{record_type}')
+        if bytes_per_record:
+            print(f', about {record_count * bytes_per_record / (1024 * 1024):.1f} MiB of results', end='')
+        print()
+
+    chunks = math.ceil(record_count / bulk_batch_size)
+    operations = []
+    if update_data:
+        if bulk and record_type == 'granule':
+            print(f'Update: at least {chunks} bulk patch requests of up to {bulk_batch_size} granules, one chunk per set '
+                  f'of changed fields, each polled until its async operation finishes')
+            operations.append('bulk_update_granule')
+        else:
+            print(f'Update: up to {record_count} update_{record_type} requests, records already holding the update '
+                  f'values are skipped')
+            operations.append(f'update_{record_type}')
+    if delete:
+        if bulk:
+            print(f'Delete: {chunks} bulk delete requests of up to {bulk_batch_size} granules, each polled until its '
+                  f'async operation finishes')
+            operations.append('bulk_delete_granule')
+        else:
+            print(f'Delete: {2 * record_count} requests, a CMR removal and a deletion per granule, plus an '
+                  f'update_granule for each granule whose productVolume is not a string')
+            operations.append('delete_granule')
+
+    estimates = {}
+    for operation in operations:
+        throughput, _ = history.throughput(operation)
+        estimates[operation] = record_count / throughput if throughput else None
+        print(f'Estimated {operation} duration: {history.estimate(operation, record_count)}')
+    if operations and None not in estimates.values():
+        print(f'Estimated total duration: {format_duration(sum(estimates.values()))}')
+
+    return {'record_count': record_count, 'estimates': estimates}
+
+
+def load_query_records(record_type, query=None, replay=None, results=None, stream=False, history=None, **kwargs):
+    """
+    Runs the query selecting the records to update or delete, or finds the replay file listing them.
+    :param stream: stream the records from the results in S3 instead of downloading them
+    :return: function returning a new iterator over the records every time it is called
+    """
+    if replay:
+        print(f'Replaying records from: {replay}')
+        return partial(read_records, replay)
+
+    query_result = query_opensearch(
+        query_data=query, record_type=record_type, results=results, download=not stream, history=history, **kwargs
+    )
+    if query_result.get('file'):
+        return partial(read_records, query_result.get('file'), source_only=True)
+    if query_result.get('slices'):
+        return partial(
+            iter_slice_records, query_result.get('slices'), source_only=True,
+            terminate_after=query_result.get('terminate_after', 0)
+        )
+    return partial(read_s3_records, query_result.get('bucket'), query_result.get('key'), source_only=True)
+
+
+def change_records(record_type, load_records, update_data=None, delete=None, bulk=False, executor=None,
+                   delete_executor=None, bulk_batch_size=1000, poll_interval=10, history=None):
+    """
+    Updates the records and then deletes them.
+    :param load_records: function returning a new iterator over the records, see load_query_records
+    :return: BulkResult failures of the updates and deletes
+    """
+    failures = []
+    if update_data:
+        patch_plan = load_patch_plan(update_data)
+        if bulk and record_type == 'granule':
+            failures.extend(bulk_update_cumulus(
+                load_records(), patch_plan, bulk_batch_size, executor, delete_executor, poll_interval, history=history
+            ))
+        else:
+            failures.extend(update_cumulus(record_type, load_records(), executor, patch_plan, history))
+
+    if delete:
+        # Records are streamed from the file again so the update above never has to hold them in memory
+        query_results = process_update_data(update_data, load_records()) if update_data else load_records()
+        if bulk:
+            failures.extend(bulk_delete_cumulus(
+                delete, query_results, bulk_batch_size, executor, delete_executor, poll_interval, history=history
+            ))
+        else:
+            failures.extend(delete_cumulus(query_results, executor, delete_executor, history))
+
+    return failures
+
+
+def main(record_type, bulk=False, results=None, stream=False, query=None, replay=None, update_data=None, delete=None,
+         concurrency=10, delete_concurrency=None, rate_limit=None, max_retries=5, failed_records='failed_records.json',
+         batch=None, batch_workers=8, output_dir='batch_results', cache=False, no_cache=False, refresh=False,
+         cache_ttl=None, bulk_batch_size=1000, poll_interval=10, plan=False, **kwargs):
+    # Records that are about to be updated or deleted are always queried fresh
+    if not (update_data or delete):
+        kwargs.update({'response_cache': get_response_cache(cache, no_cache, refresh, cache_ttl)})
+    if bulk and update_data and record_type == 'granule':
+        # Fail before querying rather than after the records have been retrieved
+        get_bulk_patch_function_name()
+    if plan:
+        if batch:
+            raise ValueError('--plan can not be combined with --batch.')
+        plan_operations(
+            record_type, query, replay, update_data, delete, bulk, kwargs.get('terminate_after', 100),
+            kwargs.get('partitions', 1), bulk_batch_size
+        )
+        return 0
+    if batch:
+        if update_data or delete:
+            raise ValueError('Updates and deletes can not be combined with --batch.')
+        run_batch(
+            load_batch_queries(batch),
+            lambda query_data, results_file: query_opensearch(query_data, record_type, results=results_file, **kwargs),
+            workers=batch_workers, transfer_concurrency=kwargs.get('transfer_concurrency', 8), output_dir=output_dir
+        )
+        return 0
+
+    history = ThroughputHistory()
+    load_records = load_query_records(record_type, query, replay, results, stream, history, **kwargs)
     if update_data or delete:
-        with open(results_file, 'r', encoding='utf-8') as results_file:
-            query_results = json.load(results_file)
-
-        # Remove extra OpenSearch information
-        i = 0
-        while i < len(query_results):
-            query_results[i] = query_results[i].get('_source')
-            i += 1
-
-        if update_data:
-            updated_results = process_update_data(update_data, query_results)
-            query_results = updated_results
-            update_cumulus(record_type, updated_results)
-
-        if delete:
-            if bulk:
-                bulk_delete_cumulus(delete, query_results)
-            else:
-                delete_cumulus(query_results)
+        retry_policy = RetryPolicy(max_retries=max_retries)
+        rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        executor = BulkExecutor(concurrency=concurrency, rate_limit=rate_limiter, retry_policy=retry_policy)
+        delete_executor = BulkExecutor(
+            concurrency=delete_concurrency or concurrency, rate_limit=rate_limiter, retry_policy=retry_policy
+        )
+        failures = change_records(
+            record_type, load_records, update_data, delete, bulk, executor, delete_executor, bulk_batch_size,
+            poll_interval, history
+        )
+        if failures:
+            count = write_replay_file(failed_records, failures)
+            print(f'{count} failed records written to: {failed_records}\n'
+                  f'Retry them by passing --replay {failed_records} in place of the query.')
 
     return 0
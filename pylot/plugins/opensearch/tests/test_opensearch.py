@@ -1,10 +1,29 @@
 import argparse
+import io
+import json
 import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
+from cumulus_api import CumulusApi
+from pylot.plugins.helpers.patch_helpers import PatchPlan
+from pylot.plugins.helpers.plan_helpers import ThroughputHistory
 from pylot.plugins.opensearch.main import return_parser, OpenSearch, update_dictionary, thread_function, \
-    bulk_delete_cumulus, process_update_data, delete_cumulus, update_cumulus, query_opensearch
+    bulk_delete_cumulus, process_update_data, delete_cumulus, update_cumulus, query_opensearch, main, read_records, \
+    read_s3_records, parse_partition_bound, partition_queries, iter_slice_records, chunk_granule_ids, \
+    wait_for_async_operation, chunk_granule_updates, bulk_update_cumulus, plan_operations
+
+
+class BulkPatchCumulusApi(CumulusApi):
+    def bulk_patch_granules(self, data, **kwargs):
+        pass
+
+
+class CumulusApiWithoutBulkPatch(CumulusApi):
+    # Hides bulk patch functions a newer cumulus-api may define
+    bulk_patch_granules = None
+    bulk_patch = None
 
 
 class TestOpenSearch(unittest.TestCase):
@@ -34,6 +53,22 @@ class TestOpenSearch(unittest.TestCase):
         query_opensearch(query_data={}, record_type='')
         pass
 
+    @patch('pylot.plugins.opensearch.main.copy_s3_object')
+    @patch('pylot.plugins.opensearch.main.get_client')
+    def test_query_opensearch_stdout_is_json(self, mock_get_client, mock_copy):
+        os.environ['OPENSEARCH_LAMBDA_ARN'] = 'FAKE_ARN'
+        mock_get_client.return_value.invoke.return_value = {
+            'StatusCode': 200, 'Payload': io.BytesIO(b'{"bucket": "bucket", "key": "key", "record_count": 1}')
+        }
+        mock_copy.side_effect = lambda bucket, key, destination: destination.write(b'[{"a": 1}]')
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with patch('sys.stdout', stdout), patch('sys.stderr', io.StringIO()) as stderr:
+            print('Printed before the query')
+            query_opensearch('{}', 'granule', results='-')
+        stdout.flush()
+        self.assertEqual(stdout.buffer.getvalue(), b'Printed before the query\n[{"a": 1}]')
+        self.assertIn('Invoking OpenSearch lambda...', stderr.getvalue())
+
     def test_invoke_opensearch_lambda(self):
         opensearch = OpenSearch()
         os.environ['OPENSEARCH_LAMBDA_ARN'] = 'FAKE_ARN'
@@ -52,13 +87,16 @@ class TestOpenSearch(unittest.TestCase):
             )
             self.assertTrue('The ARN for the OpenSearch lambda is not defined' in context.exception)
 
-    def test_download_file(self):
+    @patch('pylot.plugins.opensearch.main.download_s3_object')
+    def test_download_file(self, mock_download):
         opensearch = OpenSearch()
-        opensearch.download_file(bucket='', key='', results='', s3_client=MagicMock())
+        opensearch.download_file(bucket='', key='', results='', s3_client=MagicMock(), part_size=1, concurrency=2)
+        self.assertEqual(mock_download.call_args.kwargs.get('part_size'), 1024 * 1024)
+        self.assertEqual(mock_download.call_args.kwargs.get('concurrency'), 2)
 
     def test_process_update_data(self):
         query_res = [{'productVolume': 1, 'testField': 'testValue'}]
-        updated_res = process_update_data('/tests/fake_update.json', query_res)
+        updated_res = list(process_update_data('/tests/fake_update.json', query_res))
         expected = [{'productVolume': '1', 'testField': 'testValueUpdated'}]
         self.assertEqual(updated_res, expected)
 
@@ -70,10 +108,54 @@ class TestOpenSearch(unittest.TestCase):
         expected = {'key_1': {'key_2': 'value_1_updated'}, 'key_3': 'value_3', 'key_4': 'value_4'}
         self.assertEqual(target, expected)
 
+    def test_update_dictionary_keeps_nested_fields(self):
+        target = {'key_1': {'key_2': 'value_1', 'key_5': 'value_5'}}
+        update = {'key_1': {'key_2': 'value_1_updated'}}
+        target = update_dictionary(target, update)
+        self.assertEqual(target, {'key_1': {'key_2': 'value_1_updated', 'key_5': 'value_5'}})
+
     @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
     def test_bulk_delete_cumulus(self, gcapi):
         bulk_delete_cumulus('/tests/fake_delete.json', [{'granuleId': 'fake_granuleId'}])
 
+    def test_chunk_granule_ids(self):
+        chunks = list(chunk_granule_ids(({'granuleId': str(x)} for x in range(5)), 2))
+        self.assertEqual(chunks, [
+            {'chunk': 0, 'ids': ['0', '1']}, {'chunk': 1, 'ids': ['2', '3']}, {'chunk': 2, 'ids': ['4']}
+        ])
+
+    @patch('pylot.plugins.opensearch.main.time.sleep')
+    def test_wait_for_async_operation(self, mock_sleep):
+        cml = MagicMock()
+        cml.get_async_operation.side_effect = [{'status': 'RUNNING'}, {'status': 'RUNNING'}, {'status': 'SUCCEEDED'}]
+        self.assertEqual(wait_for_async_operation(cml, 'id', poll_interval=1), {'status': 'SUCCEEDED'})
+        self.assertEqual(mock_sleep.call_count, 2)
+        cml.get_async_operation.side_effect = [{'status': 'TASK_FAILED', 'output': 'boom'}]
+        self.assertEqual(wait_for_async_operation(cml, 'id'), {'error': 'TASK_FAILED', 'message': 'boom'})
+        cml.get_async_operation.side_effect = None
+        cml.get_async_operation.return_value = {'status': 'RUNNING'}
+        self.assertEqual(wait_for_async_operation(cml, 'id', timeout=0).get('error'), 'Timeout')
+
+    @patch('pylot.plugins.opensearch.main.time.sleep')
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_bulk_delete_cumulus_chunks(self, gcapi, mock_sleep):
+        submitted = []
+
+        def bulk_delete(data):
+            submitted.append(data.get('ids'))
+            return {'id': f'operation-{data.get("ids")[0]}'}
+
+        gcapi.return_value.bulk_delete.side_effect = bulk_delete
+        gcapi.return_value.get_async_operation.side_effect = lambda async_operation_id: \
+            {'status': 'TASK_FAILED', 'output': 'failed'} if async_operation_id == 'operation-2' else \
+            {'status': 'SUCCEEDED'}
+        failures = bulk_delete_cumulus(
+            '/tests/fake_delete.json', [{'granuleId': str(x)} for x in range(5)], batch_size=2
+        )
+        self.assertEqual(sorted(submitted), [['0', '1'], ['2', '3'], ['4']])
+        self.assertEqual([x.get('record') for x in failures], [{'granuleId': '2'}, {'granuleId': '3'}])
+        self.assertEqual(failures[0].get('error'), 'TASK_FAILED: failed')
+
     def test_thread_function(self):
         thread_function(print, [1, 2, 3])
 
@@ -87,3 +169,245 @@ class TestOpenSearch(unittest.TestCase):
         query_res = [{'record': 'value'}]
         update_cumulus('test', query_res)
 
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_update_cumulus_sends_changed_fields(self, gcapi):
+        gcapi.return_value.update_granule.side_effect = \
+            lambda record: {'statusCode': 400, 'error': 'Bad Request'} if record.get('granuleId') == 'c' else {}
+        records = [
+            {'granuleId': 'a', 'collectionId': 'c___1', 'status': 'completed', 'productVolume': 1},
+            {'granuleId': 'b', 'collectionId': 'c___1', 'status': 'failed', 'productVolume': 1},
+            {'granuleId': 'c', 'collectionId': 'c___1', 'status': 'failed', 'productVolume': 1}
+        ]
+        failures = update_cumulus('granule', records, patch_plan=PatchPlan({'status': 'completed'}))
+        self.assertEqual(gcapi.return_value.update_granule.call_count, 2)
+        gcapi.return_value.update_granule.assert_any_call({'granuleId': 'b', 'collectionId': 'c___1',
+                                                           'status': 'completed'})
+        # Failed records are reported unchanged so they can be replayed with the same update data
+        self.assertEqual(failures[0].get('record'), records[2])
+
+    def test_chunk_granule_updates(self):
+        records = [
+            {'granuleId': 'a', 'status': 'completed', 'published': False},
+            {'granuleId': 'b', 'status': 'failed', 'published': False},
+            {'granuleId': 'c', 'status': 'failed', 'published': True},
+            {'granuleId': 'd', 'status': 'completed', 'published': True}
+        ]
+        stats = {'skipped': 0}
+        chunks = list(chunk_granule_updates(records, PatchPlan({'status': 'completed', 'published': True}), 1, stats))
+        self.assertEqual([(x.get('fields'), [r.get('granuleId') for r in x.get('records')]) for x in chunks], [
+            (['published'], ['a']), (['status', 'published'], ['b']), (['status'], ['c'])
+        ])
+        self.assertEqual(stats.get('skipped'), 1)
+
+    @patch('pylot.plugins.opensearch.main.CumulusApi', BulkPatchCumulusApi)
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_bulk_update_cumulus(self, gcapi):
+        cml = MagicMock(spec=BulkPatchCumulusApi)
+        gcapi.return_value = cml
+        cml.bulk_patch_granules.side_effect = \
+            lambda data: {'statusCode': 400, 'error': 'Bad Request'} if len(data.get('apiGranules')) == 1 else {'id': 'x'}
+        cml.get_async_operation.return_value = {'status': 'SUCCEEDED'}
+        cml.update_granule.return_value = {}
+        records = [
+            {'granuleId': 'a', 'collectionId': 'c___1', 'status': 'failed'},
+            {'granuleId': 'b', 'collectionId': 'c___1', 'status': 'failed'},
+            {'granuleId': 'c', 'collectionId': 'c___1', 'status': 'failed', 'published': True}
+        ]
+        failures = bulk_update_cumulus(records, PatchPlan({'status': 'completed', 'published': True}), poll_interval=0)
+        self.assertEqual(failures, [])
+        cml.bulk_patch_granules.assert_any_call({'apiGranules': [
+            {'granuleId': 'a', 'collectionId': 'c___1', 'status': 'completed', 'published': True},
+            {'granuleId': 'b', 'collectionId': 'c___1', 'status': 'completed', 'published': True}
+        ]})
+        cml.get_async_operation.assert_called_once_with('x')
+        # The chunk the bulk endpoint rejected is retried one record at a time
+        cml.update_granule.assert_called_once_with({'granuleId': 'c', 'collectionId': 'c___1', 'status': 'completed'})
+
+    @patch('pylot.plugins.opensearch.main.CumulusApi', CumulusApiWithoutBulkPatch)
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_bulk_update_cumulus_without_bulk_patch(self, gcapi):
+        gcapi.return_value = MagicMock(spec=CumulusApiWithoutBulkPatch)
+        with self.assertRaises(ValueError):
+            bulk_update_cumulus([{'granuleId': 'a', 'status': 'failed'}], PatchPlan({'status': 'completed'}))
+        gcapi.return_value.update_granule.assert_not_called()
+        with self.assertRaises(ValueError):
+            main('granule', bulk=True, query='{}', update_data='{"status": "completed"}')
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_update_cumulus_sends_full_records(self, gcapi):
+        gcapi.return_value.update_collection.return_value = {}
+        record = {'name': 'c', 'version': '1', 'meta': {'a': 1}}
+        update_cumulus('collection', [record], patch_plan=PatchPlan({'meta': {'b': 2}}))
+        gcapi.return_value.update_collection.assert_called_once_with({'name': 'c', 'version': '1',
+                                                                      'meta': {'a': 1, 'b': 2}})
+        self.assertEqual(record, {'name': 'c', 'version': '1', 'meta': {'a': 1}})
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_delete_cumulus_skips_failed_cmr_removal(self, gcapi):
+        gcapi.return_value.remove_granule_from_cmr.side_effect = \
+            lambda granule_id: {'statusCode': 404, 'error': 'Not Found'} if granule_id == 'b' else {}
+        gcapi.return_value.delete_granule.return_value = {}
+        failures = delete_cumulus([{'granuleId': 'a', 'productVolume': '1'}, {'granuleId': 'b', 'productVolume': '1'}])
+        self.assertEqual([x.get('record').get('granuleId') for x in failures], ['b'])
+        gcapi.return_value.delete_granule.assert_called_once_with('a')
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_main_replay_writes_failed_records(self, gcapi):
+        gcapi.return_value.remove_granule_from_cmr.return_value = {}
+        gcapi.return_value.delete_granule.side_effect = \
+            lambda granule_id: {'statusCode': 400, 'error': 'Bad Request'} if granule_id == 'b' else {}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            replay = os.path.join(temp_dir, 'replay.json')
+            failed_records = os.path.join(temp_dir, 'failed.json')
+            with open(replay, 'w+', encoding='utf-8') as replay_file:
+                json.dump([{'granuleId': 'a', 'productVolume': '1'}, {'granuleId': 'b', 'productVolume': '1'}],
+                          replay_file)
+            main('granule', replay=replay, delete='/tests/fake_delete.json', failed_records=failed_records)
+            with open(failed_records, 'r', encoding='utf-8') as failed_file:
+                self.assertEqual(json.load(failed_file), [{'granuleId': 'b', 'productVolume': '1'}])
+
+    @patch('pylot.plugins.opensearch.main.query_opensearch')
+    @patch('pylot.plugins.helpers.batch_helpers.get_client')
+    def test_main_batch(self, mock_get_client, mock_query_opensearch):
+        mock_query_opensearch.side_effect = lambda query_data, record_type, results, **kwargs: {'record_count': 1}
+        with tempfile.TemporaryDirectory() as temp_dir:
+            batch = os.path.join(temp_dir, 'batch.json')
+            with open(batch, 'w+', encoding='utf-8') as batch_file:
+                json.dump({'nalma': {'query': {'term': {'collectionId': 'nalmaraw___1'}}}}, batch_file)
+            main('granule', batch=batch, output_dir=temp_dir, terminate_after=0)
+            with open(os.path.join(temp_dir, 'manifest.json'), 'r', encoding='utf-8') as manifest_file:
+                self.assertEqual(json.load(manifest_file).get('succeeded'), 1)
+        mock_query_opensearch.assert_called_once_with(
+            '{"query": {"term": {"collectionId": "nalmaraw___1"}}}', 'granule',
+            results=os.path.join(temp_dir, 'nalma.json'), terminate_after=0, response_cache=None
+        )
+        with self.assertRaises(ValueError):
+            main('granule', batch=batch, delete='fake_delete.json')
+
+    def test_invoke_opensearch_lambda_count_only(self):
+        os.environ['OPENSEARCH_LAMBDA_ARN'] = 'fake_arn'
+        lambda_client = MagicMock()
+        lambda_client.invoke.return_value = {'StatusCode': 200}
+        OpenSearch().invoke_opensearch_lambda({}, 'granules', 0, lambda_client=lambda_client, count_only=True)
+        payload = json.loads(lambda_client.invoke.call_args.kwargs.get('Payload'))
+        self.assertEqual(payload.get('config'), {
+            'query': {}, 'record_type': 'granule', 'terminate_after': 0, 'count_only': True
+        })
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    @patch('pylot.plugins.opensearch.main.count_opensearch_records', return_value={'record_count': 2500})
+    def test_plan_operations(self, mock_count, gcapi):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            history = ThroughputHistory(os.path.join(temp_dir, 'throughput.json'))
+            history.record('bulk_delete_granule', 1000, 10)
+            plan = plan_operations('granule', query='{}', update_data='/tests/fake_update.json',
+                                   delete='/tests/fake_delete.json', bulk=True, history=history)
+        self.assertEqual(plan, {
+            'record_count': 2500, 'estimates': {'bulk_update_granule': None, 'bulk_delete_granule': 25}
+        })
+        mock_count.assert_called_once_with({}, 'granule', 100)
+        gcapi.assert_not_called()
+
+    @patch('pylot.plugins.opensearch.main.query_opensearch')
+    @patch('pylot.plugins.opensearch.main.plan_operations')
+    def test_main_plan(self, mock_plan, mock_query):
+        main('granule', query='{}', delete='/tests/fake_delete.json', plan=True, terminate_after=0)
+        mock_plan.assert_called_once_with('granule', '{}', None, None, '/tests/fake_delete.json', False, 0, 1, 1000)
+        mock_query.assert_not_called()
+
+    def test_parse_partition_bound(self):
+        self.assertEqual(parse_partition_bound('1000'), 1000)
+        self.assertEqual(parse_partition_bound('1970-01-02'), 86400000)
+        self.assertEqual(parse_partition_bound('1970-01-01T00:00:01Z'), 1000)
+        self.assertIsNone(parse_partition_bound(None))
+
+    def test_partition_queries(self):
+        query = {'query': {'term': {'collectionId': 'nalmaraw___1'}}, 'size': 10}
+        slices = partition_queries(query, 4, 'updatedAt', 0, 400)
+        self.assertEqual(len(slices), 5)
+        ranges = [x.get('query').get('bool').get('filter')[1].get('range').get('updatedAt') for x in slices[:4]]
+        self.assertEqual(ranges, [{'lt': 100}, {'gte': 100, 'lt': 200}, {'gte': 200, 'lt': 300}, {'gte': 300}])
+        self.assertEqual(slices[0].get('query').get('bool').get('filter')[0], query.get('query'))
+        self.assertEqual(slices[0].get('size'), 10)
+        self.assertEqual(slices[4].get('query').get('bool').get('must_not'), [{'exists': {'field': 'updatedAt'}}])
+        with self.assertRaises(ValueError):
+            partition_queries(query, 4, 'updatedAt', None, 400)
+
+    @patch('pylot.plugins.opensearch.main.read_s3_records')
+    def test_iter_slice_records(self, mock_read_s3_records):
+        objects = {'a': [{'_id': 1, '_source': {'granuleId': 'a'}}, {'_id': 2, '_source': {'granuleId': 'b'}}],
+                   'b': [{'_id': 2, '_source': {'granuleId': 'b'}}, {'_id': 3, '_source': {'granuleId': 'c'}}]}
+        mock_read_s3_records.side_effect = lambda bucket, key: iter(objects.get(key))
+        stats = {}
+        records = list(iter_slice_records([{'key': 'a'}, {'key': 'b'}], source_only=True, stats=stats))
+        self.assertEqual([x.get('granuleId') for x in records], ['a', 'b', 'c'])
+        self.assertEqual(stats, {'read': 4, 'duplicates': 1})
+        records = list(iter_slice_records([{'key': 'a'}, {'key': 'b'}], source_only=True, terminate_after=2))
+        self.assertEqual([x.get('granuleId') for x in records], ['a', 'b'])
+
+    @patch('pylot.plugins.opensearch.main.get_client')
+    @patch('pylot.plugins.opensearch.main.read_s3_records')
+    @patch('pylot.plugins.opensearch.main.OpenSearch.invoke_opensearch_lambda')
+    def test_query_opensearch_partitioned(self, mock_invoke, mock_read_s3_records, mock_get_client):
+        def invoke(query_data, record_type, terminate_after):
+            index = 'missing' if 'must_not' in query_data.get('query').get('bool') else \
+                query_data.get('query').get('bool').get('filter')[1].get('range').get('updatedAt').get('gte', 0)
+            payload = json.dumps({'bucket': 'bucket', 'key': str(index), 'record_count': 1})
+            return {'Payload': io.BytesIO(payload.encode('utf-8'))}
+
+        mock_invoke.side_effect = invoke
+        mock_read_s3_records.side_effect = lambda bucket, key: iter([{'_id': key, '_source': {'granuleId': key}}])
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'query_results.json')
+            ret = query_opensearch(
+                '{"query": {"match_all": {}}}', 'granule', results=results, terminate_after=0, partitions=2,
+                partition_from='0', partition_to='100'
+            )
+            with open(results, 'r', encoding='utf-8') as results_file:
+                records = json.load(results_file)
+        self.assertEqual(mock_invoke.call_count, 3)
+        self.assertEqual(sorted(x.get('_id') for x in records), ['0', '50', 'missing'])
+        self.assertEqual(ret.get('record_count'), 3)
+        self.assertEqual(ret.get('file'), results)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'query_results.json')
+            ret = query_opensearch(
+                '{"query": {"match_all": {}}}', 'granule', results=results, terminate_after='2', partitions=2,
+                partition_from='0', partition_to='100'
+            )
+            with open(results, 'r', encoding='utf-8') as results_file:
+                self.assertEqual(len(json.load(results_file)), 2)
+        self.assertEqual(ret.get('record_count'), 2)
+
+    def test_read_records(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results_file = os.path.join(temp_dir, 'query_results.json')
+            with open(results_file, 'w+', encoding='utf-8') as outfile:
+                json.dump([{'_id': 1, '_source': {'granuleId': 'a'}}, {'_id': 2, '_source': {'granuleId': 'b'}}], outfile)
+            self.assertEqual(list(read_records(results_file, source_only=True)), [{'granuleId': 'a'}, {'granuleId': 'b'}])
+            self.assertEqual(len(list(read_records(results_file))), 2)
+
+    @patch('pylot.plugins.helpers.pylot_helpers.PyLOTHelpers.get_cumulus_api_instance')
+    def test_delete_cumulus_updates_product_volume(self, gcapi):
+        gcapi.return_value.update_granule.return_value = {}
+        gcapi.return_value.remove_granule_from_cmr.return_value = {}
+        gcapi.return_value.delete_granule.return_value = {}
+        delete_cumulus(iter([{'granuleId': 'a', 'productVolume': 1}, {'granuleId': 'b', 'productVolume': '1'}]))
+        gcapi.return_value.update_granule.assert_called_once_with({'granuleId': 'a', 'productVolume': '1'})
+        self.assertEqual(gcapi.return_value.delete_granule.call_count, 2)
+
+    @patch('pylot.plugins.opensearch.main.open_s3_object')
+    def test_read_s3_records(self, mock_open_s3_object):
+        mock_open_s3_object.return_value = io.BytesIO(b'[{"_source": {"granuleId": "a"}}]')
+        self.assertEqual(list(read_s3_records('bucket', 'key', source_only=True)), [{'granuleId': 'a'}])
+        mock_open_s3_object.assert_called_once_with('bucket', 'key')
+
+    @patch('pylot.plugins.opensearch.main.OpenSearch')
+    def test_query_opensearch_without_download(self, mock_opensearch):
+        payload = MagicMock()
+        payload.read.return_value = b'{"bucket": "bucket", "key": "key", "record_count": 1}'
+        mock_opensearch.return_value.invoke_opensearch_lambda.return_value = {'Payload': payload}
+        ret = query_opensearch(query_data='{}', record_type='granule', download=False)
+        self.assertEqual(ret, {'bucket': 'bucket', 'key': 'key', 'record_count': 1})
+        mock_opensearch.return_value.download_file.assert_not_called()
@@ -1,7 +1,17 @@
+import concurrent.futures
 import json
 import os
+import sys
+from collections import deque
+from contextlib import closing
 
-import boto3
+from .. import PLUGIN_MANIFEST
+from ..helpers.aws_helpers import get_client
+from ..helpers.batch_helpers import load_batch_queries, run_batch
+from ..helpers.cache_helpers import add_cache_arguments, get_response_cache
+from ..helpers.checkpoint_helpers import Checkpoint
+from ..helpers.s3_helpers import copy_s3_object, download_s3_object, open_s3_object
+from ..helpers.stream_helpers import JsonStreamWriter, iter_json_array, open_output, results_stdout, results_to_stdout
 
 
 class QueryRDS:
@@ -14,7 +24,7 @@ class QueryRDS:
 
     def invoke_rds_lambda(self, query_data, lambda_client=None, **kwargs):
         if not lambda_client:
-            lambda_client = boto3.client('lambda')
+            lambda_client = get_client('lambda')
         lambda_arn = os.getenv('RDS_LAMBDA_ARN')
         if not lambda_arn:
             raise ValueError('The ARN for the RDS lambda is not defined. Provide it as an environment variable.')
@@ -32,39 +42,251 @@ class QueryRDS:
 
         return rsp
 
-    def download_file(self, bucket, key, results, s3_client=None):
+    def download_file(self, bucket, key, results, s3_client=None, part_size=8, concurrency=8):
+        """
+        :param part_size: MiB downloaded by each ranged GET
+        :param concurrency: number of parts downloaded at once
+        """
         if not s3_client:
-            s3_client = boto3.client('s3')
+            s3_client = get_client('s3', max_pool_connections=concurrency)
         print('Downloading query results...')
-        s3_client.download_file(
-            Bucket=bucket,
-            Key=key,
-            Filename=f'{os.getcwd()}/{results}'
+        download_s3_object(
+            bucket=bucket,
+            key=key,
+            filename=os.path.join(os.getcwd(), results),
+            s3_client=s3_client,
+            part_size=int(part_size * 1024 * 1024),
+            concurrency=concurrency
         )
 
-        file = f'{os.getcwd()}/{results}'
+        file = os.path.join(os.getcwd(), results)
         return file
 
 
-def query_rds(query, results='query_results.json', **kwargs):
-    rds = QueryRDS()
-    if isinstance(query, str) and os.path.isfile(query):
-        query = rds.read_json_file(query)
-    else:
-        query = json.loads(query)
+def query_rds(query, results='query_results.json', part_size=8, transfer_concurrency=8, page_size=None,
+              response_cache=None, **kwargs):
+    """
+    :param page_size: split the query into keyset pages of this many key values. See query_rds_paged.
+    :param response_cache: ResponseCache to reuse the lambda response of an identical earlier query from
+    """
+    with results_to_stdout(results == '-'):
+        rds = QueryRDS()
+        if isinstance(query, str) and os.path.isfile(query):
+            query = rds.read_json_file(query)
+        else:
+            query = json.loads(query)
 
-    query = {'rds_config': query, 'is_test': True}
+        if page_size:
+            return query_rds_paged(query, results=results, page_size=page_size, response_cache=response_cache, **kwargs)
 
-    rsp = rds.invoke_rds_lambda(query)
-    ret_dict = json.loads(rsp.get('Payload').read().decode('utf-8'))
+        ret_dict = invoke_rds_query(query, response_cache)
+        query = {'rds_config': query, 'is_test': True}
 
-    # Download results from S3
-    file = rds.download_file(bucket=ret_dict.get('bucket'), key=ret_dict.get('key'), results=results)
-    print(
-        f'{ret_dict.get("count")} {query.get("rds_config").get("records")} records obtained: '
-        f'{os.getcwd()}/{results}'
-    )
-    return file
+        if results == '-':
+            stdout = results_stdout()
+            stdout.flush()
+            copy_s3_object(ret_dict.get('bucket'), ret_dict.get('key'), stdout.buffer)
+            return ret_dict
+
+        # Download results from S3
+        file = rds.download_file(
+            bucket=ret_dict.get('bucket'), key=ret_dict.get('key'), results=results, part_size=part_size,
+            concurrency=transfer_concurrency
+        )
+        print(f'{ret_dict.get("count")} {query.get("rds_config").get("records")} records obtained: {file}')
+        ret_dict.update({'file': file})
+        return ret_dict
+
+
+def key_range_query(rds_config, key_column, lower=None, upper=None, limit=None):
+    """
+    Restricts an RDS lambda query to key_column values in [lower, upper).
+    """
+    conditions = [f'({rds_config.get("where")})'] if rds_config.get('where') else []
+    if lower is not None:
+        conditions.append(f'{key_column} >= {lower}')
+    if upper is not None:
+        conditions.append(f'{key_column} < {upper}')
+    page_config = {**rds_config, 'where': ' AND '.join(conditions)}
+    page_config.pop('limit', None)
+    if limit:
+        page_config.update({'limit': limit})
+    return page_config
+
+
+def invoke_rds_query(rds_config, response_cache=None):
+    """
+    :param response_cache: ResponseCache to reuse the response of an identical earlier query from
+    :return: the lambda response containing the bucket, key and count of the results
+    """
+    def invoke(rds_config):
+        rsp = QueryRDS().invoke_rds_lambda({'rds_config': rds_config, 'is_test': True})
+        return json.loads(rsp.get('Payload').read().decode('utf-8'))
+
+    if response_cache:
+        return response_cache.call('rds_lambda', 'query', invoke, rds_config)
+    return invoke(rds_config)
+
+
+def has_key_rows(rds_config, key_column, lower=None, upper=None, response_cache=None):
+    """
+    :return: True if a single row probe finds rows matching the query with key_column values in [lower, upper)
+    """
+    probe = key_range_query(rds_config, key_column, lower, upper, limit=1)
+    return int(invoke_rds_query(probe, response_cache).get('count') or 0) > 0
+
+
+def find_key_upper_bound(rds_config, key_column, key_from, page_size, response_cache=None):
+    """
+    Finds a page boundary above the largest key_column value matching the query using single row probes: the probe
+    distance doubles until a probe finds no rows, then the boundary is narrowed down to a whole page.
+    :return: the first page boundary with no matching rows at or above it
+    """
+    def has_rows(lower):
+        return has_key_rows(rds_config, key_column, lower, response_cache=response_cache)
+
+    pages = 1
+    while has_rows(key_from + pages * page_size):
+        pages *= 2
+    low, high = pages // 2, pages
+    while high - low > 1:
+        middle = (low + high) // 2
+        if has_rows(key_from + middle * page_size):
+            low = middle
+        else:
+            high = middle
+
+    return key_from + high * page_size
+
+
+def find_key_lower_bound(rds_config, key_column, key_from, key_to, page_size, response_cache=None):
+    """
+    Finds the page boundary below the smallest key_column value matching the query with a binary search of single row
+    probes, so the empty pages between key_from and the first matching row are never invoked.
+    :return: the start of the first page with matching rows, or key_to if no row in [key_from, key_to) matches
+    """
+    def has_rows_below(pages):
+        return has_key_rows(rds_config, key_column, key_from, min(key_from + pages * page_size, key_to), response_cache)
+
+    low, high = 0, -(-(key_to - key_from) // page_size)
+    if not high or not has_rows_below(high):
+        return key_to
+    while high - low > 1:
+        middle = (low + high) // 2
+        if has_rows_below(middle):
+            high = middle
+        else:
+            low = middle
+
+    return key_from + low * page_size
+
+
+def query_rds_paged(rds_config, results='query_results.json', page_size=10000, key_column='cumulus_id', key_from=0,
+                    key_to=None, workers=8, resume=False, output_format='json', response_cache=None, **kwargs):
+    """
+    Runs an RDS lambda query as keyset pages on key_column ranges instead of a single invocation returning the whole
+    result set. Pages are invoked concurrently but written in key order as they complete, streamed from S3 into the
+    output, and the key of the next unwritten page is checkpointed after every page so an interrupted run can be
+    resumed. A limit in the query caps the total number of records written.
+    :param rds_config: RDS lambda query
+    :param results: name of the output file, or - to write to stdout
+    :param page_size: number of key values covered by each page
+    :param key_column: integer column the pages are cut on
+    :param key_from: smallest key value to query
+    :param key_to: key value to stop at. Found by probing the lambda if not provided.
+    :param workers: number of pages invoked at once
+    :param resume: continue from the checkpoint of a previous run writing to results
+    :param output_format: json for a JSON array or jsonl for JSON Lines
+    :param response_cache: ResponseCache to reuse page responses from
+    :return: dictionary with the count of records written and the local file
+    """
+    output = None if results == '-' else os.path.join(os.getcwd(), results)
+    checkpoint = Checkpoint(
+        f'{output}.checkpoint', query=rds_config, key_column=key_column, page_size=page_size, format=output_format
+    ) if output else None
+    state = checkpoint.load() if resume and checkpoint else {}
+    if state:
+        for field, value in (('query', rds_config), ('key_column', key_column), ('page_size', page_size)):
+            if state.get(field) != value:
+                raise ValueError(f'Checkpoint {checkpoint.path} is for a different {field.replace("_", " ")}: '
+                                 f'{state.get(field)}')
+        output_format = state.get('format')
+        print(f'Resuming from {key_column} {state.get("next_key")} after {state.get("count")} records')
+    elif resume:
+        print(f'No checkpoint found for {results}, starting from the first page.')
+
+    max_records = int(rds_config.get('limit') or 0) or sys.maxsize
+    key_from = int(state.get('next_key', key_from))
+    key_to = state.get('key_to', key_to)
+    if key_to is None:
+        key_to = find_key_upper_bound(rds_config, key_column, key_from, page_size, response_cache)
+    key_to = int(key_to)
+    if not state:
+        key_from = find_key_lower_bound(rds_config, key_column, key_from, key_to, page_size, response_cache)
+    page_starts = range(key_from, key_to, page_size)
+    print(f'Querying {key_column} {key_from} - {key_to} in {len(page_starts)} pages using {workers} workers...')
+    get_client('lambda', max_pool_connections=workers)
+
+    def run_page(lower):
+        page_query = key_range_query(rds_config, key_column, lower, min(lower + page_size, key_to))
+        return invoke_rds_query(page_query, response_cache)
+
+    with open_output(output, 'r+' if state else 'w+') as outfile:
+        if state:
+            outfile.seek(state.get('offset'))
+            outfile.truncate()
+        writer = JsonStreamWriter(outfile, json_lines=output_format == 'jsonl', count=state.get('count', 0))
+        write_pages(
+            run_page, page_starts, workers,
+            lambda page: write_page(page, writer, max_records, checkpoint, key_to, page_size)
+        )
+        writer.close()
+
+    if checkpoint:
+        checkpoint.remove()
+    print(f'{writer.count} {rds_config.get("records")} records obtained: {output or "stdout"}')
+    return {'count': writer.count, 'file': output}
+
+
+def write_pages(run_page, page_starts, workers, write):
+    """
+    Invokes the pages concurrently, keeping up to workers * 2 of them in flight, and writes them in key order as they
+    complete. Once write returns False no further page is written and the pages still pending are cancelled.
+    :param run_page: function invoking the page starting at a key
+    :param page_starts: iterable of page start keys
+    :param workers: number of pages invoked at once
+    :param write: function writing a (page start key, future) tuple, returning False to stop
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending: deque = deque()
+        writing = True
+        for lower in page_starts:
+            pending.append((lower, executor.submit(run_page, lower)))
+            if len(pending) >= workers * 2:
+                writing = write(pending.popleft())
+                if not writing:
+                    break
+        while writing and pending:
+            writing = write(pending.popleft())
+        for _, future in pending:
+            future.cancel()
+
+
+def write_page(page, writer, max_records, checkpoint, key_to, page_size):
+    """
+    Streams the results object of a completed page into the writer and checkpoints the key of the next page.
+    :param page: tuple of (page start key, future of the page's lambda response)
+    :return: False once max_records records have been written
+    """
+    lower, future = page
+    ret_dict = future.result()
+    if int(ret_dict.get('count') or 0):
+        with closing(open_s3_object(ret_dict.get('bucket'), ret_dict.get('key'))) as body:
+            records = iter_json_array(body)
+            writer.write(record for _, record in zip(range(max_records - writer.count), records))
+    if checkpoint:
+        checkpoint.save({'next_key': lower + page_size, 'key_to': key_to, 'count': writer.count, 'offset': writer.tell()})
+    return writer.count < max_records
 
 
 def return_parser(subparsers):
@@ -76,7 +298,7 @@ def return_parser(subparsers):
     }
     subparser = subparsers.add_parser(
         'rds_lambda',
-        help='This plugin is used to submit queries directly to the cumulus RDS bypassing the cumulus API.',
+        help=PLUGIN_MANIFEST.get('rds_lambda'),
         description='Submit queries to the Cumulus RDS instance.\n'
                     f'Example query: {json.dumps(query)}'
     )
@@ -84,18 +306,115 @@ def return_parser(subparsers):
         'query',
         help='A file containing an RDS Lambda query: <filename>.json or a json query string '
              'using the RDS DSL syntax: https://github.com/ghrcdaac/ghrc_rds_lambda?tab=readme-ov-file#querying',
-        metavar='query'
+        metavar='query',
+        nargs='?'
+    )
+    subparser.add_argument(
+        '--page-size',
+        help='Split the query into keyset pages covering this many --key-column values. The pages are queried '
+             'concurrently and streamed into the results file in key order.',
+        metavar='',
+        type=int,
+        default=None
+    )
+    subparser.add_argument(
+        '--key-column',
+        help='The integer column pages are cut on. Default is cumulus_id.',
+        metavar='',
+        default='cumulus_id'
+    )
+    subparser.add_argument(
+        '--key-from',
+        help='The smallest key value queried with --page-size. Default is 0.',
+        metavar='',
+        type=int,
+        default=0
+    )
+    subparser.add_argument(
+        '--key-to',
+        help='The key value paging stops at. Found by probing the table if not provided.',
+        metavar='',
+        type=int,
+        default=None
+    )
+    subparser.add_argument(
+        '-w', '--workers',
+        help='The number of pages queried at once with --page-size. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '--resume',
+        help='Resume an interrupted --page-size query from the last page written to the results file.',
+        action='store_true'
+    )
+    subparser.add_argument(
+        '-f', '--format',
+        help='Format of paged results: json for a JSON array or jsonl for JSON Lines. Default is json.',
+        metavar='',
+        dest='output_format',
+        choices=['json', 'jsonl'],
+        default='json'
+    )
+    add_cache_arguments(subparser)
+    subparser.add_argument(
+        '--batch',
+        help='The name of a json file containing many RDS Lambda queries, either an object of the form '
+             '{"<name>": <query>} or a list of queries. Used in place of query. The queries are run concurrently and '
+             'the results of each are written to <output-dir>/<name>.json along with a manifest.json summary.',
+        metavar=''
+    )
+    subparser.add_argument(
+        '--batch-workers',
+        help='The number of batch queries run at once. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '--output-dir',
+        help='The directory batch query results and the batch manifest are written to. Default is batch_results.',
+        metavar='',
+        default='batch_results'
     )
     subparser.add_argument(
         '-r', '--results',
-        help='The name to give to the results file.',
+        help='The name to give to the results file. Use - to stream the results to stdout.',
         metavar='',
         default='query_results.json'
     )
+    subparser.add_argument(
+        '--part-size',
+        help='The size in MiB of each part of the parallel results download. Default is 8.',
+        metavar='',
+        type=float,
+        default=8
+    )
+    subparser.add_argument(
+        '--transfer-concurrency',
+        help='The number of parts of the results file downloaded at once. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
 
 
-def main(**kwargs):
-    query_rds(**kwargs)
+def main(query=None, results='query_results.json', batch=None, batch_workers=8, output_dir='batch_results',
+         cache=False, no_cache=False, refresh=False, cache_ttl=None, **kwargs):
+    if query and batch:
+        raise ValueError('A query can not be combined with --batch, put it in the batch file instead.')
+    kwargs.update({'response_cache': get_response_cache(cache, no_cache, refresh, cache_ttl)})
+    if batch:
+        run_batch(
+            load_batch_queries(batch),
+            lambda query_data, results_file: query_rds(query_data, results=results_file, **kwargs),
+            workers=batch_workers, transfer_concurrency=kwargs.get('transfer_concurrency', 8), output_dir=output_dir
+        )
+    elif query:
+        query_rds(query, results=results, **kwargs)
+    else:
+        raise ValueError('Provide either a query or a --batch file of queries.')
     print('Complete')
 
     return 0
@@ -1,9 +1,34 @@
 import argparse
+import io
+import json
 import os
+import re
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 
-from pylot.plugins.rds_lambda.main import return_parser, QueryRDS, query_rds
+from pylot.plugins.rds_lambda.main import return_parser, QueryRDS, query_rds, main, key_range_query, \
+    find_key_upper_bound, find_key_lower_bound, query_rds_paged
+
+TABLE = [{'cumulus_id': cumulus_id, 'name': f'granule_{cumulus_id}'} for cumulus_id in range(1, 58) if cumulus_id % 7]
+
+
+def fake_invoke_rds_query(rds_config, response_cache=None):
+    """
+    Evaluates the key range conditions of a paged query against TABLE. Results are keyed by the where clause.
+    """
+    rows = TABLE
+    for operator, value in re.findall(r'cumulus_id (>=|<) (\d+)', rds_config.get('where')):
+        if operator == '>=':
+            rows = [x for x in rows if x.get('cumulus_id') >= int(value)]
+        else:
+            rows = [x for x in rows if x.get('cumulus_id') < int(value)]
+    rows = rows[:rds_config.get('limit', len(rows))]
+    return {'bucket': 'bucket', 'key': json.dumps(rows), 'count': len(rows)}
+
+
+def fake_open_s3_object(bucket, key):
+    return io.StringIO(key)
 
 
 class TestRDS(unittest.TestCase):
@@ -47,6 +72,139 @@ class TestRDS(unittest.TestCase):
             rds.invoke_rds_lambda(query_data={}, lambda_client=mock_client)
             self.assertTrue('The ARN for the RDS lambda is not defined' in context.exception)
 
-    def test_download_file(self):
+    @patch('pylot.plugins.rds_lambda.main.download_s3_object')
+    def test_download_file(self, mock_download):
         rds = QueryRDS()
-        rds.download_file(bucket='', key='', results='', s3_client=MagicMock())
+        rds.download_file(bucket='', key='', results='', s3_client=MagicMock(), part_size=1, concurrency=2)
+        self.assertEqual(mock_download.call_args.kwargs.get('part_size'), 1024 * 1024)
+        self.assertEqual(mock_download.call_args.kwargs.get('concurrency'), 2)
+
+    @patch('pylot.plugins.rds_lambda.main.run_batch')
+    @patch('pylot.plugins.rds_lambda.main.load_batch_queries')
+    @patch('pylot.plugins.rds_lambda.main.query_rds')
+    def test_main_batch(self, mock_query_rds, mock_load_batch_queries, mock_run_batch):
+        main(batch='batch.json', batch_workers=4, output_dir='out', results='ignored.json', transfer_concurrency=2)
+        mock_load_batch_queries.assert_called_once_with('batch.json')
+        run_query = mock_run_batch.call_args.args[1]
+        run_query('{"records": "granules"}', 'out/a.json')
+        mock_query_rds.assert_called_once_with(
+            '{"records": "granules"}', results='out/a.json', transfer_concurrency=2, response_cache=None
+        )
+        self.assertEqual(mock_run_batch.call_args.kwargs.get('workers'), 4)
+
+    @patch('pylot.plugins.rds_lambda.main.copy_s3_object')
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    def test_query_rds_stdout_is_json(self, mock_get_client, mock_copy):
+        os.environ['RDS_LAMBDA_ARN'] = 'FAKE_ARN'
+        mock_get_client.return_value.invoke.return_value = {
+            'StatusCode': 200, 'Payload': io.BytesIO(b'{"bucket": "bucket", "key": "key", "count": 1}')
+        }
+        mock_copy.side_effect = lambda bucket, key, destination: destination.write(b'[1]')
+        stdout = io.TextIOWrapper(io.BytesIO())
+        with patch('sys.stdout', stdout), patch('sys.stderr', io.StringIO()) as stderr:
+            query_rds('{"records": "granules"}', results='-')
+        stdout.flush()
+        self.assertEqual(json.loads(stdout.buffer.getvalue()), [1])
+        self.assertIn('Invoking RDS lambda...', stderr.getvalue())
+
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    @patch('pylot.plugins.rds_lambda.main.open_s3_object', side_effect=fake_open_s3_object)
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_query_rds_paged_stdout_is_json(self, mock_invoke, mock_open_s3_object, mock_get_client):
+        stdout = io.StringIO()
+        with patch('sys.stdout', stdout), patch('sys.stderr', io.StringIO()):
+            query_rds('{"records": "granules"}', results='-', page_size=5, key_to=60, workers=2)
+        self.assertEqual(json.loads(stdout.getvalue()), TABLE)
+
+    def test_main_requires_query_or_batch(self):
+        with self.assertRaises(ValueError):
+            main()
+        with self.assertRaises(ValueError):
+            main(query='{"records": "granules"}', batch='batch.json')
+
+    def test_key_range_query(self):
+        query = {'records': 'granules', 'where': 'name LIKE nalma%', 'limit': 10}
+        self.assertEqual(key_range_query(query, 'cumulus_id', 10, 20), {
+            'records': 'granules', 'where': '(name LIKE nalma%) AND cumulus_id >= 10 AND cumulus_id < 20'
+        })
+        self.assertEqual(key_range_query({'records': 'granules'}, 'cumulus_id', 10, limit=1), {
+            'records': 'granules', 'where': 'cumulus_id >= 10', 'limit': 1
+        })
+
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_find_key_upper_bound(self, mock_invoke):
+        self.assertEqual(find_key_upper_bound({'records': 'granules'}, 'cumulus_id', 0, 10), 60)
+        self.assertEqual(find_key_upper_bound({'records': 'granules'}, 'cumulus_id', 0, 100), 100)
+
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_find_key_lower_bound(self, mock_invoke):
+        # The smallest cumulus_id in TABLE is 1
+        self.assertEqual(find_key_lower_bound({'records': 'granules'}, 'cumulus_id', 0, 60, 10), 0)
+        self.assertEqual(find_key_lower_bound({'records': 'granules', 'where': 'cumulus_id >= 33'}, 'cumulus_id', 0,
+                                              60, 5), 30)
+        self.assertEqual(find_key_lower_bound({'records': 'granules'}, 'cumulus_id', 60, 100, 10), 100)
+
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    @patch('pylot.plugins.rds_lambda.main.open_s3_object', side_effect=fake_open_s3_object)
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_query_rds_paged(self, mock_invoke, mock_open_s3_object, mock_get_client):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'results.json')
+            ret = query_rds_paged({'records': 'granules'}, results=results, page_size=5, workers=3)
+            with open(results, 'r', encoding='utf-8') as results_file:
+                self.assertEqual(json.load(results_file), TABLE)
+            self.assertFalse(os.path.isfile(f'{results}.checkpoint'))
+        self.assertEqual(ret.get('count'), len(TABLE))
+
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    @patch('pylot.plugins.rds_lambda.main.open_s3_object', side_effect=fake_open_s3_object)
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_query_rds_paged_limit(self, mock_invoke, mock_open_s3_object, mock_get_client):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'results.jsonl')
+            query_rds_paged({'records': 'granules', 'limit': 12}, results=results, page_size=5, key_to=60,
+                            output_format='jsonl')
+            with open(results, 'r', encoding='utf-8') as results_file:
+                self.assertEqual([json.loads(line) for line in results_file], TABLE[:12])
+
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    @patch('pylot.plugins.rds_lambda.main.open_s3_object', side_effect=fake_open_s3_object)
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query', side_effect=fake_invoke_rds_query)
+    def test_query_rds_paged_limit_stops_writing(self, mock_invoke, mock_open_s3_object, mock_get_client):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'results.json')
+            ret = query_rds_paged({'records': 'granules', 'limit': 3}, results=results, page_size=5, key_to=60,
+                                  workers=4)
+        self.assertEqual(ret.get('count'), 3)
+        # The first page holds enough records, no later page is opened once the limit is reached
+        mock_open_s3_object.assert_called_once()
+
+    @patch('pylot.plugins.rds_lambda.main.get_client')
+    @patch('pylot.plugins.rds_lambda.main.open_s3_object', side_effect=fake_open_s3_object)
+    @patch('pylot.plugins.rds_lambda.main.invoke_rds_query')
+    def test_query_rds_paged_resume(self, mock_invoke, mock_open_s3_object, mock_get_client):
+        def failing_invoke(rds_config, response_cache=None):
+            if 'cumulus_id >= 30' in rds_config.get('where'):
+                raise ConnectionError('lambda failed')
+            return fake_invoke_rds_query(rds_config)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            results = os.path.join(temp_dir, 'results.json')
+            mock_invoke.side_effect = failing_invoke
+            with self.assertRaises(ConnectionError):
+                query_rds_paged({'records': 'granules'}, results=results, page_size=5, key_to=60, workers=2)
+            with open(f'{results}.checkpoint', 'r', encoding='utf-8') as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file).get('next_key'), 30)
+
+            mock_invoke.side_effect = fake_invoke_rds_query
+            # The checkpoint can only be resumed with the key column and page size it was written with
+            with self.assertRaises(ValueError):
+                query_rds_paged({'records': 'granules'}, results=results, page_size=5, key_column='id', resume=True)
+            with self.assertRaises(ValueError):
+                query_rds_paged({'records': 'granules'}, results=results, page_size=10, resume=True)
+            mock_invoke.reset_mock()
+            query_rds_paged({'records': 'granules'}, results=results, page_size=5, workers=2, resume=True)
+            with open(results, 'r', encoding='utf-8') as results_file:
+                self.assertEqual(json.load(results_file), TABLE)
+            lower_bounds = [int(re.search(r'>= (\d+)', x.args[0].get('where')).group(1)) for x in mock_invoke.call_args_list]
+            self.assertEqual(min(lower_bounds), 30)
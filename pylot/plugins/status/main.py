@@ -0,0 +1,303 @@
+import concurrent.futures
+import json
+import os
+import sys
+import tempfile
+import threading
+import zlib
+from contextlib import closing
+
+from .. import PLUGIN_MANIFEST
+from ..helpers.aws_helpers import get_client
+from ..helpers.get_status_helpers import GetStatusHelpers
+from ..helpers.stream_helpers import JsonStreamWriter, iter_json_array, open_output, results_to_stdout
+
+GRANULE_FIELDS = 'granuleId,collectionId,status,published,files'
+MISSING_FROM_S3 = 'missing_from_s3'
+NOT_IN_CUMULUS = 'not_in_cumulus'
+UNPUBLISHED = 'unpublished'
+NOT_COMPLETED = 'not_completed'
+
+
+class SpillPartitions:
+    """
+    Hash partitioned spill files. Lines written with the same key always land in the same partition, so two data sets
+    partitioned this way can be joined one partition at a time without holding either data set in memory.
+    """
+    def __init__(self, directory, name, partitions):
+        self.paths = [os.path.join(directory, f'{name}_{index}.txt') for index in range(partitions)]
+        self.files = [open(path, 'w+', encoding='utf-8') for path in self.paths]
+        self.lock = threading.Lock()
+
+    def partition(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self.files)
+
+    def write(self, key, value=None):
+        line = f'{key}\n' if value is None else f'{key}\t{value}\n'
+        with self.lock:
+            self.files[self.partition(key)].write(line)
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+    def read(self, index):
+        """
+        Generator of (key, value) tuples in a partition. value is None for lines written without one.
+        """
+        with open(self.paths[index], 'r', encoding='utf-8') as file:
+            for line in file:
+                key, _, value = line.rstrip('\n').partition('\t')
+                yield key, value or None
+
+
+def parse_location(location):
+    """
+    :param location: s3://bucket/prefix
+    :return: tuple of (bucket, prefix)
+    """
+    bucket, _, prefix = location.replace('s3://', '', 1).partition('/')
+    return bucket, f"{prefix.rstrip('/')}/" if prefix else ''
+
+
+def in_locations(bucket, key, locations):
+    return any(bucket == location_bucket and key.startswith(prefix) for location_bucket, prefix in locations)
+
+
+def spill_s3_keys(locations, spill, workers, s3_client=None):
+    """
+    Lists every key under the locations into the spill partitions. Each location is split into its sub-prefixes,
+    which are listed in parallel.
+    :return: dictionary of the form {'count': objects, 'bytes': total size}
+    """
+    if not s3_client:
+        s3_client = get_client('s3', max_pool_connections=workers)
+    totals = {'count': 0, 'bytes': 0}
+    lock = threading.Lock()
+
+    def list_keys(bucket, prefix, delimiter=None):
+        count = 0
+        size = 0
+        sub_prefixes = []
+        for rsp in GetStatusHelpers.iter_list_pages(s3_client, bucket, prefix, delimiter):
+            for s3_object in rsp.get('Contents', []):
+                spill.write(f'{bucket}/{s3_object.get("Key")}')
+                count += 1
+                size += s3_object.get('Size', 0)
+            sub_prefixes.extend(common_prefix.get('Prefix') for common_prefix in rsp.get('CommonPrefixes', []))
+        with lock:
+            totals['count'] += count
+            totals['bytes'] += size
+        return sub_prefixes
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for bucket, prefix in locations:
+            # Objects directly under the prefix are listed here and its sub-prefixes are listed in parallel
+            for sub_prefix in list_keys(bucket, prefix, '/'):
+                futures.append(executor.submit(list_keys, bucket, sub_prefix))
+        for future in futures:
+            future.result()
+
+    return totals
+
+
+def iter_cumulus_granules(collection_id, page_size=1000):
+    """
+    Generator of the granules of a collection from the Cumulus API.
+    """
+    from ..cumulus_api.main import paginate
+    from ..helpers.pylot_helpers import PyLOTHelpers
+
+    cml = PyLOTHelpers.get_cumulus_api_instance()
+    for page, _ in paginate(
+            cml.list_granules, sys.maxsize, collectionId=collection_id, fields=GRANULE_FIELDS, limit=page_size
+    ):
+        yield from page
+
+
+def iter_opensearch_granules(collection_id):
+    """
+    Generator of the granules of a collection from an OpenSearch query, streamed from the results object in S3.
+    """
+    from ..helpers.s3_helpers import open_s3_object
+    from ..opensearch.main import query_opensearch
+
+    query = json.dumps({'query': {'term': {'collectionId': collection_id}}})
+    query_result = query_opensearch(query, 'granule', terminate_after=0, download=False)
+    with closing(open_s3_object(query_result.get('bucket'), query_result.get('key'))) as body:
+        for record in iter_json_array(body):
+            yield record.get('_source', record)
+
+
+def spill_granules(granules, locations, spill, writer, report_unpublished=True):
+    """
+    Writes the file keys of each granule under one of the locations to the spill partitions and writes the granules
+    that are unpublished or not completed straight to the report.
+    :return: dictionary of granule, file and status counts
+    """
+    totals = {'granules': 0, 'files': 0, UNPUBLISHED: 0, NOT_COMPLETED: 0, 'status': {}}
+    for granule in granules:
+        granule_id = granule.get('granuleId')
+        totals['granules'] += 1
+        status = granule.get('status')
+        totals['status'][status] = totals['status'].get(status, 0) + 1
+        if status != 'completed':
+            totals[NOT_COMPLETED] += 1
+            writer.write([{'type': NOT_COMPLETED, 'granuleId': granule_id, 'status': status}])
+        if report_unpublished and not granule.get('published'):
+            totals[UNPUBLISHED] += 1
+            writer.write([{'type': UNPUBLISHED, 'granuleId': granule_id, 'status': status}])
+        for file in granule.get('files') or []:
+            if in_locations(file.get('bucket'), file.get('key', ''), locations):
+                totals['files'] += 1
+                spill.write(f'{file.get("bucket")}/{file.get("key")}', granule_id)
+
+    return totals
+
+
+def join_partitions(s3_spill, granule_spill, writer):
+    """
+    Joins the S3 keys with the granule file keys one partition at a time. Only the keys of a single partition of S3
+    keys are held in memory.
+    :return: dictionary with the number of keys missing from S3 and not in Cumulus
+    """
+    totals = {MISSING_FROM_S3: 0, NOT_IN_CUMULUS: 0}
+    for index in range(len(s3_spill.paths)):
+        s3_keys = {key for key, _ in s3_spill.read(index)}
+        for key, granule_id in granule_spill.read(index):
+            if key in s3_keys:
+                s3_keys.discard(key)
+            else:
+                totals[MISSING_FROM_S3] += 1
+                writer.write([{'type': MISSING_FROM_S3, 'granuleId': granule_id, 'key': f's3://{key}'}])
+        totals[NOT_IN_CUMULUS] += len(s3_keys)
+        writer.write({'type': NOT_IN_CUMULUS, 'key': f's3://{key}'} for key in sorted(s3_keys))
+
+    return totals
+
+
+def reconcile(collection_id, locations, writer, source='cumulus', partitions=64, workers=8, report_unpublished=True):
+    """
+    Compares the objects in S3 with the granule files recorded by Cumulus for a collection. S3 and Cumulus are read
+    concurrently into hash partitioned spill files which are then joined partition by partition, so memory use
+    depends on the size of a partition rather than the size of the collection. Only differences are written to the
+    report.
+    :param collection_id: collection to reconcile, e.g. nalmaraw___1
+    :param locations: list of s3://bucket/prefix locations that hold the collection's files
+    :param writer: JsonStreamWriter the differences are written to
+    :param source: where granules are read from: cumulus for the Cumulus API or opensearch for the OpenSearch lambda
+    :param partitions: number of spill partitions
+    :param workers: number of concurrent S3 listings
+    :param report_unpublished: report granules that have not been published to CMR
+    :return: summary dictionary
+    """
+    locations = [parse_location(location) for location in locations]
+    granules = iter_opensearch_granules(collection_id) if source == 'opensearch' else iter_cumulus_granules(collection_id)
+    with tempfile.TemporaryDirectory(prefix='pylot_status_') as spill_dir:
+        s3_spill = SpillPartitions(spill_dir, 's3', partitions)
+        granule_spill = SpillPartitions(spill_dir, 'granules', partitions)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                s3_future = executor.submit(spill_s3_keys, locations, s3_spill, workers)
+                granule_future = executor.submit(
+                    spill_granules, granules, locations, granule_spill, writer, report_unpublished
+                )
+                s3_totals = s3_future.result()
+                granule_totals = granule_future.result()
+        finally:
+            s3_spill.close()
+            granule_spill.close()
+        differences = join_partitions(s3_spill, granule_spill, writer)
+
+    return {
+        'collection': collection_id,
+        's3': s3_totals,
+        source: granule_totals,
+        'differences': {
+            **differences,
+            UNPUBLISHED: granule_totals.get(UNPUBLISHED),
+            NOT_COMPLETED: granule_totals.get(NOT_COMPLETED)
+        }
+    }
+
+
+def return_parser(subparsers):
+    subparser = subparsers.add_parser(
+        'status',
+        help=PLUGIN_MANIFEST.get('status'),
+        description='Reconcile the objects in S3 with the granule records in Cumulus for a collection. Only the '
+                    'differences are reported.\n'
+                    'Example: pylot status nalmaraw___1 -l s3://ghrcsbxw-protected/nalmaraw__1'
+    )
+    subparser.add_argument(
+        'collection_id',
+        help='The collection to reconcile: <name>___<version>',
+        metavar='collection_id'
+    )
+    subparser.add_argument(
+        '-l', '--location',
+        help='s3://bucket/prefix holding files of the collection. Can be provided more than once.',
+        metavar='',
+        dest='locations',
+        action='append',
+        required=True
+    )
+    subparser.add_argument(
+        '-s', '--source',
+        help='Where granule records are read from: cumulus (the Cumulus API) or opensearch (the OpenSearch lambda). '
+             'Default is cumulus.',
+        metavar='',
+        choices=['cumulus', 'opensearch'],
+        default='cumulus'
+    )
+    subparser.add_argument(
+        '-o', '--output',
+        help='Write the differences to this file instead of stdout.',
+        metavar=''
+    )
+    subparser.add_argument(
+        '-f', '--format',
+        help='Format of the differences: json for a JSON array or jsonl for JSON Lines. Default is json.',
+        metavar='',
+        dest='output_format',
+        choices=['json', 'jsonl'],
+        default='json'
+    )
+    subparser.add_argument(
+        '-p', '--partitions',
+        help='Number of spill partitions used to join S3 and Cumulus. Increase for collections with tens of millions '
+             'of files to reduce memory use. Default is 64.',
+        metavar='',
+        type=int,
+        default=64
+    )
+    subparser.add_argument(
+        '-w', '--workers',
+        help='Number of concurrent S3 listings. Default is 8.',
+        metavar='',
+        type=int,
+        default=8
+    )
+    subparser.add_argument(
+        '--ignore-unpublished',
+        help='Do not report granules that have not been published to CMR.',
+        dest='report_unpublished',
+        action='store_false'
+    )
+
+
+def main(collection_id, locations, source='cumulus', output=None, output_format='json', partitions=64, workers=8,
+         report_unpublished=True, **kwargs):
+    # Without an output file the differences are streamed to stdout, so the summary is printed to stderr
+    with results_to_stdout(output is None):
+        with open_output(output) as outfile:
+            writer = JsonStreamWriter(outfile, json_lines=output_format == 'jsonl')
+            summary = reconcile(collection_id, locations, writer, source, partitions, workers, report_unpublished)
+            writer.close()
+
+        print(json.dumps(summary, indent=2))
+        if output:
+            print(f'Differences written to: {output}')
+
+    return 0
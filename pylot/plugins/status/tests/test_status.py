@@ -0,0 +1,115 @@
+import argparse
+import io
+import json
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from pylot.plugins.helpers.stream_helpers import JsonStreamWriter
+from pylot.plugins.helpers.tests.test_get_status_helpers import fake_list_objects_v2
+from pylot.plugins.status.main import SpillPartitions, join_partitions, parse_location, reconcile, return_parser, \
+    main
+
+KEYS = {
+    'collection/a/granule_1.nc': 10,
+    'collection/a/granule_1.nc.md5': 1,
+    'collection/b/granule_2.nc': 20,
+    'collection/orphan.nc': 5,
+}
+
+GRANULES = [
+    {
+        'granuleId': 'granule_1', 'status': 'completed', 'published': True,
+        'files': [
+            {'bucket': 'bucket', 'key': 'collection/a/granule_1.nc'},
+            {'bucket': 'bucket', 'key': 'collection/a/granule_1.nc.md5'},
+            {'bucket': 'other-bucket', 'key': 'collection/a/granule_1.cmr.xml'}
+        ]
+    },
+    {
+        'granuleId': 'granule_2', 'status': 'failed', 'published': False,
+        'files': [{'bucket': 'bucket', 'key': 'collection/b/granule_2.nc'}]
+    },
+    {
+        'granuleId': 'granule_3', 'status': 'completed', 'published': True,
+        'files': [{'bucket': 'bucket', 'key': 'collection/c/granule_3.nc'}]
+    },
+]
+
+
+class TestStatus(unittest.TestCase):
+    def test_return_parser(self):
+        parser = argparse.ArgumentParser()
+        subparsers = parser.add_subparsers(title='plugins', dest='command', required=True)
+        return_parser(subparsers)
+        args = parser.parse_args(['status', 'nalmaraw___1', '-l', 's3://bucket/a', '-l', 's3://bucket/b'])
+        self.assertEqual(args.locations, ['s3://bucket/a', 's3://bucket/b'])
+        self.assertTrue(args.report_unpublished)
+
+    def test_parse_location(self):
+        self.assertEqual(parse_location('s3://bucket/collection'), ('bucket', 'collection/'))
+        self.assertEqual(parse_location('s3://bucket'), ('bucket', ''))
+
+    def test_join_partitions(self):
+        with tempfile.TemporaryDirectory() as spill_dir:
+            s3_spill = SpillPartitions(spill_dir, 's3', 4)
+            granule_spill = SpillPartitions(spill_dir, 'granules', 4)
+            for key in ('bucket/a', 'bucket/b', 'bucket/c'):
+                s3_spill.write(key)
+            granule_spill.write('bucket/a', 'granule_a')
+            granule_spill.write('bucket/d', 'granule_d')
+            s3_spill.close()
+            granule_spill.close()
+            output = io.StringIO()
+            totals = join_partitions(s3_spill, granule_spill, JsonStreamWriter(output, json_lines=True))
+
+        self.assertEqual(totals, {'missing_from_s3': 1, 'not_in_cumulus': 2})
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertIn({'type': 'missing_from_s3', 'granuleId': 'granule_d', 'key': 's3://bucket/d'}, records)
+
+    @patch('pylot.plugins.status.main.iter_cumulus_granules')
+    @patch('pylot.plugins.status.main.get_client')
+    def test_reconcile(self, mock_get_client, mock_iter_cumulus_granules):
+        mock_get_client.return_value.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        mock_iter_cumulus_granules.return_value = iter(GRANULES)
+        output = io.StringIO()
+        summary = reconcile('collection___1', ['s3://bucket/collection'], JsonStreamWriter(output, json_lines=True),
+                            partitions=3, workers=2)
+
+        self.assertEqual(summary.get('s3'), {'count': 4, 'bytes': 36})
+        self.assertEqual(summary.get('cumulus').get('granules'), 3)
+        self.assertEqual(summary.get('cumulus').get('files'), 4)
+        self.assertEqual(summary.get('differences'), {
+            'missing_from_s3': 1, 'not_in_cumulus': 1, 'unpublished': 1, 'not_completed': 1
+        })
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(sorted(record.get('type') for record in records), [
+            'missing_from_s3', 'not_completed', 'not_in_cumulus', 'unpublished'
+        ])
+        self.assertIn({'type': 'not_in_cumulus', 'key': 's3://bucket/collection/orphan.nc'}, records)
+
+    @patch('pylot.plugins.status.main.iter_opensearch_granules')
+    @patch('pylot.plugins.status.main.get_client')
+    def test_reconcile_opensearch(self, mock_get_client, mock_iter_opensearch_granules):
+        mock_get_client.return_value = MagicMock()
+        mock_get_client.return_value.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        mock_iter_opensearch_granules.return_value = iter(GRANULES[:1])
+        summary = reconcile('collection___1', ['s3://bucket/collection/a'], JsonStreamWriter(io.StringIO()),
+                            source='opensearch')
+        self.assertEqual(summary.get('differences'), {
+            'missing_from_s3': 0, 'not_in_cumulus': 0, 'unpublished': 0, 'not_completed': 0
+        })
+
+    @patch('pylot.plugins.status.main.iter_cumulus_granules')
+    @patch('pylot.plugins.status.main.get_client')
+    def test_main_stdout_is_json(self, mock_get_client, mock_iter_cumulus_granules):
+        mock_get_client.return_value.list_objects_v2.side_effect = fake_list_objects_v2(KEYS)
+        mock_iter_cumulus_granules.return_value = iter(GRANULES)
+        with patch('sys.stdout', io.StringIO()) as stdout, patch('sys.stderr', io.StringIO()) as stderr:
+            main('collection___1', ['s3://bucket/collection'], partitions=3, workers=2)
+        self.assertEqual(len(json.loads(stdout.getvalue())), 4)
+        self.assertIn('"differences"', stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,36 +5,84 @@ import os
 import sys
 from json import JSONDecodeError
 
+from pylot.plugins import PLUGIN_MANIFEST
+from pylot.plugins.helpers.stream_helpers import results_to_stdout
+from pylot.plugins.helpers.telemetry_helpers import TELEMETRY, TELEMETRY_OPTIONS, add_telemetry_arguments
 
-def import_plugins():
+
+def discover_plugins():
+    """
+    Finds the available plugins without importing them. Help text is taken from the plugin manifest.
+    :return: dictionary of the form {plugin_name: help_text}
+    """
     plugin_filter = {
         'helpers'
     }
     plugins = {}
     plugin_dir = f'{os.path.abspath(os.path.dirname(__file__))}/plugins'
-    for file in os.listdir(plugin_dir):
-        if not file.startswith('_') and file not in plugin_filter:
-            plugin = f'pylot.plugins.{file}.main'
-            print(f'Loading plugin: {plugin}')
-            module = importlib.import_module(plugin)
-            plugins[file] = module
+    for file in sorted(os.listdir(plugin_dir)):
+        if not file.startswith('_') and file not in plugin_filter and os.path.isdir(f'{plugin_dir}/{file}'):
+            plugins[file] = PLUGIN_MANIFEST.get(file, '')
+
+    return plugins
+
+
+def import_plugins(names=None):
+    """
+    Imports the main module of each plugin.
+    :param names: iterable of plugin names to import. All discovered plugins are imported if not provided.
+    :return: dictionary of the form {plugin_name: module}
+    """
+    if names is None:
+        names = discover_plugins()
+    plugins = {}
+    for file in names:
+        plugin = f'pylot.plugins.{file}.main'
+        # Printed to stderr so results streamed to stdout start with the results
+        print(f'Loading plugin: {plugin}', file=sys.stderr)
+        module = importlib.import_module(plugin)
+        plugins[file] = module
 
     return plugins
 
 
-def create_arg_parser(plugins):
+def select_plugin(argv, plugin_names):
+    """
+    Determines which plugin was requested on the commandline so that only that plugin needs to be imported.
+    :param argv: commandline arguments excluding the program name
+    :param plugin_names: iterable of available plugin names
+    :return: the plugin name or None if no plugin was requested
+    """
+    arguments = iter(argv)
+    for argument in arguments:
+        if argument in TELEMETRY_OPTIONS:
+            # Skip the value of the option
+            next(arguments, None)
+        elif not argument.startswith('-'):
+            return argument if argument in plugin_names else None
+
+    return None
+
+
+def create_arg_parser(plugins, manifest=None):
     parser = argparse.ArgumentParser(
         usage='<plugin> -h to access help for each plugin. \n',
         description='PyLOT command line utility.'
     )
+    add_telemetry_arguments(parser)
 
     # load plugin parsers
     subparsers = parser.add_subparsers(title='plugins', dest='command', required=True)
-    for name, module in plugins.items():
-        try:
-            module.return_parser(subparsers)
-        except AttributeError:
-            raise ValueError(f'Plugin {name} does not have a return_parser function.')
+    for name in (plugins if manifest is None else manifest):
+        module = plugins.get(name)
+        if module:
+            try:
+                module.return_parser(subparsers)
+            except AttributeError:
+                raise ValueError(f'Plugin {name} does not have a return_parser function.')
+        else:
+            # Placeholder so plugins that were not imported still show up in the help text
+            subparsers.add_parser(name, help=manifest.get(name))
     return parser
 
 
@@ -58,14 +106,24 @@ def process_unknown_args(unknown):
 def main():
     if len(sys.argv) == 1:
         sys.argv.append('-h')
-    plugins = import_plugins()
-    parser = create_arg_parser(plugins)
+    manifest = discover_plugins()
+    selected = select_plugin(sys.argv[1:], manifest)
+    plugins = import_plugins([selected] if selected else [])
+    parser = create_arg_parser(plugins, manifest)
     args, unknown = parser.parse_known_args()
     keyword_args = {**vars(args), **process_unknown_args(unknown)}
     # Try to call the plugin's main
     command = keyword_args.pop('command')
+    TELEMETRY.configure(
+        command, keyword_args.pop('metrics_file'), keyword_args.pop('prometheus_file'), keyword_args.pop('statsd')
+    )
     plugin = plugins.get(command)
-    getattr(plugin, 'main')(**keyword_args)
+    try:
+        # Results streamed to stdout with -r - must not be mixed with anything the plugin prints
+        with results_to_stdout(keyword_args.get('results') == '-'):
+            getattr(plugin, 'main')(**keyword_args)
+    finally:
+        TELEMETRY.finish()
 
     return 0
 
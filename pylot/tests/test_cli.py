@@ -1,6 +1,8 @@
+import io
 import unittest
+from unittest.mock import patch
 
-from pylot.pylot_cli import import_plugins, create_arg_parser, process_unknown_args
+from pylot.pylot_cli import import_plugins, create_arg_parser, process_unknown_args, discover_plugins, select_plugin
 
 
 class TestCli(unittest.TestCase):
@@ -8,12 +10,38 @@ class TestCli(unittest.TestCase):
 
     def test_import_plugins(self):
         plugins = import_plugins()
-        self.assertEqual(len(plugins), 3)
+        self.assertEqual(len(plugins), 4)
+
+    def test_import_selected_plugin(self):
+        with patch('sys.stdout', io.StringIO()) as stdout, patch('sys.stderr', io.StringIO()) as stderr:
+            plugins = import_plugins(['rds_lambda'])
+        self.assertEqual(list(plugins), ['rds_lambda'])
+        self.assertEqual(stdout.getvalue(), '')
+        self.assertIn('Loading plugin: pylot.plugins.rds_lambda.main', stderr.getvalue())
+
+    def test_discover_plugins(self):
+        manifest = discover_plugins()
+        self.assertEqual(list(manifest), ['cumulus_api', 'opensearch', 'rds_lambda', 'status'])
+
+    def test_select_plugin(self):
+        manifest = discover_plugins()
+        self.assertEqual(select_plugin(['opensearch', 'granule', '-q', 'query.json'], manifest), 'opensearch')
+        self.assertIsNone(select_plugin(['-h'], manifest))
+        self.assertIsNone(select_plugin(['not_a_plugin'], manifest))
+        self.assertEqual(select_plugin(['--metrics-file', 'metrics.json', 'rds_lambda', 'query.json'], manifest),
+                         'rds_lambda')
 
     def test_create_argparser(self):
         plugins = import_plugins()
         parser = create_arg_parser(plugins)
 
+    def test_create_argparser_with_manifest(self):
+        manifest = discover_plugins()
+        parser = create_arg_parser(import_plugins(['rds_lambda']), manifest)
+        args = parser.parse_args(['rds_lambda', 'query.json'])
+        self.assertEqual(args.command, 'rds_lambda')
+        self.assertIn('opensearch', parser.format_help())
+
     def test_process_unknown_args(self):
         args = ['limit=1', 'sort_by=granuleId']
         res = process_unknown_args(args)